@@ -0,0 +1,93 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vault_backup_analyzer  # noqa: E402
+
+
+# Analysis modes: keyword arguments of analyze_backup
+MODES = {
+    'mmap': {},
+    'text': {'use_mmap': False},
+    'counts-only': {'counts_only': True},
+    'workers-4': {'workers': 4},
+    'max-memory': {'budget': vault_backup_analyzer.MemoryBudget(256 << 20)},
+}
+
+
+def run_mode(backup_file_name, mode):
+    """Analyze backup once in this process, mount tables are read from backup itself"""
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(backup_file_name)
+    started = time.perf_counter()
+    metric_slots, _ = vault_backup_analyzer.analyze_backup(backup_file_name, auth_backs, secrets_engs,
+                                                           **MODES[mode])
+    elapsed = time.perf_counter() - started
+    return {'mode': mode, 'seconds': elapsed, 'peak_rss': vault_backup_analyzer.peak_rss()}
+
+
+def count_elements(backup_file_name):
+    return sum(1 for _ in vault_backup_analyzer.iter_backup_records(backup_file_name, counts_only=True))
+
+
+def measure(backup_file_name, mode, repeat):
+    """The best of repeat runs, every run in a fresh process, so peak RSS belongs to the mode alone"""
+    results = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--run', mode,
+                                          backup_file_name])
+        results.append(json.loads(output.decode('utf-8')))
+    return min(results, key=lambda result: result['seconds'])
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure analysis throughput and peak RSS on a backup, '
+                                                 'e.g. one made with generate_backup.py --decrypted')
+    parser.add_argument('backup_file', help='Backup with unencrypted mount tables')
+    parser.add_argument('--modes', default=','.join(MODES), help='Comma separated modes, default: all')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per mode, the best one is reported')
+    parser.add_argument('--save', help='Write results to JSON file, to compare later runs with')
+    parser.add_argument('--baseline', help='JSON file of previous run, exit with error on slowdown')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown against baseline, default: 0.2 (20%%)')
+    parser.add_argument('--run', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    if ARGS.run:
+        print(json.dumps(run_mode(ARGS.backup_file, ARGS.run)))
+        sys.exit(0)
+
+    # Elements are counted after modes are measured: peak RSS of this process is inherited by children
+    RESULTS = {MODE: measure(ARGS.backup_file, MODE, ARGS.repeat) for MODE in ARGS.modes.split(',')}
+    SIZE = os.path.getsize(ARGS.backup_file)
+    ELEMENTS = count_elements(ARGS.backup_file)
+    print('{}: {:.1f} MB, {} elements'.format(ARGS.backup_file, SIZE / 1e6, ELEMENTS))
+    print('{:<12} {:>9} {:>9} {:>13} {:>13}'.format('mode', 'seconds', 'MB/s', 'elements/s', 'peak RSS MB'))
+
+    for MODE, RESULT in RESULTS.items():
+        RESULT['mb_per_second'] = SIZE / 1e6 / RESULT['seconds']
+        RESULT['elements_per_second'] = ELEMENTS / RESULT['seconds']
+        print('{:<12} {:>9.3f} {:>9.1f} {:>13.0f} {:>13.1f}'.format(
+            MODE, RESULT['seconds'], RESULT['mb_per_second'], RESULT['elements_per_second'],
+            RESULT['peak_rss'] / 1e6))
+
+    if ARGS.save:
+        with open(ARGS.save, 'w') as RESULTS_FILE:
+            RESULTS_FILE.write(json.dumps(RESULTS, indent=2))
+
+    if ARGS.baseline:
+        with open(ARGS.baseline, 'r') as BASELINE_FILE:
+            BASELINE = json.loads(BASELINE_FILE.read())
+        SLOWER = [MODE for MODE, RESULT in RESULTS.items() if MODE in BASELINE and
+                  RESULT['mb_per_second'] < BASELINE[MODE]['mb_per_second'] * (1 - ARGS.tolerance)]
+        for MODE in SLOWER:
+            print('{} is slower than baseline: {:.1f} MB/s instead of {:.1f} MB/s'.format(
+                MODE, RESULTS[MODE]['mb_per_second'], BASELINE[MODE]['mb_per_second']))
+        if SLOWER:
+            sys.exit(1)
@@ -0,0 +1,191 @@
+import argparse
+import base64
+import json
+import random
+import time
+
+
+# Base64 encoded random bytes values are sliced from, so values are cheap to produce at any scale
+POOL_SIZE = 1 << 22
+LEASE_TTL = 7 * 86400
+
+
+class BackupWriter:
+    """Writes elements in `consul kv export` layout one by one, nothing is kept in memory"""
+    def __init__(self, backup_file, prefix):
+        self.backup_file = backup_file
+        self.prefix = prefix
+        self.elements = 0
+        self.backup_file.write('[')
+
+    def write(self, key, value):
+        separator = ',' if self.elements else ''
+        self.backup_file.write('{}\n\t{{\n\t\t"key": {},\n\t\t"flags": 0,\n\t\t"value": "{}"\n\t}}'.format(
+            separator, json.dumps('/'.join((self.prefix, key))), value))
+        self.elements += 1
+
+    def close(self):
+        self.backup_file.write('\n]\n')
+
+
+class Generator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        pool = self.rng.getrandbits(POOL_SIZE * 8).to_bytes(POOL_SIZE, 'little')
+        self.pool = base64.b64encode(pool).decode('ascii')
+        self.now = args.now
+
+    def uuid(self):
+        value = '{:032x}'.format(self.rng.getrandbits(128))
+        return '-'.join((value[:8], value[8:12], value[12:16], value[16:20], value[20:]))
+
+    def hash(self):
+        return '{:064x}'.format(self.rng.getrandbits(256))
+
+    def value(self, size=None):
+        """Base64 encoded random value of about size bytes, --value-size on average"""
+        if size is None:
+            size = self.rng.randint(self.args.value_size // 2, self.args.value_size * 3 // 2)
+        encoded_size = (size + 2) // 3 * 4
+        start = self.rng.randrange(0, len(self.pool) - encoded_size) // 4 * 4
+        return self.pool[start:start + encoded_size]
+
+    def plain(self, value):
+        """Value as stored in decrypted backup, random one as encrypted by vault barrier otherwise"""
+        if not self.args.decrypted:
+            return self.value(len(json.dumps(value)) + 40)
+        return base64.b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+    def time(self, timestamp):
+        return time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp)) + '.000000000Z'
+
+    def mounts(self):
+        auth = [('token', 'token')]
+        auth += [('approle', 'approle' if 0 == idx else 'approle-{}'.format(idx))
+                 for idx in range(self.args.approle_mounts)]
+        auth += [('userpass', 'userpass')]
+        secrets = [('cubbyhole', 'cubbyhole', None), ('identity', 'identity', None), ('system', 'sys', None),
+                   ('transit', 'transit', None)]
+        secrets += [('kv', 'kv1-{}'.format(idx), '1') for idx in range(self.args.kv1_mounts)]
+        secrets += [('kv', 'kv2-{}'.format(idx), '2') for idx in range(self.args.kv2_mounts)]
+        return ([{'type': m_type, 'path': path, 'uuid': self.uuid()} for m_type, path in auth],
+                [{'type': m_type, 'path': path, 'uuid': self.uuid(), 'version': version}
+                 for m_type, path, version in secrets])
+
+    def mount_table(self, table, mounts):
+        entries = []
+        for mount in mounts:
+            entry = {'table': table, 'path': mount['path'] + '/', 'type': mount['type'], 'uuid': mount['uuid']}
+            if mount.get('version'):
+                entry['options'] = {'version': mount['version']}
+            entries.append(entry)
+        return {'type': table, 'entries': entries}
+
+    def lease(self, writer, path):
+        issue_time = self.now - self.rng.randrange(LEASE_TTL)
+        lease_id = '/'.join((path, self.hash()))
+        writer.write('sys/expire/id/' + lease_id, self.plain({
+            'lease_id': lease_id, 'path': path, 'issue_time': self.time(issue_time),
+            'expire_time': self.time(issue_time + LEASE_TTL), 'last_renewal_time': self.time(0)}))
+
+    def generate(self, writer):
+        args = self.args
+        auth, secrets = self.mounts()
+
+        writer.write('audit/{}/salt'.format(self.uuid()), self.value(64))
+        writer.write('core/auth', self.plain(self.mount_table('auth', auth)))
+        writer.write('core/mounts', self.plain(self.mount_table('mounts', secrets)))
+        for key in ('audit', 'keyring', 'master', 'seal-config', 'wrapping/jwtkey', 'cluster/local/info'):
+            writer.write('core/' + key, self.value())
+
+        approles = [mount for mount in auth if 'approle' == mount['type']]
+        for mount in approles:
+            base = 'auth/{}/'.format(mount['uuid'])
+            writer.write(base + 'salt', self.value(64))
+            for role in range(args.roles):
+                writer.write(base + 'role/role-{}'.format(role), self.value())
+                writer.write(base + 'role_id/' + self.hash(), self.value())
+                role_hmac = self.hash()
+                for _ in range(args.secret_ids):
+                    writer.write(base + 'secret_id/{}/{}'.format(role_hmac, self.hash()), self.value())
+                    writer.write(base + 'accessor/' + self.hash(), self.value())
+        userpass = [mount for mount in auth if 'userpass' == mount['type']][0]
+        for user in range(args.users):
+            writer.write('auth/{}/user/user-{}'.format(userpass['uuid'], user), self.value())
+
+        for mount in secrets:
+            base = 'logical/{}/'.format(mount['uuid'])
+            if '1' == mount['version']:
+                for secret in range(args.secrets):
+                    writer.write(base + 'path/to/{}/secret-{}'.format(secret % 100, secret), self.value())
+            elif '2' == mount['version']:
+                base += self.uuid() + '/'
+                writer.write(base + 'salt', self.value(64))
+                writer.write(base + 'policy/metadata', self.value())
+                for _ in range(args.secrets):
+                    secret_hash = self.hash()
+                    writer.write(base + 'metadata/' + secret_hash, self.value())
+                    for _ in range(args.versions):
+                        version_hash = self.hash()
+                        writer.write(base + 'versions/{}/{}'.format(version_hash[:3], version_hash), self.value())
+            elif 'transit' == mount['type']:
+                for key in range(10):
+                    writer.write(base + 'policy/key-{}'.format(key), self.value())
+                    writer.write(base + 'archive/key-{}'.format(key), self.value())
+            elif 'identity' == mount['type']:
+                for bucket in range(256):
+                    writer.write(base + 'packer/buckets/{}'.format(bucket), self.value())
+
+        for name in ('default', 'control-group', 'response-wrapping', 'backup-analyzer'):
+            writer.write('sys/policy/' + name, self.value())
+        writer.write('sys/token/salt', self.value(64))
+        month = time.strftime('%Y/%m', time.gmtime(self.now))
+        writer.write('sys/counters/requests/' + month, self.value(16))
+
+        # Every login makes a token, its accessor and a lease
+        login_paths = ['auth/{}/login'.format(mount['path']) for mount in approles]
+        login_paths += ['auth/userpass/login/user-{}'.format(user) for user in range(min(args.users, 100))]
+        for lease in range(args.leases):
+            writer.write('sys/token/id/' + self.hash(), self.value())
+            writer.write('sys/token/accessor/' + self.hash(), self.value())
+            self.lease(writer, login_paths[lease % len(login_paths)])
+        for _ in range(args.tokens):
+            writer.write('sys/token/id/' + self.hash(), self.value())
+            writer.write('sys/token/accessor/' + self.hash(), self.value())
+            self.lease(writer, 'auth/token/create')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Generate synthetic vault backup in `consul kv export` format '
+                                                 'without vault and consul')
+    parser.add_argument('backup_file', help='File to write backup to')
+    parser.add_argument('--prefix', default='vault', help='Consul KV prefix, default: vault')
+    parser.add_argument('--approle-mounts', type=int, default=1, help='Number of approle auth backends')
+    parser.add_argument('--roles', type=int, default=10, help='Roles per approle auth backend')
+    parser.add_argument('--secret-ids', type=int, default=10, help='Secret IDs per role')
+    parser.add_argument('--users', type=int, default=10, help='Users of userpass auth backend')
+    parser.add_argument('--kv1-mounts', type=int, default=1, help='Number of KVv1 secrets engines')
+    parser.add_argument('--kv2-mounts', type=int, default=1, help='Number of KVv2 secrets engines')
+    parser.add_argument('--secrets', type=int, default=1000, help='Secrets per KV secrets engine')
+    parser.add_argument('--versions', type=int, default=3, help='Versions per KVv2 secret')
+    parser.add_argument('--leases', type=int, default=10000, help='Login leases, each with token and accessor')
+    parser.add_argument('--tokens', type=int, default=1000, help='Tokens created with token auth backend')
+    parser.add_argument('--value-size', type=int, default=300, help='Average size of values in bytes')
+    parser.add_argument('--decrypted', action='store_true',
+                        help='Store mount tables and leases as plain JSON, as in decrypted backup. '
+                             'Required to analyze generated backup with --offline and --lease-timeline')
+    parser.add_argument('--now', type=int, default=int(time.time()),
+                        help='Unix time leases are issued before and expire after, default: current time')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Random seed, the same seed and --now give the same backup')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    with open(ARGS.backup_file, 'w', buffering=1 << 20) as BACKUP_FILE:
+        WRITER = BackupWriter(BACKUP_FILE, ARGS.prefix)
+        Generator(ARGS).generate(WRITER)
+        WRITER.close()
+    print('{} elements written to {}'.format(WRITER.elements, ARGS.backup_file))
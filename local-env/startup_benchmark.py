@@ -0,0 +1,97 @@
+import argparse
+import http.server
+import json
+import os
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+MAIN = os.path.join(ROOT, 'main.py')
+SCRIPT = os.path.join(ROOT, 'vault_backup_analyzer.py')
+# Scenarios: arguments of python, {backup} and {pushgateway} are substituted
+OFFLINE = ['{backup}', '{pushgateway}', 'env=startup', '--offline']
+SCENARIOS = {
+    'import': ['-c', 'import vault_backup_analyzer'],
+    'help': [MAIN, '--help'],
+    'offline': [MAIN] + OFFLINE,
+    'offline-script': [SCRIPT] + OFFLINE,
+    'counts-only': [MAIN] + OFFLINE + ['--counts-only'],
+}
+
+
+class PushgatewayHandler(http.server.BaseHTTPRequestHandler):
+    """Accepts pushed metrics and drops them, so push time doesn't depend on real pushgateway"""
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_POST = do_PUT
+
+    def log_message(self, *args):
+        pass
+
+
+def start_pushgateway():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PushgatewayHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return '127.0.0.1:{}'.format(server.server_address[1])
+
+
+def measure(scenario, backup_file_name, pushgateway_addr, repeat):
+    """Wall time of repeat runs of scenario in fresh processes, after one run which fills bytecode caches"""
+    command = [sys.executable] + [argument.format(backup=backup_file_name, pushgateway=pushgateway_addr)
+                                  for argument in SCENARIOS[scenario]]
+    times = []
+    for _ in range(repeat + 1):
+        started = time.perf_counter()
+        subprocess.run(command, cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - started)
+    return {'scenario': scenario, 'best': min(times[1:]), 'median': statistics.median(times[1:])}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure startup time of short runs: import, --help and analysis '
+                                                 'of a small backup pushed to local stub of pushgateway')
+    parser.add_argument('backup_file', help='Small backup with unencrypted mount tables, e.g. one made with '
+                                            'generate_backup.py --decrypted')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS), help='Comma separated scenarios, default: all')
+    parser.add_argument('--repeat', type=int, default=10, help='Runs per scenario')
+    parser.add_argument('--save', help='Write results to JSON file, to compare later runs with')
+    parser.add_argument('--baseline', help='JSON file of previous run, exit with error on slowdown')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown of median time against baseline, default: 0.2 (20%%)')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    ARGS = parse_args()
+    PUSHGATEWAY_ADDR = start_pushgateway()
+    BACKUP_FILE = os.path.abspath(ARGS.backup_file)
+
+    print('{:<16} {:>9} {:>11}'.format('scenario', 'best ms', 'median ms'))
+    RESULTS = {}
+    for SCENARIO in ARGS.scenarios.split(','):
+        RESULT = measure(SCENARIO, BACKUP_FILE, PUSHGATEWAY_ADDR, ARGS.repeat)
+        RESULTS[SCENARIO] = RESULT
+        print('{:<16} {:>9.1f} {:>11.1f}'.format(SCENARIO, RESULT['best'] * 1000, RESULT['median'] * 1000))
+
+    if ARGS.save:
+        with open(ARGS.save, 'w') as RESULTS_FILE:
+            RESULTS_FILE.write(json.dumps(RESULTS, indent=2))
+
+    if ARGS.baseline:
+        with open(ARGS.baseline, 'r') as BASELINE_FILE:
+            BASELINE = json.loads(BASELINE_FILE.read())
+        SLOWER = [SCENARIO for SCENARIO, RESULT in RESULTS.items() if SCENARIO in BASELINE and
+                  RESULT['median'] > BASELINE[SCENARIO]['median'] * (1 + ARGS.tolerance)]
+        for SCENARIO in SLOWER:
+            print('{} is slower than baseline: {:.1f} ms instead of {:.1f} ms'.format(
+                SCENARIO, RESULTS[SCENARIO]['median'] * 1000, BASELINE[SCENARIO]['median'] * 1000))
+        if SLOWER:
+            sys.exit(1)
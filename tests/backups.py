@@ -0,0 +1,156 @@
+"""Builders of small vault backups the tests analyze: consul export and integrated storage snapshots"""
+import base64
+import io
+import json
+import struct
+import tarfile
+
+
+AUTH_MOUNTS = [
+    {'table': 'auth', 'path': 'token/', 'type': 'token', 'uuid': 'aaaa-1'},
+    {'table': 'auth', 'path': 'approle/', 'type': 'approle', 'uuid': 'aaaa-2'},
+]
+SECRETS_MOUNTS = [
+    {'table': 'mounts', 'path': 'cubbyhole/', 'type': 'cubbyhole', 'uuid': 'ssss-1'},
+    {'table': 'mounts', 'path': 'simple/', 'type': 'kv', 'uuid': 'ssss-2', 'options': {'version': '1'}},
+    {'table': 'mounts', 'path': 'secret/', 'type': 'kv', 'uuid': 'ssss-3', 'options': {'version': '2'}},
+]
+
+
+def storage_entries():
+    """(key without consul prefix, value) pairs of decrypted backup with mount tables"""
+    return [
+        ('audit/x-1/salt', b'salt'),
+        ('core/auth', json.dumps({'type': 'auth', 'entries': AUTH_MOUNTS}).encode('utf-8')),
+        ('core/mounts', json.dumps({'type': 'mounts', 'entries': SECRETS_MOUNTS}).encode('utf-8')),
+        ('core/keyring', b'k' * 100),
+        ('auth/aaaa-2/role/backup-analyzer', b'r' * 30),
+        ('auth/aaaa-2/role_id/h1', b'i' * 20),
+        ('auth/aaaa-2/secret_id/h2/h3', b's' * 41),
+        ('auth/aaaa-2/accessor/h4', b'a' * 7),
+        ('logical/ssss-1/sha/path/secret', b'c' * 12),
+        ('logical/ssss-2/path/to/secret', b'v' * 300),
+        ('logical/ssss-2/root', b''),
+        ('logical/ssss-3/u1/metadata/h', b'm' * 64),
+        ('logical/ssss-3/u1/versions/v/h', b'v' * 65),
+        ('logical/ssss-3/u1/salt', b's' * 66),
+        ('sys/policy/default', b'p' * 10),
+        ('sys/token/id/h', b't' * 11),
+        ('sys/token/accessor/x', b'x' * 13),
+        ('sys/expire/id/auth/approle/login/h', json.dumps({
+            'lease_id': 'auth/approle/login/h', 'path': 'auth/approle/login',
+            'issue_time': '2020-01-01T00:00:00Z', 'expire_time': '2020-01-08T00:00:00Z'}).encode('utf-8')),
+    ]
+
+
+def export_elements(entries, prefix='vault'):
+    """Elements of `consul kv export` array"""
+    return [{'key': '/'.join((prefix, key)), 'flags': 0, 'value': base64.b64encode(value).decode('ascii')}
+            for key, value in entries]
+
+
+def write_export(path, entries, prefix='vault'):
+    """Write entries in `consul kv export` layout to path"""
+    with open(path, 'w') as backup_file:
+        json.dump(export_elements(entries, prefix), backup_file, indent='\t')
+    return str(path)
+
+
+def varint(value):
+    """Protobuf base 128 varint"""
+    encoded = bytearray()
+    while value > 0x7f:
+        encoded.append(value & 0x7f | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def storage_entry(key, value):
+    """StorageEntry protobuf message, with seal_wrap field the reader should skip"""
+    key = key.encode('utf-8')
+    return b''.join((b'\x0a', varint(len(key)), key, b'\x12', varint(len(value)), value, b'\x18\x01'))
+
+
+def write_raft_snapshot(path, entries):
+    """Write entries as raft snapshot of integrated storage, as `vault operator raft snapshot save` does"""
+    state = b''.join(varint(len(message)) + message
+                     for message in (storage_entry(key, value) for key, value in entries))
+    with tarfile.open(str(path), 'w:gz') as archive:
+        for name, data in (('meta.json', b'{"Index": 1}'), ('state.bin', state), ('SHA256SUMS', b'')):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            archive.addfile(info, io.BytesIO(data))
+    return str(path)
+
+
+BOLT_PAGE_SIZE = 4096
+BOLT_PAGE_HEADER = struct.Struct('<QHHI')
+BOLT_LEAF_ELEMENT = struct.Struct('<IIII')
+BOLT_BRANCH_ELEMENT = struct.Struct('<IIQ')
+BOLT_META = struct.Struct('<IIIIQQQQQ')
+
+
+def bolt_checksum(data):
+    checksum = 0xcbf29ce484222325
+    for byte in data:
+        checksum = ((checksum ^ byte) * 0x100000001b3) & 0xffffffffffffffff
+    return checksum
+
+
+def bolt_leaf_page(page_id, items):
+    """Leaf page of (flags, key, value) items, it spans overflow pages when it doesn't fit one page"""
+    elements = b''
+    data = b''
+    for idx, (flags, key, value) in enumerate(items):
+        # Position of key is relative to its element
+        position = (len(items) - idx) * BOLT_LEAF_ELEMENT.size + len(data)
+        elements += BOLT_LEAF_ELEMENT.pack(flags, position, len(key), len(value))
+        data += key + value
+    overflow = (BOLT_PAGE_HEADER.size + len(elements) + len(data) - 1) // BOLT_PAGE_SIZE
+    return BOLT_PAGE_HEADER.pack(page_id, 0x02, len(items), overflow) + elements + data
+
+
+def bolt_branch_page(page_id, children):
+    """Branch page of (first key, child page id) pairs"""
+    elements = b''
+    data = b''
+    for idx, (key, child) in enumerate(children):
+        position = (len(children) - idx) * BOLT_BRANCH_ELEMENT.size + len(data)
+        elements += BOLT_BRANCH_ELEMENT.pack(position, len(key), child)
+        data += key
+    return BOLT_PAGE_HEADER.pack(page_id, 0x01, len(children), 0) + elements + data
+
+
+def write_boltdb(path, entries, leaf_size=4, inline=False, txids=(1, 2)):
+    """Write entries into data bucket of BoltDB file, as vault.db of integrated storage. Data bucket is
+    a branch page over leaves of leaf_size entries, or inline bucket stored in value of root page with inline.
+    Meta pages 0 and 1 get txids and both point to the same root."""
+    items = [(0, key.encode('utf-8'), value) for key, value in sorted(entries)]
+    pages = []
+
+    def add_page(build, *args):
+        # Pages 0 and 1 are meta pages, 2 is freelist
+        page_id = 3 + sum(len(page) for page in pages) // BOLT_PAGE_SIZE
+        page = build(page_id, *args)
+        pages.append(page + b'\0' * (-len(page) % BOLT_PAGE_SIZE))
+        return page_id
+
+    if inline:
+        data_bucket = struct.pack('<QQ', 0, 0) + bolt_leaf_page(0, items)
+    else:
+        leaves = [items[idx:idx + leaf_size] for idx in range(0, len(items), leaf_size)]
+        children = [(leaf[0][1], add_page(bolt_leaf_page, leaf)) for leaf in leaves]
+        data_bucket = struct.pack('<QQ', add_page(bolt_branch_page, children), 0)
+    config_bucket = struct.pack('<QQ', 0, 0) + bolt_leaf_page(0, [(0, b'latest_config', b'{}')])
+    root = add_page(bolt_leaf_page, [(0x01, b'config', config_bucket), (0x01, b'data', data_bucket)])
+
+    page_count = 3 + sum(len(page) for page in pages) // BOLT_PAGE_SIZE
+    with open(str(path), 'wb') as backup_file:
+        for page_id, txid in enumerate(txids):
+            meta = BOLT_META.pack(0xED0CDAED, 2, BOLT_PAGE_SIZE, 0, root, 0, 2, page_count, txid)
+            page = BOLT_PAGE_HEADER.pack(page_id, 0x04, 0, 0) + meta + struct.pack('<Q', bolt_checksum(meta))
+            backup_file.write(page.ljust(BOLT_PAGE_SIZE, b'\0'))
+        backup_file.write(BOLT_PAGE_HEADER.pack(2, 0x10, 0, 0).ljust(BOLT_PAGE_SIZE, b'\0'))
+        backup_file.write(b''.join(pages))
+    return str(path)
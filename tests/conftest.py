@@ -0,0 +1,52 @@
+import http.server
+import os
+import sys
+import threading
+
+import pytest
+
+
+# Analyzer is a script in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import vault_backup_analyzer  # noqa: E402
+
+
+class PushgatewayHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_PUT(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        self.server.pushed[self.path] = body.decode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_POST = do_PUT
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def pushgateway():
+    """Stub of pushgateway, pushed metrics are kept in `pushed` by path"""
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), PushgatewayHandler)
+    server.pushed = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['numpy', 'fallback'])
+def numpy_mode(request, monkeypatch):
+    """Run test with NumPy and with code paths used when it isn't installed"""
+    optional_module = vault_backup_analyzer.optional_module
+    if 'fallback' == request.param:
+        monkeypatch.setattr(vault_backup_analyzer, 'optional_module',
+                            lambda name: None if 'numpy' == name else optional_module(name))
+    elif optional_module('numpy') is None:
+        pytest.skip('numpy is not installed')
+    return request.param
@@ -0,0 +1,42 @@
+import vault_backup_analyzer
+
+from backups import storage_entries, write_export
+
+
+def pushed_metrics(pushgateway):
+    """Pushed samples without self-metrics, which measure time of the run"""
+    [body] = pushgateway.pushed.values()
+    pushgateway.pushed.clear()
+    return sorted(line for line in body.splitlines() if not line.startswith(('#', 'vba_analyzer_')))
+
+
+def test_async_pushes_the_same_metrics(tmp_path, pushgateway):
+    argv = [write_export(tmp_path / 'backup.json', storage_entries()),
+            '127.0.0.1:{}'.format(pushgateway.server_port), 'env=test', '--offline']
+    vault_backup_analyzer.main(argv)
+    metrics = pushed_metrics(pushgateway)
+    vault_backup_analyzer.main(argv + ['--async'])
+    assert metrics == pushed_metrics(pushgateway)
+    assert 'vba_auth_backend_secret_ids_count{mount_point="approle",type="approle"} 1.0' in metrics
+
+
+def test_async_refetches_stale_mount_tables(tmp_path, pushgateway, monkeypatch):
+    backup = write_export(tmp_path / 'backup.json', storage_entries())
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(backup)
+    fetched = []
+    monkeypatch.setattr(vault_backup_analyzer, 'fetch_mount_tables',
+                        lambda *args: fetched.append(args) or (auth_backs, secrets_engs))
+    # Cache was filled before approle was mounted
+    cache = vault_backup_analyzer.MountTablesCache(str(tmp_path), 3600)
+    cache.store('http://vault:8200', {uuid: auth_back for uuid, auth_back in auth_backs.items()
+                                     if 'approle' != auth_back['type']}, secrets_engs)
+
+    argv = [backup, '127.0.0.1:{}'.format(pushgateway.server_port), 'env=test', 'http://vault:8200',
+            str(tmp_path / 'creds.json'), '--mounts-cache-dir', str(tmp_path)]
+    vault_backup_analyzer.main(argv + ['--async'])
+    assert [('http://vault:8200', str(tmp_path / 'creds.json'))] == fetched
+    assert auth_backs == cache.load('http://vault:8200')[0]
+    metrics = pushed_metrics(pushgateway)
+
+    vault_backup_analyzer.main(argv + ['--offline'])
+    assert pushed_metrics(pushgateway) == metrics
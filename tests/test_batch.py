@@ -0,0 +1,30 @@
+import json
+
+import vault_backup_analyzer
+
+from backups import export_elements, storage_entries, write_export
+
+
+def test_malformed_cluster_does_not_stop_others(tmp_path, pushgateway, capsys):
+    malformed = export_elements(storage_entries())
+    del malformed[5]['key']
+    (tmp_path / 'malformed.json').write_text(json.dumps(malformed))
+    config = {
+        'pushgateway_addr': '127.0.0.1:{}'.format(pushgateway.server_port),
+        'processes': 2,
+        'defaults': {'offline': True},
+        'clusters': [
+            {'backup_file': str(tmp_path / 'malformed.json'), 'labels': 'env=test,cluster=malformed'},
+            {'backup_file': write_export(tmp_path / 'valid.json', storage_entries()),
+             'labels': 'env=test,cluster=valid'},
+        ],
+    }
+    (tmp_path / 'batch.json').write_text(json.dumps(config))
+
+    args = vault_backup_analyzer.parse_args(['--batch', str(tmp_path / 'batch.json')])
+    assert 1 == vault_backup_analyzer.run_batch(args)
+
+    assert 'No key field found' in capsys.readouterr().err
+    [(path, body)] = pushgateway.pushed.items()
+    assert '/cluster/valid/' in path
+    assert 'vba_auth_backend_secret_ids_count{mount_point="approle",type="approle"} 1.0' in body
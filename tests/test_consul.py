@@ -0,0 +1,130 @@
+import base64
+import http.server
+import json
+import threading
+import urllib.parse
+
+import pytest
+
+import vault_backup_analyzer
+
+from backups import storage_entries, write_export
+
+
+class ConsulHandler(http.server.BaseHTTPRequestHandler):
+    """KV API of consul over server.kv, {key with prefix: value}. Keys in server.gone are listed,
+    but respond 404 as if they were deleted after listing."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        key = urllib.parse.unquote(url.path[len('/v1/kv/'):])
+        query = urllib.parse.parse_qs(url.query, keep_blank_values=True)
+        self.server.requests.append((self.client_address, key, url.query))
+        kv = self.server.kv
+        keys = sorted(name for name in kv if name.startswith(key))
+        if key in self.server.gone:
+            keys = []
+        if 'keys' in query:
+            separator = query.get('separator', [''])[0]
+            if separator:
+                # Keys under the next separator are folded into their common prefix
+                keys = sorted({key + ''.join(name[len(key):].partition(separator)[:2]) for name in keys})
+            body = json.dumps(keys) if keys else None
+        elif 'raw' in query:
+            body = kv[key] if key in kv else None
+        else:
+            if 'recurse' not in query:
+                keys = [key] if key in kv else []
+            # Empty values are null in consul responses
+            body = json.dumps([{'LockIndex': 0, 'Key': name, 'Flags': 0, 'CreateIndex': 1, 'ModifyIndex': 1,
+                                'Value': base64.b64encode(kv[name]).decode('ascii') if kv[name] else None}
+                               for name in keys]) if keys else None
+        if body is None:
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        self.server.sent += len(body)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def consul_entries():
+    # Key right under the prefix is read without recurse
+    return storage_entries() + [('lonely', b'single')]
+
+
+@pytest.fixture
+def consul():
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ConsulHandler)
+    server.kv = {'/'.join(('vault', key)): value for key, value in consul_entries()}
+    server.kv['other/key'] = b'not analyzed'
+    server.gone = set()
+    server.requests = []
+    server.sent = 0
+    server.url = 'http://127.0.0.1:{}/vault'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_records_match_export(consul, tmp_path):
+    export = write_export(tmp_path / 'export.json', consul_entries())
+    records = list(vault_backup_analyzer.iter_consul_records(consul.url))
+    assert sorted(vault_backup_analyzer.iter_backup_records(export)) == sorted(records)
+
+    queries = [(key, query) for _, key, query in consul.requests]
+    assert ('vault/', 'keys&separator=/') == queries[0]
+    assert ('vault/lonely', '') in queries
+    assert ('vault/logical/', 'recurse') in queries
+    # Whole tree is read over one connection
+    assert 1 == len({client for client, _, _ in consul.requests})
+
+
+def test_keys_only(consul):
+    records = list(vault_backup_analyzer.iter_consul_records(consul.url, keys_only=True))
+    assert sorted(('vault/' + key, 0) for key, _ in consul_entries()) == sorted(records)
+    assert ('vault/sys/', 'keys') in [(key, query) for _, key, query in consul.requests]
+
+
+def test_missing_keys(consul):
+    consul.gone.add('vault/sys/')
+    records = list(vault_backup_analyzer.iter_consul_records(consul.url))
+    assert not [key for key, _ in records if key.startswith('vault/sys/')]
+    assert len(consul_entries()) - 4 == len(records)
+
+    consul.gone.add('vault/')
+    assert [] == list(vault_backup_analyzer.iter_consul_records(consul.url))
+
+
+def test_find_values(consul):
+    keys = ['core/auth', 'core/local-auth', 'logical/ssss-2/root']
+    values = vault_backup_analyzer.find_consul_values(consul.url, keys)
+    assert {'core/auth': dict(storage_entries())['core/auth'], 'logical/ssss-2/root': b''} == values
+    assert all('raw' == query for _, _, query in consul.requests)
+
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(consul.url)
+    assert {'token', 'approle'} == {mount['name'] for mount in auth_backs.values()}
+    assert {'cubbyhole', 'simple', 'secret'} == {mount['name'] for mount in secrets_engs.values()}
+
+
+def test_no_prefix():
+    with pytest.raises(ValueError, match='No KV prefix'):
+        list(vault_backup_analyzer.iter_consul_records('http://127.0.0.1:8500/'))
+
+
+def test_response_bytes(consul):
+    stats = vault_backup_analyzer.AnalyzerStats()
+    records = list(vault_backup_analyzer.iter_backup_records(consul.url, stats=stats))
+    assert len(consul_entries()) == len(records)
+    assert consul.sent == stats.backup_bytes
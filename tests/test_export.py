@@ -0,0 +1,52 @@
+import base64
+
+import pytest
+
+import vault_backup_analyzer
+
+from backups import storage_entries, write_export
+
+
+pyarrow = pytest.importorskip('pyarrow')
+import pyarrow.ipc  # noqa: E402
+import pyarrow.parquet  # noqa: E402
+
+
+@pytest.mark.parametrize('file_name', ['keys.parquet', 'keys.arrow'])
+def test_export_keys(tmp_path, monkeypatch, file_name):
+    backup = write_export(tmp_path / 'backup.json', storage_entries())
+    classified = []
+    classify = vault_backup_analyzer.PathClassifier.classify
+    classify_batch = vault_backup_analyzer.PathClassifier.classify_batch
+    monkeypatch.setattr(vault_backup_analyzer.PathClassifier, 'classify',
+                        lambda self, key: classified.append(key) or classify(self, key))
+    monkeypatch.setattr(vault_backup_analyzer.PathClassifier, 'classify_batch',
+                        lambda self, keys: classified.extend(keys) or classify_batch(self, keys))
+
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(backup)
+    key_export = vault_backup_analyzer.KeyExport(str(tmp_path / file_name))
+    slots, _ = vault_backup_analyzer.analyze_backup(backup, auth_backs, secrets_engs, key_export=key_export)
+    key_export.close()
+
+    # Keys are classified once, for metrics and export together
+    assert len(storage_entries()) == len(classified)
+    assert dict(zip(slots.keys, slots.counts)) == dict(zip(*slot_counts(backup, auth_backs, secrets_engs)))
+
+    if file_name.endswith('.arrow'):
+        table = pyarrow.ipc.open_file(str(tmp_path / file_name)).read_all()
+    else:
+        table = pyarrow.parquet.read_table(str(tmp_path / file_name))
+    rows = {row['key']: row for row in table.to_pylist()}
+    assert ['vault/' + key for key, _ in storage_entries()] == list(rows)
+    for key, value in storage_entries():
+        assert len(value) == rows['vault/' + key]['size']
+        assert len(base64.b64encode(value)) == rows['vault/' + key]['encoded_size']
+    secret_id = rows['vault/auth/aaaa-2/secret_id/h2/h3']
+    assert ('auth', 'aaaa-2', 'approle', 'approle', 'auth_backend_secret_ids', 5) == (
+        secret_id['branch'], secret_id['mount_uuid'], secret_id['mount_point'], secret_id['type'],
+        secret_id['kind'], secret_id['depth'])
+
+
+def slot_counts(backup, auth_backs, secrets_engs):
+    slots, _ = vault_backup_analyzer.analyze_backup(backup, auth_backs, secrets_engs)
+    return slots.keys, slots.counts
@@ -0,0 +1,451 @@
+import base64
+import gzip
+import io
+import json
+import mmap
+import os
+import time
+
+import pytest
+
+import vault_backup_analyzer
+
+from backups import export_elements, storage_entries, write_export
+
+
+ELEMENTS = [
+    {'Key': 'vault/logical/{braces}/in}key{', 'Flags': 0, 'Value': base64.b64encode(b'a').decode()},
+    {'Key': 'vault/sys/"quoted"/back\\slash', 'Flags': 0, 'Value': None},
+    {'key': 'vault/core/lower', 'flags': 0, 'value': base64.b64encode(b'ab').decode()},
+    {'value': base64.b64encode(b'abc').decode(), 'key': 'vault/value/first', 'flags': 0},
+    {'Flags': 0, 'Key': 'vault/flags/first', 'Value': ''},
+    {'Value': base64.b64encode(b'x' * 100).decode(), 'Flags': 0, 'Key': 'vault/key/last",{"key":"fake'},
+    {'key': 'vault/utf-8/ключ', 'flags': 0, 'value': base64.b64encode(b'abcd').decode()},
+    {'key': 'vault/null/first', 'value': None, 'flags': 0},
+]
+RECORDS = [
+    ('vault/logical/{braces}/in}key{', 1),
+    ('vault/sys/"quoted"/back\\slash', 0),
+    ('vault/core/lower', 2),
+    ('vault/value/first', 3),
+    ('vault/flags/first', 0),
+    ('vault/key/last",{"key":"fake', 100),
+    ('vault/utf-8/ключ', 4),
+    ('vault/null/first', 0),
+]
+LAYOUTS = {
+    'export': {'indent': '\t'},
+    'compact': {'separators': (',', ':')},
+    'ascii': {'indent': 1, 'ensure_ascii': True},
+    'utf-8': {'ensure_ascii': False},
+}
+
+
+def backup_text(layout, elements=ELEMENTS):
+    return json.dumps(elements, **LAYOUTS[layout]) + '\n'
+
+
+def chunked(data, size):
+    return [data[idx:idx + size] for idx in range(0, len(data), size)]
+
+
+@pytest.fixture(params=sorted(LAYOUTS))
+def text(request):
+    return backup_text(request.param)
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_iter_elements(text, chunk_size):
+    elements = vault_backup_analyzer.iter_elements(io.StringIO(text), chunk_size=chunk_size)
+    assert RECORDS == [vault_backup_analyzer.element_record(element) for element in elements]
+
+
+def test_iter_raw_records(text):
+    assert RECORDS == list(vault_backup_analyzer.iter_raw_records(text.encode('utf-8')))
+
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 4096])
+def test_iter_stream_records(text, chunk_size):
+    chunks = chunked(text.encode('utf-8'), chunk_size)
+    assert RECORDS == list(vault_backup_analyzer.iter_stream_records(chunks))
+    keys = [(key, 0) for key, _ in RECORDS]
+    assert keys == list(vault_backup_analyzer.iter_stream_records(chunks, counts_only=True))
+    assert keys == list(vault_backup_analyzer.iter_raw_keys(text.encode('utf-8')))
+
+
+@pytest.mark.parametrize('data', ['', '[]', '[\n]\n', ' [ ] '])
+def test_empty_backup(data, tmp_path):
+    assert [] == list(vault_backup_analyzer.iter_elements(io.StringIO(data), chunk_size=1))
+    assert [] == list(vault_backup_analyzer.iter_raw_records(data.encode()))
+    assert [] == list(vault_backup_analyzer.iter_stream_records(chunked(data.encode(), 1)))
+    assert [] == list(vault_backup_analyzer.iter_stream_records(chunked(data.encode(), 1), counts_only=True))
+    backup = tmp_path / 'backup.json'
+    backup.write_text(data)
+    for use_mmap in (True, False):
+        assert [] == list(vault_backup_analyzer.iter_backup_records(str(backup), use_mmap))
+
+
+def test_element_without_key():
+    text = backup_text('export', ELEMENTS[:2] + [{'Flags': 0, 'Value': None}])
+    with pytest.raises(ValueError, match='No key field found at offset {}'.format(text.rindex('{'))):
+        list(vault_backup_analyzer.iter_raw_records(text.encode('utf-8')))
+    with pytest.raises(ValueError, match='No key field found'):
+        list(vault_backup_analyzer.iter_stream_records(chunked(text.encode('utf-8'), 7)))
+    with pytest.raises(ValueError, match='No key field found in element with fields Flags, Value'):
+        [vault_backup_analyzer.element_record(element)
+         for element in vault_backup_analyzer.iter_elements(io.StringIO(text))]
+
+
+def test_truncated_backup():
+    text = backup_text('export')[:-20]
+    with pytest.raises(ValueError):
+        list(vault_backup_analyzer.iter_raw_records(text.encode('utf-8')))
+    with pytest.raises(ValueError):
+        list(vault_backup_analyzer.iter_elements(io.StringIO(text), chunk_size=7))
+
+
+class CountingReader(io.StringIO):
+    """Text stream which counts chars read from it"""
+    read_chars = 0
+
+    def read(self, size=-1):
+        piece = super().read(size)
+        self.read_chars += len(piece)
+        return piece
+
+
+def large_backup_text(bad_element=None, at=10, count=20000):
+    elements = [json.dumps({'key': 'vault/sys/token/id/{}'.format(idx), 'flags': 0,
+                            'value': base64.b64encode(b'token').decode()}) for idx in range(count)]
+    if bad_element is not None:
+        elements[at] = bad_element
+    return '[\n' + ',\n'.join(elements) + '\n]\n'
+
+
+@pytest.mark.parametrize('chunk_size, element_limit', [(65536, None), (1024, None), (1024, 4096)])
+def test_malformed_element_in_the_middle(chunk_size, element_limit):
+    text = large_backup_text('{"key": "vault/bad", "flags": , "value": null}')
+    reader = CountingReader(text)
+    offset = text.index('"flags": ,') + len('"flags": ')
+    with pytest.raises(ValueError, match='Malformed element at char {}: Expecting value'.format(offset)):
+        list(vault_backup_analyzer.iter_elements(reader, chunk_size, element_limit))
+    # The rest of backup isn't read
+    assert reader.read_chars <= 2 * chunk_size
+
+
+def test_malformed_element_in_text_mode(tmp_path):
+    backup = tmp_path / 'backup.json'
+    backup.write_text(large_backup_text('{"key": "vault/bad" "flags": 0}', at=1000))
+    budget = vault_backup_analyzer.MemoryBudget(1 << 16)
+    for records_budget in (None, budget):
+        with pytest.raises(ValueError, match='Malformed element'):
+            list(vault_backup_analyzer.iter_backup_records(str(backup), use_mmap=False, budget=records_budget))
+
+
+def test_element_over_budget_in_text_mode(tmp_path):
+    backup = tmp_path / 'backup.json'
+    backup.write_text(large_backup_text(json.dumps({'key': 'vault/large', 'flags': 0, 'value': 'A' * 200000})))
+    budget = vault_backup_analyzer.MemoryBudget(1 << 16)
+    with pytest.raises(MemoryError, match='without --no-mmap'):
+        list(vault_backup_analyzer.iter_backup_records(str(backup), use_mmap=False, budget=budget))
+    assert 20000 == len(list(vault_backup_analyzer.iter_backup_records(str(backup), budget=budget)))
+
+
+# Mount tables as convert_hvac_dict returns them, with a mount of every type the rules know,
+# a type without rules, KV without version and auth backend mounted under path of another one
+CLASSIFIER_AUTH_BACKS = {
+    'a-token': {'type': 'token', 'name': 'token'},
+    'a-userpass': {'type': 'userpass', 'name': 'users'},
+    'a-ldap': {'type': 'ldap', 'name': 'ldap'},
+    'a-approle': {'type': 'approle', 'name': 'approle'},
+    'a-nested': {'type': 'approle', 'name': 'approle/team'},
+    'a-github': {'type': 'github', 'name': 'github'},
+}
+CLASSIFIER_SECRETS_ENGS = {
+    's-cubbyhole': {'type': 'cubbyhole', 'name': 'cubbyhole'},
+    's-identity': {'type': 'identity', 'name': 'identity'},
+    's-kv1': {'type': 'kv', 'name': 'simple', 'options': {'version': '1'}},
+    's-kv2': {'type': 'kv', 'name': 'secret', 'options': {'version': '2'}},
+    's-kv': {'type': 'kv', 'name': 'legacy', 'options': None},
+    's-transit': {'type': 'transit', 'name': 'transit'},
+}
+# Keys without consul prefix and metrics the original if/elif rules count them with,
+# keys no rule counts are counted as unknown under their top level storage path
+CLASSIFIED_KEYS = [
+    ('audit/x-1/salt', {('vba_system_objects', ('audit_device',))}),
+    ('core/mounts', {('vba_system_objects', ('core',))}),
+    ('auth/a-userpass/user/bob', {('vba_auth_backend_objects', ('userpass', 'users')),
+                                  ('vba_auth_backend_users', ('userpass', 'users'))}),
+    ('auth/a-userpass/config', {('vba_auth_backend_objects', ('userpass', 'users'))}),
+    ('auth/a-ldap/user/bob', {('vba_auth_backend_objects', ('ldap', 'ldap')),
+                              ('vba_auth_backend_users', ('ldap', 'ldap'))}),
+    ('auth/a-ldap/group/ops', {('vba_auth_backend_objects', ('ldap', 'ldap')),
+                               ('vba_auth_backend_groups', ('ldap', 'ldap'))}),
+    ('auth/a-approle/accessor/h', {('vba_auth_backend_objects', ('approle', 'approle')),
+                                   ('vba_auth_backend_secret_ids_accessors', ('approle', 'approle'))}),
+    ('auth/a-approle/role_id/h', {('vba_auth_backend_objects', ('approle', 'approle')),
+                                  ('vba_auth_backend_role_ids', ('approle', 'approle'))}),
+    ('auth/a-approle/secret_id/h/h', {('vba_auth_backend_objects', ('approle', 'approle')),
+                                      ('vba_auth_backend_secret_ids', ('approle', 'approle'))}),
+    ('auth/a-approle/role/backup', {('vba_auth_backend_objects', ('approle', 'approle')),
+                                    ('vba_auth_backend_roles', ('approle', 'approle'))}),
+    ('auth/a-nested/role/backup', {('vba_auth_backend_objects', ('approle', 'approle/team')),
+                                   ('vba_auth_backend_roles', ('approle', 'approle/team'))}),
+    ('auth/a-github/map/teams/ops', {('vba_auth_backend_objects', ('github', 'github'))}),
+    ('auth/a-unknown/role/backup', {('vba_analyzer_unknown_keys', ('auth',))}),
+    ('logical/s-cubbyhole/h/secret', {('vba_secrets_engine_objects', ('cubbyhole', 'cubbyhole', '')),
+                                      ('vba_secrets_engine_secrets', ('cubbyhole', 'cubbyhole', ''))}),
+    ('logical/s-identity/entity/h', {('vba_secrets_engine_objects', ('identity', 'identity', '')),
+                                     ('vba_secrets_engine_secrets', ('identity', 'identity', ''))}),
+    ('logical/s-kv1/path/to/secret', {('vba_secrets_engine_objects', ('kv', 'simple', '1')),
+                                      ('vba_secrets_engine_secrets', ('kv', 'simple', '1'))}),
+    ('logical/s-kv2/u1', {('vba_secrets_engine_objects', ('kv', 'secret', '1')),
+                          ('vba_secrets_engine_secrets', ('kv', 'secret', '1'))}),
+    ('logical/s-kv2/u1/metadata/h', {('vba_secrets_engine_objects', ('kv', 'secret', '2')),
+                                     ('vba_secrets_engine_secrets', ('kv', 'secret', '2'))}),
+    ('logical/s-kv2/u1/versions/v/h', {('vba_secrets_engine_objects', ('kv', 'secret', '2')),
+                                       ('vba_secrets_engine_secrets_versions', ('kv', 'secret', '2'))}),
+    ('logical/s-kv2/u1/archive/h', {('vba_secrets_engine_objects', ('kv', 'secret', '2')),
+                                    ('vba_secrets_engine_secrets_archives', ('kv', 'secret', '2'))}),
+    ('logical/s-kv2/u1/policy/h', {('vba_secrets_engine_objects', ('kv', 'secret', '2')),
+                                   ('vba_secrets_engine_secrets_policies', ('kv', 'secret', '2'))}),
+    ('logical/s-kv2/u1/salt', {('vba_secrets_engine_objects', ('kv', 'secret', '2'))}),
+    ('logical/s-kv/path/to/secret', {('vba_analyzer_unknown_keys', ('logical',))}),
+    ('logical/s-transit/archive/key', {('vba_secrets_engine_objects', ('transit', 'transit', '')),
+                                       ('vba_secrets_engine_secrets_archives', ('transit', 'transit', '2'))}),
+    ('logical/s-transit/policy/key', {('vba_secrets_engine_objects', ('transit', 'transit', '')),
+                                      ('vba_secrets_engine_secrets_policies', ('transit', 'transit', '2'))}),
+    ('logical/s-transit/config', {('vba_secrets_engine_objects', ('transit', 'transit', ''))}),
+    ('logical/s-unknown/path/to/secret', {('vba_analyzer_unknown_keys', ('logical',))}),
+    ('sys/counters/requests/2020/01', {('vba_system_objects', ('counters',))}),
+    ('sys/policy/default', {('vba_system_objects', ('policies',))}),
+    ('sys/config/ui', {('vba_system_objects', ('config',))}),
+    ('sys/token/accessor/h', {('vba_auth_backend_objects', ('token', 'token')),
+                              ('vba_auth_backend_token_accessors', ('token', 'token'))}),
+    ('sys/token/id/h', {('vba_auth_backend_objects', ('token', 'token')),
+                        ('vba_auth_backend_tokens', ('token', 'token'))}),
+    ('sys/token/salt', {('vba_auth_backend_objects', ('token', 'token'))}),
+    ('sys/expire/id/auth/approle/login/h', {('vba_auth_backend_tokens', ('approle', 'approle'))}),
+    ('sys/expire/id/auth/approle/renew-self/h', {('vba_auth_backend_token_renew_self', ('approle', 'approle'))}),
+    # Mount approle/team shares the first segment with mount approle
+    ('sys/expire/id/auth/approle/team/login/h', {('vba_auth_backend_tokens', ('approle', 'approle/team'))}),
+    ('sys/expire/id/auth/approle/team/renew-self/h', {('vba_auth_backend_token_renew_self',
+                                                       ('approle', 'approle/team'))}),
+    ('sys/expire/id/auth/approle/other/h', {('vba_analyzer_unknown_keys', ('sys',))}),
+    ('sys/expire/id/auth/unknown/login/h', {('vba_analyzer_unknown_keys', ('sys',))}),
+    ('sys/expire/id/pki/issue/h', {('vba_secrets_engine_objects', ('pki', 'expire', '')),
+                                   ('vba_secrets_engine_secrets', ('pki', 'expire', ''))}),
+    ('sys/expire/id/secret/h', {('vba_secrets_engine_objects', ('secret', 'expire', '')),
+                                ('vba_secrets_engine_secrets', ('secret', 'expire', ''))}),
+    ('sys/unknown/h', {('vba_analyzer_unknown_keys', ('sys',))}),
+    ('unknown/h', {('vba_analyzer_unknown_keys', ('other',))}),
+]
+
+
+def rule_paths(rule, path=()):
+    """Paths of segments rules are given for, to the leaves of rule tree"""
+    yield path
+    for segment, child_rule in rule.get('children', {}).items():
+        yield from rule_paths(child_rule, path + (segment,))
+
+
+def test_classified_keys_cover_rules():
+    keys = [key.split('/') for key, _ in CLASSIFIED_KEYS]
+    for path in rule_paths(vault_backup_analyzer.STORAGE_RULES):
+        assert any(tuple(segments[:len(path)]) == path for segments in keys), path
+    auth_types = {auth_back['type'] for auth_back in CLASSIFIER_AUTH_BACKS.values()}
+    assert set(vault_backup_analyzer.AUTH_BACKEND_RULES) - {'*'} < auth_types
+    secrets_kinds = {vault_backup_analyzer.secrets_engine_kind(secrets_eng)
+                     for secrets_eng in CLASSIFIER_SECRETS_ENGS.values()}
+    assert set(vault_backup_analyzer.SECRETS_ENGINE_RULES) < secrets_kinds
+
+
+@pytest.mark.parametrize('key, expected', CLASSIFIED_KEYS, ids=[key for key, _ in CLASSIFIED_KEYS])
+def test_classify(key, expected):
+    slots = vault_backup_analyzer.MetricSlots()
+    classifier = vault_backup_analyzer.PathClassifier(CLASSIFIER_AUTH_BACKS, CLASSIFIER_SECRETS_ENGS, slots)
+    classified = [slots.keys[slot] for slot in classifier.classify('vault/' + key)]
+    branch = key.split('/')[0] if key.split('/')[0] in vault_backup_analyzer.STORAGE_RULES['children'] else 'other'
+    assert [(vault_backup_analyzer.BRANCH_METRIC, (branch,))] == [
+        pair for pair in classified if vault_backup_analyzer.BRANCH_METRIC == pair[0]]
+    assert expected == {pair for pair in classified if vault_backup_analyzer.BRANCH_METRIC != pair[0]}
+    # UUIDs missing in mount tables are reported to refetch them
+    unresolved = {'a-unknown', 's-unknown'} & set(key.split('/'))
+    assert unresolved == classifier.unresolved_mounts
+
+
+def generated_records(count):
+    """Records of every classified key and of keys under the same parents, sizes vary"""
+    keys = [key for key, _ in CLASSIFIED_KEYS]
+    # Keys ending at nodes of the trie, their parents are walked with the next segment in children
+    keys += ['auth', 'logical/s-kv2', 'sys/expire/id/auth/approle', 'sys/expire/id/auth/approle/team']
+    records = [('vault/' + key, len(key)) for key in keys]
+    for idx in range(count - len(records)):
+        key = keys[idx % len(keys)]
+        records.append(('vault/{}-{}'.format(key, idx // len(keys)), idx % 97))
+    return records
+
+
+def slot_totals(slots):
+    return {pair: (slots.counts[slot], slots.sizes[slot]) for slot, pair in enumerate(slots.keys)
+            if slots.counts[slot]}
+
+
+def test_classify_batch_matches_classify(numpy_mode):
+    records = generated_records(vault_backup_analyzer.RECORDS_BATCH + 1000)
+    scalar = vault_backup_analyzer.PathClassifier(CLASSIFIER_AUTH_BACKS, CLASSIFIER_SECRETS_ENGS,
+                                                  vault_backup_analyzer.MetricSlots())
+    for key, size in records:
+        scalar.slots.add(scalar.classify(key), size)
+
+    numpy = vault_backup_analyzer.optional_module('numpy')
+    batched = vault_backup_analyzer.PathClassifier(CLASSIFIER_AUTH_BACKS, CLASSIFIER_SECRETS_ENGS,
+                                                   vault_backup_analyzer.MetricSlots())
+    for start in range(0, len(records), 1000):
+        batch = records[start:start + 1000]
+        codes = vault_backup_analyzer.process_batch(batched, batch, numpy)
+        assert [scalar.classify(key) for key, _ in batch] == [batched.classes[code] for code in codes]
+    assert slot_totals(scalar.slots) == slot_totals(batched.slots)
+    assert scalar.unresolved_mounts == batched.unresolved_mounts
+    assert {'a-unknown', 's-unknown'} < batched.unresolved_mounts
+
+    # The first batch is full, so the rest are classified with NumPy when it is installed
+    processed = vault_backup_analyzer.PathClassifier(CLASSIFIER_AUTH_BACKS, CLASSIFIER_SECRETS_ENGS,
+                                                     vault_backup_analyzer.MetricSlots())
+    vault_backup_analyzer.process_records(iter(records), processed, vault_backup_analyzer.AnalyzerStats())
+    assert slot_totals(scalar.slots) == slot_totals(processed.slots)
+
+
+# 2020-01-02T00:00:00Z
+TIMELINE_NOW = 1577923200
+
+
+def sharded_entries(count=2000):
+    """Entries of every branch with leases issued and expiring around TIMELINE_NOW"""
+    entries = storage_entries()
+    for idx in range(count):
+        entries.append(('logical/ssss-{}/path/{}'.format(idx % 3 + 1, idx), b'v' * (idx % 300)))
+        if 0 == idx % 4:
+            issue_time = TIMELINE_NOW - idx * 97
+            entries.append(('sys/expire/id/auth/approle/login/h{}'.format(idx), json.dumps({
+                'issue_time': '2020-01-01T00:00:00Z' if idx % 8 else vault_time(issue_time),
+                'expire_time': vault_time(issue_time + 3 * 86400)}).encode('utf-8')))
+    return entries
+
+
+def vault_time(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+@pytest.mark.parametrize('shards', [1, 2, 7, 5000])
+def test_find_shard_offsets(tmp_path, shards):
+    backup = write_export(tmp_path / 'backup.json', sharded_entries())
+    offsets = vault_backup_analyzer.find_shard_offsets(backup, shards)
+    # Backup has fewer elements than the most of shards
+    assert 1 <= len(offsets) <= min(shards, len(sharded_entries()))
+    assert 0 == offsets[0][0]
+    assert os.path.getsize(backup) == offsets[-1][1]
+    assert [end for _, end in offsets[:-1]] == [start for start, _ in offsets[1:]]
+
+    for counts_only in (False, True):
+        records = [record for start, end in offsets
+                   for record in vault_backup_analyzer.iter_backup_records(backup, True, start, end, counts_only)]
+        assert list(vault_backup_analyzer.iter_backup_records(backup, counts_only=counts_only)) == records
+
+
+def test_find_shard_offsets_of_empty_backup(tmp_path):
+    backup = tmp_path / 'backup.json'
+    backup.write_text('')
+    assert [] == vault_backup_analyzer.find_shard_offsets(str(backup), 4)
+
+
+@pytest.mark.parametrize('max_memory', [None, 1 << 30])
+def test_sharded_analysis_matches_single_process(tmp_path, max_memory):
+    backup = write_export(tmp_path / 'backup.json', sharded_entries())
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(backup)
+    budget = None if max_memory is None else vault_backup_analyzer.MemoryBudget(max_memory)
+    results = []
+    for workers in (1, 3):
+        timeline = vault_backup_analyzer.LeaseTimeline(TIMELINE_NOW)
+        report = vault_backup_analyzer.StorageReport(5)
+        slots, unresolved_mounts = vault_backup_analyzer.analyze_backup(
+            backup, auth_backs, secrets_engs, workers=workers, report=report, value_sink=timeline, budget=budget)
+        results.append((slot_totals(slots), unresolved_mounts, timeline.expiring, timeline.issued,
+                        sorted(report.largest)))
+    assert results[0] == results[1]
+    # Every lease expires within 7 days, windows are cumulative
+    assert 501 == results[0][2]['auth/approle/login'][-1]
+
+
+def large_entries():
+    """Entries with values longer than reader windows and element limits, padded differently"""
+    entries = sharded_entries(200)
+    for idx in range(3):
+        entries.insert(100 + idx * 50, ('logical/ssss-2/large/{}'.format(idx), b'L' * (50000 + idx)))
+    return entries
+
+
+@pytest.mark.parametrize('counts_only', [False, True])
+@pytest.mark.parametrize('window', [1024, 4096, 1 << 20])
+def test_mapped_windows(tmp_path, counts_only, window):
+    backup = write_export(tmp_path / 'backup.json', large_entries())
+    expected = list(vault_backup_analyzer.iter_backup_records(backup, counts_only=counts_only))
+    with open(backup, 'rb') as backup_file, \
+            mmap.mmap(backup_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+        records = list(vault_backup_analyzer.iter_mapped_windows(mapped, 0, None, counts_only, None, window))
+        assert expected == records
+        # Shards are scanned in windows between their offsets
+        records = [record for start, end in vault_backup_analyzer.find_shard_offsets(backup, 3)
+                   for record in vault_backup_analyzer.iter_mapped_windows(mapped, start, end, counts_only, None,
+                                                                          window)]
+        assert expected == records
+
+        timelines = [vault_backup_analyzer.LeaseTimeline(TIMELINE_NOW) for _ in range(2)]
+        list(vault_backup_analyzer.iter_raw_records(mapped, value_sink=timelines[0]))
+        list(vault_backup_analyzer.iter_mapped_windows(mapped, 0, None, False, timelines[1], window))
+        assert timelines[0].expiring == timelines[1].expiring
+
+
+@pytest.mark.parametrize('chunk_size', [7, 1000, 65536])
+def test_large_element_in_stream(chunk_size):
+    data = json.dumps(export_elements(large_entries()), indent='\t').encode('utf-8')
+    chunks = chunked(data, chunk_size)
+    expected = list(vault_backup_analyzer.iter_stream_records(chunks))
+    assert ('vault/logical/ssss-2/large/2', 50002) in expected
+    assert expected == list(vault_backup_analyzer.iter_stream_records(chunks, element_limit=4096))
+
+
+def test_large_lease_in_stream():
+    # Lease values are decoded, so they can't be measured without being kept
+    lease = ('sys/expire/id/auth/approle/login/large', json.dumps({'padding': 'p' * 50000}).encode('utf-8'))
+    data = json.dumps(export_elements(large_entries() + [lease])).encode('utf-8')
+    timeline = vault_backup_analyzer.LeaseTimeline(TIMELINE_NOW)
+    with pytest.raises(MemoryError, match='Value of vault/sys/expire/id/auth/approle/login/large is needed'):
+        list(vault_backup_analyzer.iter_stream_records(chunked(data, 1000), value_sink=timeline,
+                                                       element_limit=4096))
+
+
+def test_large_element_in_other_layout():
+    elements = export_elements(large_entries())
+    elements[150] = {'value': elements[150]['value'], 'key': elements[150]['key'], 'flags': 0}
+    data = json.dumps(elements).encode('utf-8')
+    assert list(vault_backup_analyzer.iter_stream_records(chunked(data, 1000)))
+    with pytest.raises(MemoryError, match=vault_backup_analyzer.LARGE_ELEMENT_LAYOUT_ERROR):
+        list(vault_backup_analyzer.iter_stream_records(chunked(data, 1000), element_limit=4096))
+
+
+def test_backup_ends_in_large_element():
+    data = json.dumps(export_elements(large_entries())).encode('utf-8')
+    truncated = data[:data.index(b'large/0') + 40000]
+    with pytest.raises(ValueError, match='Backup ends inside of value of vault/logical/ssss-2/large/0'):
+        list(vault_backup_analyzer.iter_stream_records(chunked(truncated, 1000), element_limit=4096))
+
+
+def test_large_element_in_compressed_backup(tmp_path):
+    backup = tmp_path / 'backup.json.gz'
+    backup.write_bytes(gzip.compress(json.dumps(export_elements(large_entries())).encode('utf-8')))
+    export = write_export(tmp_path / 'backup.json', large_entries())
+    budget = vault_backup_analyzer.MemoryBudget(1 << 16)
+    assert budget.element_limit < 50000
+    assert list(vault_backup_analyzer.iter_backup_records(export)) == list(
+        vault_backup_analyzer.iter_backup_records(str(backup), budget=budget))
@@ -0,0 +1,184 @@
+import gzip
+import mmap
+import os
+import tarfile
+
+import pytest
+
+import vault_backup_analyzer
+
+from backups import BOLT_PAGE_SIZE, storage_entries, write_boltdb, write_export, write_raft_snapshot
+
+
+def large_entries():
+    # Value of the last entry spans overflow pages of its BoltDB leaf
+    return storage_entries() + [('logical/ssss-2/path/to/large', bytes(range(256)) * 40)]
+
+
+def slot_totals(backup_file_name):
+    """Count and size per metric slot of backup analyzed with mount tables stored in it"""
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(backup_file_name)
+    slots, unresolved_mounts = vault_backup_analyzer.analyze_backup(backup_file_name, auth_backs, secrets_engs)
+    assert not unresolved_mounts
+    return totals(slots)
+
+
+def totals(slots):
+    return {key: (count, size) for key, count, size in zip(slots.keys, slots.counts, slots.sizes) if count}
+
+
+@pytest.fixture
+def export(tmp_path):
+    return write_export(tmp_path / 'export.json', large_entries())
+
+
+@pytest.fixture(params=['raft', 'boltdb', 'boltdb-branches', 'boltdb-inline'])
+def storage_backup(request, tmp_path):
+    if 'raft' == request.param:
+        return write_raft_snapshot(tmp_path / 'raft.snap', large_entries())
+    if 'boltdb-branches' == request.param:
+        return write_boltdb(tmp_path / 'vault.db', large_entries(), leaf_size=2)
+    if 'boltdb-inline' == request.param:
+        return write_boltdb(tmp_path / 'vault.db', large_entries(), inline=True)
+    return write_boltdb(tmp_path / 'vault.db', large_entries())
+
+
+def test_storage_format(export, tmp_path):
+    assert 'raft' == vault_backup_analyzer.storage_format(write_raft_snapshot(tmp_path / 'raft.snap', []))
+    assert 'boltdb' == vault_backup_analyzer.storage_format(write_boltdb(tmp_path / 'vault.db', []))
+    assert vault_backup_analyzer.storage_format(export) is None
+
+
+def test_storage_records_match_export(storage_backup, export):
+    records = list(vault_backup_analyzer.iter_backup_records(storage_backup))
+    export_records = list(vault_backup_analyzer.iter_backup_records(export))
+    if storage_backup.endswith('.db'):
+        # BoltDB keeps entries in key order
+        export_records.sort()
+    assert export_records == records
+
+
+def test_storage_analysis_matches_export(storage_backup, export):
+    assert slot_totals(export) == slot_totals(storage_backup)
+
+
+def test_raft_snapshot_values(tmp_path):
+    snapshot = write_raft_snapshot(tmp_path / 'raft.snap', large_entries())
+    assert large_entries() == list(vault_backup_analyzer.iter_raft_snapshot(snapshot))
+
+
+def test_boltdb_values(tmp_path):
+    for backup in (write_boltdb(tmp_path / 'vault.db', large_entries(), leaf_size=3),
+                   write_boltdb(tmp_path / 'inline.db', large_entries(), inline=True)):
+        assert sorted(large_entries()) == list(vault_backup_analyzer.iter_boltdb(backup))
+
+
+def test_bolt_page_in_key_order(tmp_path):
+    backup = write_boltdb(tmp_path / 'vault.db', large_entries(), leaf_size=2)
+    with open(backup, 'rb') as backup_file:
+        with mmap.mmap(backup_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            meta = vault_backup_analyzer.read_bolt_meta(mapped)
+            page_size = meta[2]
+            [config, data] = vault_backup_analyzer.iter_bolt_page(mapped, page_size, mapped, meta[4] * page_size)
+            assert (vault_backup_analyzer.BOLT_BUCKET_LEAF, b'config') == config[:2]
+            assert (vault_backup_analyzer.BOLT_BUCKET_LEAF, b'data') == data[:2]
+            buffer, offset = vault_backup_analyzer.bolt_bucket_root(mapped, page_size, mapped, data[2], data[3])
+            elements = list(vault_backup_analyzer.iter_bolt_page(mapped, page_size, buffer, offset))
+    assert sorted(key.encode() for key, _ in large_entries()) == [element[1] for element in elements]
+    assert sorted(len(value) for _, value in large_entries()) == sorted(element[3] for element in elements)
+
+
+def test_bolt_meta_of_last_transaction(tmp_path):
+    backup = write_boltdb(tmp_path / 'vault.db', storage_entries(), txids=(7, 6))
+    with open(backup, 'r+b') as backup_file:
+        with mmap.mmap(backup_file.fileno(), 0) as mapped:
+            assert 7 == vault_backup_analyzer.read_bolt_meta(mapped)[8]
+            # Meta page with broken checksum is skipped
+            offset = vault_backup_analyzer.BOLT_PAGE_HEADER.size + vault_backup_analyzer.BOLT_META.size - 1
+            mapped[offset] ^= 0xff
+            assert 6 == vault_backup_analyzer.read_bolt_meta(mapped)[8]
+            mapped[BOLT_PAGE_SIZE + offset] ^= 0xff
+            with pytest.raises(ValueError, match='No valid meta page'):
+                vault_backup_analyzer.read_bolt_meta(mapped)
+
+
+def test_decode_storage_entry():
+    # Fields of all wire types, unknown ones are skipped
+    message = (b'\x0a\x03a/b' b'\x19' + bytes(8) + b'\x12\x02xy' b'\x25' + bytes(4) + b'\x18\x96\x01'
+               b'\x22\x00')
+    assert ('a/b', b'xy') == vault_backup_analyzer.decode_storage_entry(memoryview(message))
+    assert ('', b'') == vault_backup_analyzer.decode_storage_entry(b'')
+    with pytest.raises(ValueError, match='wire type 3'):
+        vault_backup_analyzer.decode_storage_entry(b'\x0b')
+
+
+def test_key_index_round_trip(tmp_path, numpy_mode):
+    backup = write_export(tmp_path / 'backup.json', storage_entries())
+    index_file = str(tmp_path / 'backup.index')
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(backup)
+    slots, metric_diff, _ = vault_backup_analyzer.analyze_backup_diff(backup, auth_backs, secrets_engs, index_file)
+    assert metric_diff is None
+    assert slot_totals(backup) == totals(slots)
+
+    fingerprint = vault_backup_analyzer.mount_tables_fingerprint(auth_backs, secrets_engs)
+    index = vault_backup_analyzer.KeyIndex.load(index_file, vault_backup_analyzer.MetricSlots(), fingerprint)
+    assert sorted(index.hashes) == list(index.hashes)
+    for key, value in storage_entries():
+        position = index.find(vault_backup_analyzer.KeyIndex.key_hash('vault/' + key))
+        assert len(value) == index.sizes[position]
+    assert vault_backup_analyzer.KeyIndex.load(index_file, vault_backup_analyzer.MetricSlots(), 'other') is None
+
+
+def test_key_index_deltas(tmp_path, numpy_mode):
+    index_file = str(tmp_path / 'backup.index')
+    previous = write_export(tmp_path / 'previous.json', storage_entries())
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(previous)
+    vault_backup_analyzer.analyze_backup_diff(previous, auth_backs, secrets_engs, index_file)
+
+    entries = dict(storage_entries())
+    del entries['auth/aaaa-2/accessor/h4']
+    entries['auth/aaaa-2/secret_id/h2/h5'] = b's' * 10
+    entries['logical/ssss-2/path/to/secret'] = b'v' * 200
+    backup = write_export(tmp_path / 'backup.json', list(entries.items()))
+    slots, metric_diff, _ = vault_backup_analyzer.analyze_backup_diff(backup, auth_backs, secrets_engs, index_file)
+    assert slot_totals(backup) == totals(slots)
+
+    approle = ('approle', 'approle')
+    kv = ('kv', 'simple', '1')
+    assert {('vba_auth_backend_secret_ids', approle): 1} == {
+        slots.keys[slot]: added for slot, added in metric_diff.added.items()
+        if added and slots.keys[slot][0].startswith('vba_auth_backend_secret')}
+    removed = {slots.keys[slot]: count for slot, count in metric_diff.removed.items() if count}
+    assert 1 == removed[('vba_auth_backend_secret_ids_accessors', approle)]
+    size_delta = {slots.keys[slot]: delta for slot, delta in metric_diff.size_delta.items() if delta}
+    assert 10 == size_delta[('vba_auth_backend_secret_ids', approle)]
+    assert -7 == size_delta[('vba_auth_backend_secret_ids_accessors', approle)]
+    assert -100 == size_delta[('vba_secrets_engine_objects', kv)]
+
+
+def read_bytes(backup_file_name, **kwargs):
+    stats = vault_backup_analyzer.AnalyzerStats()
+    auth_backs, secrets_engs = vault_backup_analyzer.read_backup_mount_tables(backup_file_name)
+    vault_backup_analyzer.analyze_backup(backup_file_name, auth_backs, secrets_engs, stats=stats, **kwargs)
+    return stats.backup_bytes
+
+
+def test_backup_bytes(export, tmp_path):
+    size = os.path.getsize(export)
+    assert size == read_bytes(export)
+    assert size == read_bytes(export, use_mmap=False)
+    assert size == read_bytes(export, counts_only=True)
+    assert size == read_bytes(export, budget=vault_backup_analyzer.MemoryBudget(1 << 30))
+    assert size == read_bytes(export, workers=2)
+
+    # Compressed backup is counted by decompressed bytes parsed
+    compressed = tmp_path / 'export.json.gz'
+    with open(export, 'rb') as export_file:
+        compressed.write_bytes(gzip.compress(export_file.read()))
+    assert size == read_bytes(str(compressed))
+
+    snapshot = write_raft_snapshot(tmp_path / 'raft.snap', large_entries())
+    with tarfile.open(snapshot) as archive:
+        assert archive.getmember('state.bin').size == read_bytes(snapshot)
+    boltdb = write_boltdb(tmp_path / 'vault.db', large_entries())
+    assert os.path.getsize(boltdb) == read_bytes(boltdb)
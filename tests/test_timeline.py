@@ -0,0 +1,92 @@
+import gzip
+import json
+import time
+
+import pytest
+
+import vault_backup_analyzer
+
+
+# 2020-01-02T00:00:00Z
+NOW = 1577923200
+HOUR = 3600
+DAY = 86400
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('2020-01-02T00:00:00Z', NOW),
+    ('2020-01-02T00:00:00.123456789Z', NOW),
+    ('2020-01-02T03:00:00+03:00', NOW),
+    ('2020-01-01T18:30:00-05:30', NOW),
+    ('2020-01-02T00:00:00.5+00:00', NOW),
+    ('2019-12-31T23:59:59Z', NOW - DAY - 1),
+    # Zero time.Time of Go is stored for leases without expiry
+    ('0001-01-01T00:00:00Z', None),
+    ('', None),
+    (None, None),
+    ('2020-01-02 00:00:00Z', None),
+    ('2020-01-02T00:00:00', None),
+])
+def test_parse_vault_time(value, expected):
+    assert expected == vault_backup_analyzer.parse_vault_time(value)
+
+
+def vault_time(seconds):
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(seconds))
+
+
+def lease(issue_time, expire_time):
+    return json.dumps({'issue_time': issue_time, 'expire_time': expire_time}).encode('utf-8')
+
+
+def test_timeline_windows():
+    timeline = vault_backup_analyzer.LeaseTimeline(NOW)
+    leases = [
+        # Time left until expiry, windows are cumulative and include their bounds
+        (NOW - DAY, NOW - 1),
+        (NOW - DAY, NOW),
+        (NOW - DAY, NOW + 1),
+        (NOW - DAY, NOW + HOUR),
+        (NOW - DAY, NOW + HOUR + 1),
+        (NOW - DAY, NOW + 7 * DAY),
+        (NOW - DAY, NOW + 7 * DAY + 1),
+        # Time since issue
+        (NOW, NOW + 30 * DAY),
+        (NOW - HOUR, NOW + 30 * DAY),
+        (NOW - HOUR - 1, NOW + 30 * DAY),
+        (NOW - 7 * DAY - 1, NOW + 30 * DAY),
+        (NOW + 1, NOW + 30 * DAY),
+    ]
+    for idx, (issue_time, expire_time) in enumerate(leases):
+        timeline.add('vault/sys/expire/id/auth/approle/login/h{}'.format(idx),
+                     lease(vault_time(issue_time), vault_time(expire_time)))
+    # Leases without expiry and values compressed by vault
+    timeline.add('vault/sys/expire/id/auth/token/create/h', lease('0001-01-01T00:00:00Z', '0001-01-01T00:00:00Z'))
+    timeline.add('vault/sys/expire/id/secret/creds/role/h',
+                 vault_backup_analyzer.VAULT_GZIP_CANARY + gzip.compress(lease(vault_time(NOW), vault_time(NOW))))
+    # Value encrypted by vault barrier
+    timeline.add('vault/sys/expire/id/secret/creds/role/encrypted', b'\x00\x00\x00\x01encrypted')
+
+    # Expired, 1h, 24h, 7d
+    assert {'auth/approle/login': [2, 2, 3, 4], 'secret/creds/role': [1, 0, 0, 0]} == timeline.expiring
+    # 1h, 24h, 7d
+    assert {'auth/approle/login': [2, 10, 10], 'secret/creds/role': [1, 1, 1]} == timeline.issued
+    assert {'secret/creds/role': 1} == timeline.undecoded
+
+    merged = vault_backup_analyzer.LeaseTimeline(NOW).merge(timeline).merge(timeline)
+    assert {'auth/approle/login': [4, 4, 6, 8], 'secret/creds/role': [2, 0, 0, 0]} == merged.expiring
+    assert {'secret/creds/role': 2} == merged.undecoded
+
+
+@pytest.mark.parametrize('lease_prefix, mount_point', [
+    ('auth/approle/login', 'approle'),
+    ('auth/approle/team/login', 'approle/team'),
+    ('auth/userpass/login/bob', 'unknown'),
+    ('secret/creds/role', 'secret'),
+    ('secret', 'secret'),
+    ('approle/login', 'unknown'),
+])
+def test_timeline_mount_point(lease_prefix, mount_point):
+    auth_paths = {'approle': {}, 'approle/team': {}}
+    secrets_paths = {'secret': {}}
+    assert mount_point == vault_backup_analyzer.LeaseTimeline.mount_point(lease_prefix, auth_paths, secrets_paths)
@@ -1,9 +1,348 @@
+import argparse
+import base64
+import bisect
+import calendar
+import contextlib
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
+import http.client
+import importlib
+import io
+import itertools
 import json
+import lzma
+import mmap
+import os
+import queue
+import re
+import resource
 import sys
-import hvac
 import socket
-
-from prometheus_client import CollectorRegistry, Gauge, push_to_gateway
+import struct
+import tarfile
+import threading
+import time
+import urllib.parse
+
+from array import array
+
+
+METRICS_LIST = {
+    'vba_auth_backend_objects_count': {'label_names': ['type', 'mount_point'],
+                                       'description': 'Count auth backend objects'},
+    'vba_auth_backend_objects_size': {'label_names': ['type', 'mount_point'],
+                                      'description': 'Size of auth backend objects'},
+    'vba_auth_backend_roles_count': {'label_names': ['type', 'mount_point'],
+                                     'description': 'Count auth backend roles'},
+    'vba_auth_backend_roles_size': {'label_names': ['type', 'mount_point'],
+                                    'description': 'Size of auth backend role_ids'},
+    'vba_auth_backend_role_ids_count': {'label_names': ['type', 'mount_point'],
+                                        'description': 'Count auth backend role_ids'},
+    'vba_auth_backend_role_ids_size': {'label_names': ['type', 'mount_point'],
+                                       'description': 'Size of auth backend roles'},
+    'vba_auth_backend_secret_ids_count': {'label_names': ['type', 'mount_point'],
+                                          'description': 'Count auth backend secret_ids'},
+    'vba_auth_backend_secret_ids_size': {'label_names': ['type', 'mount_point'],
+                                         'description': 'Size of auth backend secret_ids'},
+    'vba_auth_backend_secret_ids_accessors_count': {'label_names': ['type', 'mount_point'],
+                                                    'description': 'Count auth backend secret_ids_accessors'},
+    'vba_auth_backend_secret_ids_accessors_size': {'label_names': ['type', 'mount_point'],
+                                                   'description': 'Size of auth backend secret_ids_accessors'},
+    'vba_auth_backend_tokens_count': {'label_names': ['type', 'mount_point'],
+                                      'description': 'Count auth backend tokens'},
+    'vba_auth_backend_tokens_size': {'label_names': ['type', 'mount_point'],
+                                     'description': 'Size of auth backend tokens'},
+    'vba_auth_backend_token_renew_self_count': {'label_names': ['type', 'mount_point'],
+                                                 'description': 'Count auth backend tokens renew self'},
+    'vba_auth_backend_token_renew_self_size': {'label_names': ['type', 'mount_point'],
+                                                'description': 'Size of auth backend tokens renew self'},
+    'vba_auth_backend_token_accessors_count': {'label_names': ['type', 'mount_point'],
+                                               'description': 'Count auth backend token accessors'},
+    'vba_auth_backend_token_accessors_size': {'label_names': ['type', 'mount_point'],
+                                              'description': 'Size of auth backend token accessors'},
+    'vba_auth_backend_users_count': {'label_names': ['type', 'mount_point'],
+                                     'description': 'Count auth backend users'},
+    'vba_auth_backend_users_size': {'label_names': ['type', 'mount_point'],
+                                    'description': 'Size of auth backend users'},
+    'vba_auth_backend_groups_count': {'label_names': ['type', 'mount_point'],
+                                      'description': 'Count auth backend groups'},
+    'vba_auth_backend_groups_size': {'label_names': ['type', 'mount_point'],
+                                     'description': 'Size of auth backend groups'},
+    'vba_secrets_engine_objects_count': {'label_names': ['type', 'mount_point', 'version'],
+                                         'description': 'Count secrets engine objects'},
+    'vba_secrets_engine_objects_size': {'label_names': ['type', 'mount_point', 'version'],
+                                        'description': 'Size of secrets engine objects'},
+    'vba_secrets_engine_secrets_count': {'label_names': ['type', 'mount_point', 'version'],
+                                         'description': 'Count secrets engine secrets'},
+    'vba_secrets_engine_secrets_size': {'label_names': ['type', 'mount_point', 'version'],
+                                        'description': 'Size of secrets engine secrets'},
+    'vba_secrets_engine_secrets_archives_count': {'label_names': ['type', 'mount_point', 'version'],
+                                                  'description': 'Count secrets engine secrets archives'},
+    'vba_secrets_engine_secrets_archives_size': {'label_names': ['type', 'mount_point', 'version'],
+                                                 'description': 'Count secrets engine secrets archives'},
+    'vba_secrets_engine_secrets_policies_count': {'label_names': ['type', 'mount_point', 'version'],
+                                                  'description': 'Count secrets engine secrets policies'},
+    'vba_secrets_engine_secrets_policies_size': {'label_names': ['type', 'mount_point', 'version'],
+                                                 'description': 'Count secrets engine secrets policies'},
+    'vba_secrets_engine_secrets_versions_count': {'label_names': ['type', 'mount_point', 'version'],
+                                                  'description': 'Count secrets engine secrets versions'},
+    'vba_secrets_engine_secrets_versions_size': {'label_names': ['type', 'mount_point', 'version'],
+                                                 'description': 'Count secrets engine secrets versions'},
+    'vba_system_objects_count': {'label_names': ['type'], 'description': 'Count system objects'},
+    'vba_system_objects_size': {'label_names': ['type'], 'description': 'Size of system objects'},
+    'vba_analyzer_branch_elements_count': {'label_names': ['branch'],
+                                           'description': 'Count backup elements per top level storage path'},
+    'vba_analyzer_branch_elements_size': {'label_names': ['branch'],
+                                          'description': 'Size of backup elements per top level storage path'},
+    'vba_analyzer_unknown_keys_count': {'label_names': ['branch'],
+                                        'description': 'Count keys not counted by any other metric'},
+    'vba_analyzer_unknown_keys_size': {'label_names': ['branch'],
+                                       'description': 'Size of keys not counted by any other metric'},
+}
+# Self-metrics of analyzer run, pushed with every analysis
+ANALYZER_METRICS_LIST = {
+    'vba_analyzer_phase_seconds': {'label_names': ['phase'],
+                                   'description': 'Seconds spent per analysis phase, summed over worker processes'},
+    'vba_analyzer_backup_bytes': {'label_names': [], 'description': 'Bytes of backup read and parsed'},
+    'vba_analyzer_peak_rss_bytes': {'label_names': [],
+                                    'description': 'Peak RSS of analyzer process or its largest worker process'},
+}
+
+# Heavy hitters and value size distribution, pushed with --top
+REPORT_METRICS_LIST = {
+    'vba_top_prefix_keys_count': {'label_names': ['prefix', 'mount_point'],
+                                  'description': 'Count objects under storage path, top paths only, upper bound'},
+    'vba_top_prefix_keys_size': {'label_names': ['prefix', 'mount_point'],
+                                 'description': 'Size of objects under storage path, top paths only, upper bound'},
+    'vba_top_key_size': {'label_names': ['key', 'mount_point'], 'description': 'Size of the largest objects'},
+    'vba_mount_objects_size_bucket': {'label_names': ['kind', 'type', 'mount_point', 'le'],
+                                      'description': 'Count mount objects not larger than le bytes'},
+}
+# Lease timeline, pushed with --lease-timeline
+LEASE_METRICS_LIST = {
+    'vba_leases_expiring_count': {'label_names': ['mount_point', 'within'],
+                                  'description': 'Count leases expiring within time since backup, '
+                                                 'expired ones are not revoked yet'},
+    'vba_leases_issued_count': {'label_names': ['mount_point', 'within'],
+                                'description': 'Count leases issued within time before backup'},
+    'vba_leases_issued_per_hour': {'label_names': ['mount_point'],
+                                   'description': 'Leases issued per hour during the last day before backup'},
+    'vba_leases_undecoded_count': {'label_names': ['mount_point'],
+                                   'description': 'Count leases encrypted by vault barrier or in unknown format'},
+}
+# Columns of per-key export, written with --export-keys
+EXPORT_COLUMNS = (('key', 'string'), ('branch', 'string'), ('mount_uuid', 'string'), ('mount_point', 'string'),
+                  ('type', 'string'), ('version', 'string'), ('kind', 'string'), ('depth', 'int16'),
+                  ('size', 'int64'), ('encoded_size', 'int64'))
+# Time windows of lease timeline in seconds
+LEASE_WINDOWS = (('1h', 3600), ('24h', 86400), ('7d', 604800))
+# Upper bounds of value size buckets in bytes
+SIZE_BUCKETS = (128, 512, 2048, 8192, 32768, 131072, 524288, 2097152)
+# Space-saving sketches monitor this many times more paths than reported, so reported ones are close to exact
+TOP_SKETCH_FACTOR = 10
+
+# Seconds between checks of watched backup file in exporter mode
+WATCH_PERIOD = 5
+# Keys under these paths (after consul prefix) can't be classified before mount tables are known
+MOUNT_DEPENDENT_PREFIXES = ('auth/', 'logical/', 'sys/token/', 'sys/expire/id/auth/')
+# Records processed between checks if mount tables have arrived
+RECORDS_BATCH = 65536
+# Attempts to push metrics and delay before the first retry in seconds, doubled after every attempt
+PUSH_ATTEMPTS = 5
+PUSH_BACKOFF = 1
+
+# Whitespace and delimiters between elements of the exported array
+ARRAY_DELIMITERS = re.compile(r'[\s,\[]*')
+# Boundary between two elements of the exported array, it can't occur inside of JSON string
+ELEMENT_BOUNDARY = re.compile(r'\}\s*,\s*\{\s*"[A-Za-z]+"\s*:')
+RAW_ARRAY_DELIMITERS = re.compile(rb'[\s,\[]*')
+RAW_ARRAY_END = re.compile(rb'[\s,\[]*(?:\]\s*)?')
+# Element as written by `consul kv export`: key, flags and value fields in this order
+RAW_EXPORT_FIELDS = rb'[\s,\[]*\{\s*"[Kk]ey"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"\s*,\s*"[Ff]lags"\s*:\s*\d+\s*,'
+RAW_EXPORT_ELEMENT = re.compile(RAW_EXPORT_FIELDS + rb'\s*"[Vv]alue"\s*:\s*(?:"([^"]*)"|null)\s*\}')
+# Element in `consul kv export` layout up to the opening quote of its value
+RAW_EXPORT_VALUE_START = re.compile(RAW_EXPORT_FIELDS + rb'\s*"[Vv]alue"\s*:\s*"')
+RAW_ELEMENT_END = re.compile(rb'\s*\}')
+# Any flat JSON object, strings inside it may contain braces and escaped quotes. Chars outside of strings
+# are matched one by one, so truncated element fails without backtracking
+RAW_ELEMENT = re.compile(rb'[\s,\[]*(\{(?:[^{}"]|"[^"\\]*(?:\\.[^"\\]*)*")*\})')
+# Boundary between two elements, next element should start with a field name
+RAW_ELEMENT_BOUNDARY = re.compile(rb'\}\s*,\s*(?=\{\s*"[A-Za-z]+"\s*:)')
+# Key field, values are base64 strings or null, so it can't occur inside of them
+RAW_KEY_FIELD = re.compile(rb'"[Kk]ey"\s*:\s*"([^"\\]*(?:\\.[^"\\]*)*)"')
+RAW_VALUE_FIELD = re.compile(rb'"[Vv]alue"\s*:\s*(?:"([^"]*)"|null)')
+BASE64_PAD = ord('=')
+# Time as encoded by Go, with optional fraction of second
+VAULT_TIME = re.compile(r'(\d{4})-(\d\d)-(\d\d)T(\d\d):(\d\d):(\d\d)(?:\.\d+)?(Z|[+-]\d\d:\d\d)$')
+# Vault prepends canary byte to compressed values, gzip is the default compression
+VAULT_GZIP_CANARY = b'G'
+# Magic bytes of compressed backup formats
+COMPRESSION_MAGIC = (
+    (b'\x1f\x8b', 'gzip'),
+    (b'\xfd7zXZ\x00', 'xz'),
+    (b'\x28\xb5\x2f\xfd', 'zstd'),
+)
+# Size of decompressed chunks and number of chunks decompressor thread may get ahead of parser
+DECOMPRESS_CHUNK = 1 << 20
+DECOMPRESS_QUEUE = 8
+# With --max-memory: share of budget a single buffered element may take, share of budget mmap window may take
+# and the least window size. Keys are shorter than KEY_FIELD_LIMIT.
+ELEMENT_BUDGET_SHARE = 8
+WINDOW_BUDGET_SHARE = 4
+MIN_WINDOW = 1 << 24
+KEY_FIELD_LIMIT = 1 << 16
+# Advice given when element read in text mode is longer than --max-memory budget allows
+TEXT_ELEMENT_LIMIT_ADVICE = 'read backup file in mmap mode (without --no-mmap)'
+CONSUL_ELEMENT_LIMIT_ADVICE = 'save backup with `consul kv export` and read the file in mmap mode'
+LARGE_ELEMENT_LAYOUT_ERROR = 'Element longer than --max-memory budget allows is not in `consul kv export` layout'
+SIZE_SUFFIXES = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+MEGABYTE = 1 << 20
+
+# Integrated storage keys have no consul prefix, classification expects one
+INTEGRATED_STORAGE_PREFIX = 'vault'
+# Member of raft snapshot archive with delimited StorageEntry protobuf messages
+RAFT_SNAPSHOT_STATE = 'state.bin'
+# Bucket with vault storage entries in BoltDB file of integrated storage (vault.db)
+BOLT_DATA_BUCKET = b'data'
+BOLT_MAGIC = 0xED0CDAED
+BOLT_BRANCH_PAGE = 0x01
+BOLT_LEAF_PAGE = 0x02
+BOLT_BUCKET_LEAF = 0x01
+# id, flags, count, overflow
+BOLT_PAGE_HEADER = struct.Struct('<QHHI')
+# magic, version, page size, flags, root bucket (root page, sequence), freelist page, page count, txid, checksum
+BOLT_META = struct.Struct('<IIIIQQQQQQ')
+# position of key relative to element, key size, child page
+BOLT_BRANCH_ELEMENT = struct.Struct('<IIQ')
+# flags, position of key relative to element, key size, value size
+BOLT_LEAF_ELEMENT = struct.Struct('<IIII')
+# root page (0 for inline bucket, its page follows the header), sequence
+BOLT_BUCKET_HEADER = struct.Struct('<QQ')
+
+# Seconds to wait for consul to respond
+CONSUL_TIMEOUT = 60
+
+# Batch config entries give positional arguments by name, the rest are options
+BATCH_ARGUMENTS = ('backup_file', 'pushgateway_addr', 'labels', 'vault_addr', 'vault_creds_file')
+# Clusters are analyzed in processes of batch pool and pushed at once
+BATCH_UNSUPPORTED_OPTIONS = ('batch', 'listen', 'interval', 'async', 'profile', 'workers')
+
+# Mount tables stored in backup, keys are without consul prefix
+MOUNT_TABLE_KEYS = {
+    'core/auth': 'auth',
+    'core/local-auth': 'auth',
+    'core/mounts': 'secrets',
+    'core/local-mounts': 'secrets',
+}
+
+# Classification rules follow storage layout described in vault-storage-structure.yml.
+# Rule fields:
+#   metrics  - (metric family, labels template) pairs counted for key which passes through this segment
+#   terminal - pairs counted only if key ends at this segment
+#   children - rules for exact next segments
+#   any      - rule for any other next segment
+#   each     - same as any, but rule is compiled per distinct segment value, so it can use {segment} label
+#   mounts   - next segment is UUID of auth backend ('auth') or secrets engine ('secrets'),
+#              rule is taken from AUTH_BACKEND_RULES/SECRETS_ENGINE_RULES by mount type
+#   lease_mounts - next segments are mount path of auth backend referenced by lease, rule is taken from `rule` field
+#   mount_type - labels are taken from the first auth backend of this type
+# Labels templates are formatted with mount's type, name and the segment itself.
+AUTH_LABELS = ('{type}', '{name}')
+SECRETS_LABELS = ('{type}', '{name}', '')
+KV1_LABELS = ('{type}', '{name}', '1')
+KV2_LABELS = ('{type}', '{name}', '2')
+
+AUTH_BACKEND_RULES = {
+    'userpass': {'metrics': [('vba_auth_backend_objects', AUTH_LABELS)], 'children': {
+        'user': {'metrics': [('vba_auth_backend_users', AUTH_LABELS)]},
+    }},
+    'ldap': {'metrics': [('vba_auth_backend_objects', AUTH_LABELS)], 'children': {
+        'user': {'metrics': [('vba_auth_backend_users', AUTH_LABELS)]},
+        'group': {'metrics': [('vba_auth_backend_groups', AUTH_LABELS)]},
+    }},
+    'approle': {'metrics': [('vba_auth_backend_objects', AUTH_LABELS)], 'children': {
+        'accessor': {'metrics': [('vba_auth_backend_secret_ids_accessors', AUTH_LABELS)]},
+        'role_id': {'metrics': [('vba_auth_backend_role_ids', AUTH_LABELS)]},
+        'secret_id': {'metrics': [('vba_auth_backend_secret_ids', AUTH_LABELS)]},
+        'role': {'metrics': [('vba_auth_backend_roles', AUTH_LABELS)]},
+    }},
+    # Any other auth backend type
+    '*': {'metrics': [('vba_auth_backend_objects', AUTH_LABELS)]},
+}
+
+SECRETS_ENGINE_RULES = {
+    'cubbyhole': {'metrics': [('vba_secrets_engine_objects', SECRETS_LABELS),
+                              ('vba_secrets_engine_secrets', SECRETS_LABELS)]},
+    'identity': {'metrics': [('vba_secrets_engine_objects', SECRETS_LABELS),
+                             ('vba_secrets_engine_secrets', SECRETS_LABELS)]},
+    'kv-1': {'metrics': [('vba_secrets_engine_objects', KV1_LABELS),
+                         ('vba_secrets_engine_secrets', KV1_LABELS)]},
+    # KVv2 keeps secrets under <UUID>/<kind>/..., keys which are not that deep are counted as KVv1 ones
+    'kv-2': {'terminal': [('vba_secrets_engine_objects', KV1_LABELS), ('vba_secrets_engine_secrets', KV1_LABELS)],
+             'any': {'terminal': [('vba_secrets_engine_objects', KV1_LABELS),
+                                  ('vba_secrets_engine_secrets', KV1_LABELS)],
+                     'any': {'metrics': [('vba_secrets_engine_objects', KV2_LABELS)]},
+                     'children': {
+                         'metadata': {'metrics': [('vba_secrets_engine_objects', KV2_LABELS),
+                                                  ('vba_secrets_engine_secrets', KV2_LABELS)]},
+                         'versions': {'metrics': [('vba_secrets_engine_objects', KV2_LABELS),
+                                                  ('vba_secrets_engine_secrets_versions', KV2_LABELS)]},
+                         'archive': {'metrics': [('vba_secrets_engine_objects', KV2_LABELS),
+                                                 ('vba_secrets_engine_secrets_archives', KV2_LABELS)]},
+                         'policy': {'metrics': [('vba_secrets_engine_objects', KV2_LABELS),
+                                                ('vba_secrets_engine_secrets_policies', KV2_LABELS)]},
+                     }}},
+    'transit': {'metrics': [('vba_secrets_engine_objects', SECRETS_LABELS)], 'children': {
+        'archive': {'metrics': [('vba_secrets_engine_secrets_archives', KV2_LABELS)]},
+        'policy': {'metrics': [('vba_secrets_engine_secrets_policies', KV2_LABELS)]},
+    }},
+}
+
+LEASE_RULE = {'children': {
+    'login': {'metrics': [('vba_auth_backend_tokens', AUTH_LABELS)]},
+    'renew-self': {'metrics': [('vba_auth_backend_token_renew_self', AUTH_LABELS)]},
+}}
+
+# Keys start with consul prefix, rules start from the segment after it
+STORAGE_RULES = {'children': {
+    'audit': {'metrics': [('vba_system_objects', ('audit_device',))]},
+    'core': {'metrics': [('vba_system_objects', ('core',))]},
+    'auth': {'mounts': 'auth'},
+    'logical': {'mounts': 'secrets'},
+    'sys': {'children': {
+        'counters': {'metrics': [('vba_system_objects', ('counters',))]},
+        'policy': {'metrics': [('vba_system_objects', ('policies',))]},
+        'config': {'metrics': [('vba_system_objects', ('config',))]},
+        'token': {'mount_type': 'token', 'metrics': [('vba_auth_backend_objects', AUTH_LABELS)], 'children': {
+            'accessor': {'metrics': [('vba_auth_backend_token_accessors', AUTH_LABELS)]},
+            'id': {'metrics': [('vba_auth_backend_tokens', AUTH_LABELS)]},
+        }},
+        'expire': {'children': {
+            'id': {'children': {'auth': {'lease_mounts': 'auth', 'rule': LEASE_RULE}},
+                   'each': {'metrics': [('vba_secrets_engine_objects', ('{segment}', 'expire', '')),
+                                        ('vba_secrets_engine_secrets', ('{segment}', 'expire', ''))]}},
+        }},
+    }},
+}}
+
+# Self-metrics of classification: every key is counted under its top level storage path ('other' for unknown
+# ones), keys which no other metric counts are counted as unknown too
+BRANCH_METRIC = 'vba_analyzer_branch_elements'
+UNKNOWN_METRIC = 'vba_analyzer_unknown_keys'
+
+
+# hvac, prometheus_client, numpy, pyarrow, zstandard, asyncio and process pool are imported by code paths using them,
+# so short runs don't pay for imports of modes they don't use
+@functools.lru_cache(maxsize=None)
+def optional_module(name):
+    """Optional dependency imported on first use, None if it isn't installed"""
+    try:
+        return importlib.import_module(name)
+    except ImportError:
+        return None
 
 
 class Metrics:
@@ -15,327 +354,1842 @@ class Metrics:
         self.metrics = {}
 
     def create_metric(self, metric_name, description, labelnames):
+        from prometheus_client import Gauge
         if metric_name not in self.metrics:
             self.metrics[metric_name] = Gauge(metric_name, description, labelnames=labelnames, registry=self.registry)
 
     def inc(self, metric_name, metric_labels, metric_value=1):
-        self.metrics[metric_name].labels(*metric_labels).inc(metric_value)
-
-    def push_metrics(self):
+        metric = self.metrics[metric_name]
+        if metric_labels:
+            metric = metric.labels(*metric_labels)
+        metric.inc(metric_value)
+
+    def push_metrics(self, handler=None):
+        from prometheus_client import push_to_gateway
+        from prometheus_client.exposition import default_handler
         push_to_gateway(self.pushgateway_addr, job='vault_backup_analyzer',
-                        grouping_key=self.grouping_key, registry=self.registry)
+                        grouping_key=self.grouping_key, registry=self.registry, handler=handler or default_handler)
+
+
+class PushgatewaySession:
+    """Handler of push_to_gateway keeping one connection per pushgateway, so metrics of many grouping keys
+    are pushed without connecting again for every one"""
+    def __init__(self):
+        self.connections = {}
+
+    def close(self):
+        for connection in self.connections.values():
+            connection.close()
+
+    def connection(self, url):
+        if url.netloc not in self.connections:
+            connection_class = http.client.HTTPSConnection if 'https' == url.scheme else http.client.HTTPConnection
+            self.connections[url.netloc] = connection_class(url.netloc)
+        return self.connections[url.netloc]
+
+    def request(self, url, method, timeout, headers, data):
+        url = urllib.parse.urlsplit(url)
+        path = '?'.join((url.path, url.query)) if url.query else url.path
+        for attempt in range(2):
+            connection = self.connection(url)
+            connection.timeout = timeout
+            try:
+                connection.request(method, path, body=data, headers=dict(headers))
+                response = connection.getresponse()
+                response.read()
+                break
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                # Pushgateway closed idle connection, it is opened again once
+                connection.close()
+                if attempt:
+                    raise
+        if response.status >= 400:
+            raise IOError('error talking to pushgateway: {} {}'.format(response.status, response.reason))
+
+    def handler(self, url, method, timeout, headers, data):
+        return functools.partial(self.request, url, method, timeout, headers, data)
+
+
+class SnapshotCollector:
+    """Collector serving metrics of the last finished analysis with constant labels added.
+    Snapshot registry is replaced as a whole, so scrapes never block on analysis and never see
+    partially built registry."""
+    def __init__(self, const_labels):
+        self.const_labels = const_labels
+        self.registry = None
+
+    def swap(self, registry):
+        self.registry = registry
+
+    def collect(self):
+        registry = self.registry
+        if registry is None:
+            return
+        for metric in registry.collect():
+            metric.samples = [sample._replace(labels=dict(self.const_labels, **sample.labels))
+                              for sample in metric.samples]
+            yield metric
+
+
+def diff_metrics_list(metrics_list=None):
+    """Metrics of changes since previous backup, derived from metrics_list:
+    <name>_added_count and <name>_removed_count from <name>_count, <name>_size_delta from <name>_size"""
+    if metrics_list is None:
+        metrics_list = METRICS_LIST
+    diff_list = {}
+    for metric, params in metrics_list.items():
+        if metric.endswith('_count'):
+            diff_list[metric[:-len('count')] + 'added_count'] = {
+                'label_names': params['label_names'],
+                'description': params['description'] + ' added since previous backup'}
+            diff_list[metric[:-len('count')] + 'removed_count'] = {
+                'label_names': params['label_names'],
+                'description': params['description'] + ' removed since previous backup'}
+        elif metric.endswith('_size'):
+            diff_list[metric + '_delta'] = {
+                'label_names': params['label_names'],
+                'description': params['description'] + ' change since previous backup'}
+    return diff_list
+
+
+def count_metrics_list(metrics_list=None):
+    """Only <name>_count metrics of metrics_list, for analysis without values"""
+    if metrics_list is None:
+        metrics_list = METRICS_LIST
+    return {metric: params for metric, params in metrics_list.items() if metric.endswith('_count')}
+
+
+def create_metrics(metrics_pool, metrics_list=None):
+    if metrics_list is None:
+        metrics_list = METRICS_LIST
+    for metric in metrics_list.keys():
+        metrics_pool.create_metric(metric_name=metric, description=metrics_list[metric]['description'],
+                                   labelnames=metrics_list[metric]['label_names'])
+    return metrics_pool
 
 
-def read_in_chunks(file_object, chunk_size=1024):
-    """Lazy function (generator) to read a file piece by piece.
-    Default chunk size: 1k."""
+class MetricSlots:
+    """Counters of (metric family, labels) pairs. Every pair is resolved to integer slot once,
+    so hot loop only adds to plain lists and values reach Metrics once in flush().
+    Slots are picklable, so they can be collected from worker processes and merged."""
+    def __init__(self):
+        self.index = {}
+        self.keys = []
+        self.counts = []
+        self.sizes = []
+
+    def slot(self, m_name, m_labels):
+        key = (m_name, tuple(m_labels))
+        if key not in self.index:
+            self.index[key] = len(self.keys)
+            self.keys.append(key)
+            self.counts.append(0)
+            self.sizes.append(0)
+        return self.index[key]
+
+    def add(self, slots, size):
+        counts = self.counts
+        sizes = self.sizes
+        for slot in slots:
+            counts[slot] += 1
+            sizes[slot] += size
+
+    def add_batch(self, classes, codes, sizes):
+        """Add batch of keys classified into classes[code], counts and sizes are summed per code with NumPy"""
+        numpy = optional_module('numpy')
+        codes = numpy.array(codes, dtype=numpy.intp)
+        counts = numpy.bincount(codes, minlength=len(classes))
+        # Sums of float64 are exact below 2**53 bytes per batch
+        totals = numpy.bincount(codes, weights=numpy.array(sizes, dtype=numpy.float64), minlength=len(classes))
+        for code in numpy.flatnonzero(counts).tolist():
+            count = int(counts[code])
+            size = int(totals[code])
+            for slot in classes[code]:
+                self.counts[slot] += count
+                self.sizes[slot] += size
+
+    def merge(self, other):
+        # Slots of the same pair may differ between processes, so they are matched by pair
+        for idx, (m_name, m_labels) in enumerate(other.keys):
+            slot = self.slot(m_name, m_labels)
+            self.counts[slot] += other.counts[idx]
+            self.sizes[slot] += other.sizes[idx]
+        return self
+
+    def flush(self, metrics_pool):
+        for idx, (m_name, m_labels) in enumerate(self.keys):
+            if self.counts[idx]:
+                metrics_pool = update_metrics(metrics_pool, m_name, m_labels, self.counts[idx], self.sizes[idx])
+        return metrics_pool
+
+
+class MetricDiff:
+    """Keys added and removed since previous backup and change of their values size, per metric slot"""
+    def __init__(self, slots):
+        self.slots = slots
+        self.added = {}
+        self.removed = {}
+        self.size_delta = {}
+
+    def add(self, slots, added=0, removed=0, size_delta=0):
+        for slot in slots:
+            self.added[slot] = self.added.get(slot, 0) + added
+            self.removed[slot] = self.removed.get(slot, 0) + removed
+            self.size_delta[slot] = self.size_delta.get(slot, 0) + size_delta
+
+    def flush(self, metrics_pool):
+        for slot in self.added:
+            m_name, m_labels = self.slots.keys[slot]
+            metrics_pool.inc('_'.join([m_name, 'added', 'count']), m_labels, self.added[slot])
+            metrics_pool.inc('_'.join([m_name, 'removed', 'count']), m_labels, self.removed[slot])
+            metrics_pool.inc('_'.join([m_name, 'size', 'delta']), m_labels, self.size_delta[slot])
+        return metrics_pool
+
+
+class SpaceSaving:
+    """Space-saving sketch of the heaviest items of a stream in `capacity` counters. When all counters are taken,
+    the lightest item is evicted and the new one inherits its weight, so weights are upper bounds overestimated
+    at most by inherited weight. Heap is updated lazily: entries may lag behind weights, never exceed them."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.weights = {}
+        self.heap = []
+
+    def add(self, item, weight=1):
+        weights = self.weights
+        if item in weights:
+            weights[item] += weight
+            return
+        if not weight:
+            return
+        if len(weights) >= self.capacity:
+            weight += self.evict()
+        weights[item] = weight
+        heapq.heappush(self.heap, (weight, item))
+
+    def evict(self):
+        weights = self.weights
+        heap = self.heap
+        while True:
+            weight, item = heap[0]
+            if weights[item] == weight:
+                heapq.heappop(heap)
+                del weights[item]
+                return weight
+            heapq.heapreplace(heap, (weights[item], item))
+
+    def merge(self, other):
+        for item, weight in other.weights.items():
+            self.add(item, weight)
+        return self
+
+    def top(self, count):
+        return heapq.nlargest(count, self.weights.items(), key=lambda pair: pair[1])
+
+
+class StorageReport:
+    """Heavy hitters and value size distribution collected during scan in bounded memory: storage paths
+    (parent of a key, e.g. kv directory, approle role or lease prefix) with the most objects and the largest size,
+    the largest objects and histograms of object sizes per mount."""
+    metrics_list = REPORT_METRICS_LIST
+
+    def __init__(self, top):
+        self.top = top
+        self.prefix_counts = SpaceSaving(top * TOP_SKETCH_FACTOR)
+        self.prefix_sizes = SpaceSaving(top * TOP_SKETCH_FACTOR)
+        # Min-heap of (size, key), the smallest of the largest objects is replaced
+        self.largest = []
+        # (auth or logical, mount UUID): per bucket counts, the last one is +Inf
+        self.histograms = {}
+
+    def add(self, key, size):
+        path = key.partition('/')[2]
+        prefix = path.rpartition('/')[0]
+        self.prefix_counts.add(prefix)
+        self.prefix_sizes.add(prefix, size)
+
+        if len(self.largest) < self.top:
+            heapq.heappush(self.largest, (size, path))
+        elif size > self.largest[0][0]:
+            heapq.heapreplace(self.largest, (size, path))
+
+        kind, _, rest = path.partition('/')
+        if 'auth' == kind or 'logical' == kind:
+            mount = (kind, rest.partition('/')[0])
+            if mount not in self.histograms:
+                self.histograms[mount] = [0] * (len(SIZE_BUCKETS) + 1)
+            self.histograms[mount][bisect.bisect_left(SIZE_BUCKETS, size)] += 1
+
+    def merge(self, other):
+        self.prefix_counts.merge(other.prefix_counts)
+        self.prefix_sizes.merge(other.prefix_sizes)
+        for size, path in other.largest:
+            if len(self.largest) < self.top:
+                heapq.heappush(self.largest, (size, path))
+            elif size > self.largest[0][0]:
+                heapq.heapreplace(self.largest, (size, path))
+        for mount, buckets in other.histograms.items():
+            if mount not in self.histograms:
+                self.histograms[mount] = [0] * (len(SIZE_BUCKETS) + 1)
+            self.histograms[mount] = [ours + theirs for ours, theirs in zip(self.histograms[mount], buckets)]
+        return self
+
+    @staticmethod
+    def mount(path, auth_backs, secrets_engs):
+        """Type and name of mount the storage path belongs to, UUID is used as name of unknown mount"""
+        kind, _, rest = path.partition('/')
+        uuid = rest.partition('/')[0]
+        table = auth_backs if 'auth' == kind else secrets_engs if 'logical' == kind else None
+        if table is None or not uuid:
+            return '', ''
+        mount = table.get(uuid)
+        if mount is None:
+            return 'unknown', uuid
+        return mount['type'], mount['name']
+
+    def flush(self, metrics_pool, auth_backs, secrets_engs):
+        for prefix, count in self.prefix_counts.top(self.top):
+            mount_point = self.mount(prefix, auth_backs, secrets_engs)[1]
+            metrics_pool.inc('vba_top_prefix_keys_count', [prefix, mount_point], count)
+        for prefix, size in self.prefix_sizes.top(self.top):
+            mount_point = self.mount(prefix, auth_backs, secrets_engs)[1]
+            metrics_pool.inc('vba_top_prefix_keys_size', [prefix, mount_point], size)
+        for size, path in self.largest:
+            metrics_pool.inc('vba_top_key_size', [path, self.mount(path, auth_backs, secrets_engs)[1]], size)
+        for (kind, uuid), buckets in self.histograms.items():
+            m_type, mount_point = self.mount('/'.join((kind, uuid)), auth_backs, secrets_engs)
+            kind = 'auth' if 'auth' == kind else 'secrets'
+            cumulative = 0
+            for bound, count in zip(SIZE_BUCKETS + ('+Inf',), buckets):
+                cumulative += count
+                metrics_pool.inc('vba_mount_objects_size_bucket', [kind, m_type, mount_point, str(bound)], cumulative)
+        return metrics_pool
+
+
+class LeaseTimeline:
+    """Leases bucketed by time left until expiry and by time since issue, relative to backup time. Counts are
+    aggregated per lease prefix (lease path without ID, e.g. auth/approle/login) while scanning, leases themselves
+    aren't kept. Values are read by backup readers as value sink, only leases of decrypted backup can be decoded."""
+    metrics_list = LEASE_METRICS_LIST
+    prefix = 'sys/expire/id/'
+
+    def __init__(self, now):
+        self.now = now
+        # Lease prefix: counts of expired and expiring within LEASE_WINDOWS
+        self.expiring = {}
+        # Lease prefix: counts of issued within LEASE_WINDOWS
+        self.issued = {}
+        self.undecoded = {}
+
+    def add(self, key, value):
+        lease_prefix = key.partition('/')[2][len(self.prefix):].rpartition('/')[0]
+        try:
+            lease = decode_storage_value(value)
+        except ValueError:
+            self.undecoded[lease_prefix] = self.undecoded.get(lease_prefix, 0) + 1
+            return
+
+        expire_time = parse_vault_time(lease.get('expire_time'))
+        if expire_time is not None:
+            if lease_prefix not in self.expiring:
+                self.expiring[lease_prefix] = [0] * (len(LEASE_WINDOWS) + 1)
+            counts = self.expiring[lease_prefix]
+            left = expire_time - self.now
+            if left <= 0:
+                counts[0] += 1
+            for idx, (_, window) in enumerate(LEASE_WINDOWS, 1):
+                if 0 < left <= window:
+                    counts[idx] += 1
+
+        issue_time = parse_vault_time(lease.get('issue_time'))
+        if issue_time is not None:
+            if lease_prefix not in self.issued:
+                self.issued[lease_prefix] = [0] * len(LEASE_WINDOWS)
+            counts = self.issued[lease_prefix]
+            age = self.now - issue_time
+            for idx, (_, window) in enumerate(LEASE_WINDOWS):
+                if 0 <= age <= window:
+                    counts[idx] += 1
+
+    def merge(self, other):
+        for ours, theirs in ((self.expiring, other.expiring), (self.issued, other.issued)):
+            for lease_prefix, counts in theirs.items():
+                if lease_prefix in ours:
+                    ours[lease_prefix] = [left + right for left, right in zip(ours[lease_prefix], counts)]
+                else:
+                    ours[lease_prefix] = counts
+        for lease_prefix, count in other.undecoded.items():
+            self.undecoded[lease_prefix] = self.undecoded.get(lease_prefix, 0) + count
+        return self
+
+    @staticmethod
+    def mount_point(lease_prefix, auth_paths, secrets_paths):
+        """Mount of lease prefix by the longest matching mount path, auth mounts are prefixed with auth/"""
+        segments = lease_prefix.split('/')
+        paths = secrets_paths
+        if 'auth' == segments[0]:
+            segments = segments[1:]
+            paths = auth_paths
+        for end in range(len(segments), 0, -1):
+            if '/'.join(segments[:end]) in paths:
+                return '/'.join(segments[:end])
+        return 'unknown'
+
+    def flush(self, metrics_pool, auth_backs, secrets_engs):
+        auth_paths = MountTable(auth_backs).by_path
+        secrets_paths = MountTable(secrets_engs).by_path
+        if self.undecoded:
+            print('{} leases can not be decoded, timeline is available only for decrypted backup'.format(
+                sum(self.undecoded.values())), file=sys.stderr)
+
+        for lease_prefix, counts in self.expiring.items():
+            mount_point = self.mount_point(lease_prefix, auth_paths, secrets_paths)
+            metrics_pool.inc('vba_leases_expiring_count', [mount_point, 'expired'], counts[0])
+            for (within, _), count in zip(LEASE_WINDOWS, counts[1:]):
+                metrics_pool.inc('vba_leases_expiring_count', [mount_point, within], count)
+        for lease_prefix, counts in self.issued.items():
+            mount_point = self.mount_point(lease_prefix, auth_paths, secrets_paths)
+            for (within, window), count in zip(LEASE_WINDOWS, counts):
+                metrics_pool.inc('vba_leases_issued_count', [mount_point, within], count)
+                if 86400 == window:
+                    metrics_pool.inc('vba_leases_issued_per_hour', [mount_point], count / 24)
+        for lease_prefix, count in self.undecoded.items():
+            mount_point = self.mount_point(lease_prefix, auth_paths, secrets_paths)
+            metrics_pool.inc('vba_leases_undecoded_count', [mount_point], count)
+        return metrics_pool
+
+
+class KeyExport:
+    """One row per key written to Parquet file (Arrow IPC file for .arrow and .feather) batch by batch,
+    so memory is bounded by batch size. Kind, type, mount point and version of a key are taken from the most
+    specific metric it is counted by, they are resolved once per classification."""
+    def __init__(self, export_file_name):
+        if optional_module('pyarrow') is None:
+            raise ValueError('pyarrow package is required to export keys')
+        import pyarrow.ipc
+        import pyarrow.parquet
+        self.schema = pyarrow.schema([(name, getattr(pyarrow, column_type)()) for name, column_type in EXPORT_COLUMNS])
+        if export_file_name.endswith(('.arrow', '.feather')):
+            self.writer = pyarrow.ipc.new_file(export_file_name, self.schema)
+        else:
+            self.writer = pyarrow.parquet.ParquetWriter(export_file_name, self.schema)
+        self.descriptions = {}
+
+    def close(self):
+        self.writer.close()
+
+    def describe(self, slots, metric_slots):
+        """Branch, kind, type, mount point and version of keys classified with slots"""
+        description = self.descriptions.get(slots)
+        if description is None:
+            branch = kind = None
+            labels = ()
+            for m_name, m_labels in (metric_slots.keys[slot] for slot in slots):
+                if BRANCH_METRIC == m_name:
+                    branch = m_labels[0]
+                elif UNKNOWN_METRIC == m_name:
+                    kind = 'unknown'
+                else:
+                    # Slots of deeper segments come later
+                    kind, labels = m_name[len('vba_'):], m_labels
+            labels = [label or None for label in labels] + [None] * (3 - len(labels))
+            description = (branch, kind) + tuple(labels[:3])
+            self.descriptions[slots] = description
+        return description
+
+    def write(self, records, codes, classifier):
+        """Write batch of records, codes are their classifications by classifier.classify_batch"""
+        import pyarrow
+        columns = [[] for _ in EXPORT_COLUMNS]
+        keys, branches, uuids, mount_points, types, versions, kinds, depths, sizes, encoded_sizes = columns
+        for (key, size), code in zip(records, codes):
+            segments = key.split('/')
+            branch, kind, m_type, mount_point, version = self.describe(classifier.classes[code], classifier.slots)
+            keys.append(key)
+            branches.append(branch)
+            uuids.append(segments[2] if branch in ('auth', 'logical') and len(segments) > 2 else None)
+            mount_points.append(mount_point)
+            types.append(m_type)
+            versions.append(version)
+            kinds.append(kind)
+            depths.append(len(segments) - 1)
+            sizes.append(size)
+            # Length of base64 encoded value, as it is stored in consul export
+            encoded_sizes.append((size + 2) // 3 * 4)
+        self.writer.write_table(pyarrow.Table.from_arrays(
+            [pyarrow.array(column, type=field.type) for column, field in zip(columns, self.schema)],
+            schema=self.schema))
+
+
+def peak_rss():
+    """Peak RSS of this process or its largest finished child process in bytes"""
+    usage = max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+    # Linux reports kilobytes, macOS bytes
+    return usage if 'darwin' == sys.platform else usage * 1024
+
+
+def current_rss():
+    """Current RSS of this process in bytes, peak one where /proc isn't available"""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * mmap.PAGESIZE
+    except OSError:
+        return peak_rss()
+
+
+def parse_size(size):
+    """Size in bytes from number with optional K, M or G suffix (powers of 1024)"""
+    number = size.strip().upper().rstrip('B')
+    multiplier = 1
+    if number and number[-1] in SIZE_SUFFIXES:
+        multiplier = SIZE_SUFFIXES[number[-1]]
+        number = number[:-1]
+    try:
+        return int(float(number) * multiplier)
+    except ValueError:
+        raise argparse.ArgumentTypeError('invalid size: {}'.format(size))
+
+
+class MemoryBudget:
+    """Memory limit of analysis (--max-memory). Readers keep at most element_limit bytes of a single element:
+    larger values are measured while being read instead of being buffered, where it isn't possible reading fails.
+    Mapped backup is scanned in windows and pages of scanned windows are released. RSS is checked once
+    per batch of records, analysis fails fast with MemoryError once the limit is exceeded."""
+    def __init__(self, limit):
+        self.limit = limit
+        self.element_limit = limit // ELEMENT_BUDGET_SHARE
+        self.window = max(limit // WINDOW_BUDGET_SHARE, MIN_WINDOW)
+
+    def exceeded(self):
+        return current_rss() > self.limit
+
+    def check(self, what):
+        rss = current_rss()
+        if rss > self.limit:
+            raise MemoryError('{} exceeds --max-memory: RSS is {:.1f} MB of {:.1f} MB allowed'.format(
+                what, rss / MEGABYTE, self.limit / MEGABYTE))
+
+    def share(self, parts):
+        """Budget of one of parts processes sharing this one"""
+        return MemoryBudget(self.limit // parts)
+
+
+class AnalyzerStats:
+    """Time spent per phase of analysis: fetching mount tables, reading and parsing backup, classification,
+    flushing metrics and pushing them. Reading and classification are timed per batch of records,
+    so timers cost nothing per element. Picklable, so stats of worker processes are merged."""
+    metrics_list = ANALYZER_METRICS_LIST
+
+    def __init__(self):
+        self.phases = {}
+        self.backup_bytes = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.perf_counter() - started
+
+    def timed(self, name, function, *args):
+        with self.phase(name):
+            return function(*args)
+
+    def merge(self, other):
+        for name, seconds in other.phases.items():
+            self.phases[name] = self.phases.get(name, 0) + seconds
+        self.backup_bytes += other.backup_bytes
+        return self
+
+    def summary(self):
+        lines = ['{:<14} {:>9.3f}s'.format(name, seconds) for name, seconds in self.phases.items()]
+        lines.append('{:<14} {:>9.1f}MB'.format('peak RSS', peak_rss() / 1e6))
+        return '\n'.join(lines)
+
+    def flush(self, metrics_pool, auth_backs, secrets_engs):
+        for name, seconds in self.phases.items():
+            metrics_pool.inc('vba_analyzer_phase_seconds', [name], seconds)
+        metrics_pool.inc('vba_analyzer_backup_bytes', [], self.backup_bytes)
+        metrics_pool.inc('vba_analyzer_peak_rss_bytes', [], peak_rss())
+        return metrics_pool
+
+
+class KeyIndex:
+    """Index of analyzed backup: 64-bit key hash -> (classification, value size), hashes are kept sorted
+    for binary search. Classification is id of a metric slots tuple, slots are stored as (metric family, labels)
+    pairs, so index can be loaded with any slot numbering. Count and size of keys are kept per classification."""
+    VERSION = 2
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.classes = []
+        self.class_ids = {}
+        self.class_counts = []
+        self.class_sizes = []
+        self.hashes = array('Q')
+        self.class_refs = array('I')
+        self.sizes = array('Q')
+
+    @staticmethod
+    def key_hash(key):
+        return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'little')
+
+    def class_id(self, slots):
+        class_id = self.class_ids.get(slots)
+        if class_id is None:
+            class_id = len(self.classes)
+            self.class_ids[slots] = class_id
+            self.classes.append(slots)
+            self.class_counts.append(0)
+            self.class_sizes.append(0)
+        return class_id
+
+    def append(self, key_hash, class_id, size):
+        self.hashes.append(key_hash)
+        self.class_refs.append(class_id)
+        self.sizes.append(size)
+        self.class_counts[class_id] += 1
+        self.class_sizes[class_id] += size
+
+    def find(self, key_hash):
+        position = bisect.bisect_left(self.hashes, key_hash)
+        if position < len(self.hashes) and self.hashes[position] == key_hash:
+            return position
+        return -1
+
+    def add_to(self, metric_slots):
+        for class_id, slots in enumerate(self.classes):
+            for slot in slots:
+                metric_slots.counts[slot] += self.class_counts[class_id]
+                metric_slots.sizes[slot] += self.class_sizes[class_id]
+        return metric_slots
+
+    def sorted_arrays(self):
+        """Hashes, classification refs and sizes reordered by hash. With NumPy packed arrays are reordered by
+        argsort of hashes, without it a list of ints with position packed into the low bits of hash is sorted."""
+        numpy = optional_module('numpy')
+        if numpy is None:
+            order = [packed & 0xffffffff for packed in sorted(key_hash << 32 | position
+                                                              for position, key_hash in enumerate(self.hashes))]
+            return (array('Q', (self.hashes[position] for position in order)),
+                    array('I', (self.class_refs[position] for position in order)),
+                    array('Q', (self.sizes[position] for position in order)))
+        order = numpy.argsort(numpy.frombuffer(self.hashes, dtype=numpy.uint64), kind='stable')
+        reordered = []
+        for values in (self.hashes, self.class_refs, self.sizes):
+            values_sorted = array(values.typecode)
+            values_sorted.frombytes(memoryview(numpy.frombuffer(values, dtype=values.typecode)[order]).cast('B'))
+            reordered.append(values_sorted)
+        return tuple(reordered)
+
+    def save(self, index_file_name, metric_slots):
+        hashes, class_refs, sizes = self.sorted_arrays()
+
+        slot_refs = {}
+        for slots in self.classes:
+            for slot in slots:
+                slot_refs.setdefault(slot, len(slot_refs))
+        header = {
+            'version': self.VERSION,
+            'fingerprint': self.fingerprint,
+            'slot_keys': [metric_slots.keys[slot] for slot in slot_refs],
+            'classes': [[slot_refs[slot] for slot in slots] for slots in self.classes],
+            'class_counts': self.class_counts,
+            'class_sizes': self.class_sizes,
+            'keys': len(hashes),
+        }
+
+        tmp_name = '{}.{}.tmp'.format(index_file_name, os.getpid())
+        with open(tmp_name, 'wb') as index_file:
+            index_file.write(json.dumps(header).encode('utf-8') + b'\n')
+            hashes.tofile(index_file)
+            class_refs.tofile(index_file)
+            sizes.tofile(index_file)
+        os.replace(tmp_name, index_file_name)
+
+    @classmethod
+    def load(cls, index_file_name, metric_slots, fingerprint):
+        """Returns None if there is no index or it was built with other mount tables"""
+        try:
+            with open(index_file_name, 'rb') as index_file:
+                header = json.loads(index_file.readline().decode('utf-8'))
+                if header.get('version') != cls.VERSION or header.get('fingerprint') != fingerprint:
+                    return None
+                index = cls(fingerprint)
+                slots = [metric_slots.slot(m_name, m_labels) for m_name, m_labels in header['slot_keys']]
+                for class_slots in header['classes']:
+                    index.class_id(tuple(slots[slot_ref] for slot_ref in class_slots))
+                index.class_counts = header['class_counts']
+                index.class_sizes = header['class_sizes']
+                index.hashes.fromfile(index_file, header['keys'])
+                index.class_refs.fromfile(index_file, header['keys'])
+                index.sizes.fromfile(index_file, header['keys'])
+        except (OSError, ValueError, EOFError):
+            return None
+        return index
+
+
+def iter_elements(file_object, chunk_size=65536, element_limit=None, limit_advice=None):
+    """Lazy function (generator) to read elements of exported array one by one.
+    Elements are decoded in place by offset, buffer is compacted only when it runs out of
+    complete elements, so every char is copied once. Read size is doubled while a single
+    element doesn't fit into the buffer, element longer than element_limit raises MemoryError
+    with limit_advice. Malformed element raises ValueError as soon as the next element starts."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    # Chars dropped from the start of buffer
+    consumed = 0
+    eof = False
+
+    while True:
+        position = ARRAY_DELIMITERS.match(buffer, position).end()
+        if position < len(buffer) and ']' == buffer[position]:
+            return
+
+        try:
+            element, position = decoder.raw_decode(buffer, position)
+        except ValueError as error:
+            if eof and position == len(buffer):
+                return
+            # Element followed by the next one is complete, it can't be fixed by reading more
+            if eof or ELEMENT_BOUNDARY.search(buffer, position):
+                raise ValueError('Malformed element at char {}: {}'.format(consumed + error.pos, error.msg))
+            if len(buffer) - position >= chunk_size:
+                if element_limit is not None and len(buffer) - position > element_limit:
+                    raise MemoryError('Element longer than {} chars does not fit into --max-memory budget{}'.format(
+                        element_limit, ', ' + limit_advice if limit_advice else ''))
+                chunk_size *= 2
+            piece = file_object.read(chunk_size)
+            eof = not piece
+            buffer = buffer[position:] + piece
+            consumed += position
+            position = 0
+            continue
+
+        yield element
+
+
+def decode_raw_key(raw_key):
+    """Key from bytes of JSON string without quotes, only escaped keys are decoded as JSON"""
+    if b'\\' in raw_key:
+        return json.loads(b''.join((b'"', raw_key, b'"')).decode('utf-8'))
+    return raw_key.decode('utf-8')
+
+
+def is_value_cut(buffer, position, end):
+    """Whether element in `consul kv export` layout at position has no closing quote of value before end"""
+    match = RAW_EXPORT_VALUE_START.match(buffer, position, end)
+    return match is not None and -1 == buffer.find(b'"', match.end(), end)
+
+
+def iter_raw_records(buffer, start=0, end=None, partial=False, value_sink=None):
+    """Lazy function (generator) to read (key, value size) pairs from exported array in bytes-like
+    object (bytes, mmap). Elements are located by offsets, only the key field is decoded.
+    Elements in `consul kv export` layout are matched at once, any other field order falls back
+    to searching key and value inside of the element. With partial buffer may end in the middle of
+    element, offset of the first unread element is returned then. Values of keys under value_sink.prefix
+    (without consul prefix) are decoded and passed to value_sink.add."""
+    if end is None:
+        end = len(buffer)
+
+    position = start
     while True:
-        data = file_object.read(chunk_size)
-        if not data:
+        match = RAW_EXPORT_ELEMENT.match(buffer, position, end)
+        if match is not None:
+            raw_key = match.group(1)
+            # Span of unmatched group is (-1, -1), so null value has zero length
+            value_start, value_end = match.span(2)
+        elif partial and is_value_cut(buffer, position, end):
+            # Value too long to be matched by RAW_ELEMENT is cut by the end of buffer
             break
-        yield data
+        else:
+            match = RAW_ELEMENT.match(buffer, position, end)
+            if match is None:
+                break
+            key = RAW_KEY_FIELD.search(buffer, match.start(1), match.end())
+            if key is None:
+                raise ValueError('No key field found at offset {}'.format(match.start(1)))
+            raw_key = key.group(1)
+            value = RAW_VALUE_FIELD.search(buffer, match.start(1), match.end())
+            value_start, value_end = value.span(1) if value is not None else (-1, -1)
+        position = match.end()
+        key = decode_raw_key(raw_key)
+
+        if value_end - value_start > 1:
+            padding = (BASE64_PAD == buffer[value_end - 1]) + (BASE64_PAD == buffer[value_end - 2])
+        else:
+            padding = 0
+
+        if value_sink is not None and key.partition('/')[2].startswith(value_sink.prefix):
+            value_sink.add(key, base64.b64decode(buffer[value_start:value_end]) if value_start >= 0 else b'')
+
+        yield key, value_size(value_end - value_start, padding)
+
+    if partial:
+        return position
+    if RAW_ARRAY_END.match(buffer, position, end).end() != end:
+        raise ValueError('Malformed element at offset {}'.format(position))
 
 
-def find_uuid_auth_backend(auth_backs, auth_type):
-    for key in auth_backs.keys():
-        if auth_backs[key]['type'] == auth_type:
-            return key
+def iter_raw_keys(buffer, start=0, end=None):
+    """Lazy function (generator) to read (key, 0) pairs from exported array in bytes-like object, only key fields
+    are searched for, values are skipped without being matched. Returns offset after the last key found."""
+    if end is None:
+        end = len(buffer)
+
+    position = start
+    for match in RAW_KEY_FIELD.finditer(buffer, start, end):
+        position = match.end()
+        yield decode_raw_key(match.group(1)), 0
+    return position
+
+
+def backup_compression(backup_file_name):
+    """Compression format of backup file detected by magic bytes, None for uncompressed one"""
+    with open(backup_file_name, 'rb') as backup_file:
+        head = backup_file.read(6)
+    for magic, compression in COMPRESSION_MAGIC:
+        if head.startswith(magic):
+            return compression
     return None
 
 
-def process_backup(backup_file_name, prom_metrics, auth_backs, secrets_engs):
-    buffer = ""
+def open_decompressed(backup_file_name, compression):
+    if 'gzip' == compression:
+        return gzip.open(backup_file_name, 'rb')
+    if 'xz' == compression:
+        return lzma.open(backup_file_name, 'rb')
+    zstandard = optional_module('zstandard')
+    if zstandard is None:
+        raise ValueError('zstandard package is required to read zstd compressed backup')
+    return zstandard.ZstdDecompressor().stream_reader(open(backup_file_name, 'rb'))
+
+
+def iter_chunks_threaded(stream, chunk_size=DECOMPRESS_CHUNK, depth=DECOMPRESS_QUEUE):
+    """Lazy function (generator) to read chunks of stream in separate thread, at most depth chunks ahead.
+    zlib, lzma and zstandard release GIL while decompressing, so decompression runs in parallel with parsing."""
+    chunks = queue.Queue(depth)
+    stop = threading.Event()
+
+    def read_chunks():
+        try:
+            while not stop.is_set():
+                chunk = stream.read(chunk_size)
+                chunks.put(chunk)
+                if not chunk:
+                    return
+        except Exception as error:
+            chunks.put(error)
+
+    reader = threading.Thread(target=read_chunks, daemon=True)
+    reader.start()
+    try:
+        while True:
+            chunk = chunks.get()
+            if isinstance(chunk, Exception):
+                raise chunk
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        stop.set()
+        # Unblock reader waiting for free space in queue
+        while reader.is_alive():
+            try:
+                chunks.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        reader.join()
+
+
+def iter_stream_records(chunks, counts_only=False, value_sink=None, element_limit=None):
+    """Lazy function (generator) to read (key, value size) pairs from exported array received in chunks of bytes.
+    Element split between chunks is completed by the next ones: they are joined to it at once when as much
+    data as it holds has arrived, so long element is parsed again only each time it doubles. With counts_only
+    only the tail which may hold split key field is kept. Element longer than element_limit isn't kept
+    in memory: its value is measured while being received, it isn't passed to value_sink."""
+    buffer = b''
+    pending = []
+    pending_size = 0
+    chunks = iter(chunks)
+    for chunk in chunks:
+        pending.append(chunk)
+        pending_size += len(chunk)
+        if pending_size < len(buffer) and (element_limit is None or len(buffer) + pending_size <= element_limit):
+            continue
+        buffer = b''.join([buffer] + pending)
+        pending = []
+        pending_size = 0
+        if counts_only:
+            position = yield from iter_raw_keys(buffer)
+            # Key fields can't occur inside of values, only the tail with key field split by chunk is kept
+            buffer = buffer[max(position, len(buffer) - KEY_FIELD_LIMIT):]
+            continue
+        position = yield from iter_raw_records(buffer, partial=True, value_sink=value_sink)
+        buffer = buffer[position:]
+        if element_limit is not None and len(buffer) > element_limit:
+            record, buffer = read_large_element(buffer, chunks, value_sink)
+            yield record
+    buffer = b''.join([buffer] + pending)
+    if counts_only:
+        yield from iter_raw_keys(buffer)
+    else:
+        yield from iter_raw_records(buffer, value_sink=value_sink)
+
+
+def read_large_element(buffer, chunks, value_sink=None):
+    """Read element in `consul kv export` layout which buffer starts with, value is measured chunk by chunk
+    without being kept. Returns (key, value size) and the rest of the last chunk after the element."""
+    match = RAW_EXPORT_VALUE_START.match(buffer)
+    if match is None:
+        raise MemoryError(LARGE_ELEMENT_LAYOUT_ERROR)
+    key = decode_raw_key(match.group(1))
+    if value_sink is not None and key.partition('/')[2].startswith(value_sink.prefix):
+        raise MemoryError('Value of {} is needed, but it is longer than --max-memory budget allows'.format(key))
+    length = 0
+    tail = b''
+    rest = buffer[match.end():]
+    # Base64 has no quotes, so the next quote closes value
+    end = rest.find(b'"')
+    while -1 == end:
+        length += len(rest)
+        tail = (tail + rest[-2:])[-2:]
+        rest = next(chunks, b'')
+        if not rest:
+            raise ValueError('Backup ends inside of value of {}'.format(key))
+        end = rest.find(b'"')
+    length += end
+    tail = (tail + rest[max(end - 2, 0):end])[-2:]
+    rest = rest[end + 1:]
+
+    element_end = RAW_ELEMENT_END.match(rest)
+    while element_end is None:
+        if rest.strip():
+            raise MemoryError(LARGE_ELEMENT_LAYOUT_ERROR)
+        chunk = next(chunks, b'')
+        if not chunk:
+            raise ValueError('Backup ends inside of element {}'.format(key))
+        rest += chunk
+        element_end = RAW_ELEMENT_END.match(rest)
+    return (key, value_size(length, tail.count(b'=') if length > 1 else 0)), rest[element_end.end():]
+
+
+def iter_compressed_records(backup_file_name, compression, counts_only=False, value_sink=None, element_limit=None,
+                            stats=None):
+    with open_decompressed(backup_file_name, compression) as stream:
+        chunks = iter_chunks_threaded(stream)
+        if stats is not None:
+            chunks = iter_counted(chunks, stats)
+        yield from iter_stream_records(chunks, counts_only, value_sink, element_limit)
+
+
+def iter_counted(chunks, stats):
+    """Pass chunks through, their bytes are added to AnalyzerStats"""
+    for chunk in chunks:
+        stats.backup_bytes += len(chunk)
+        yield chunk
+
+
+def find_compressed_values(backup_file_name, compression, keys):
+    """Values of given keys (without consul prefix) in compressed backup, it is decompressed only up to
+    the last of them. Returns base64 decoded values, missing keys are absent in result."""
+    keys = set(keys)
+    values = {}
+    with open_decompressed(backup_file_name, compression) as stream:
+        for element in iter_elements(io.TextIOWrapper(stream, encoding='utf-8')):
+            key = element.get('key', element.get('Key', ''))
+            value = element.get('value', element.get('Value'))
+            key = key.partition('/')[2]
+            if key in keys:
+                keys.discard(key)
+                if value is not None:
+                    values[key] = base64.b64decode(value)
+                if not keys:
+                    break
+    return values
+
+
+def value_size(encoded_length, padding=0):
+    """Size of stored value in bytes, derived from length of its base64 encoded form"""
+    return encoded_length // 4 * 3 - padding
+
+
+def element_record(element, value_sink=None):
+    field = ''
+    value = ''
+    if 'Key' in element:
+        field = 'Key'
+        value = 'Value'
+    if 'key' in element:
+        field = 'key'
+        value = 'value'
+
+    if '' == field:
+        raise ValueError('No key field found in element with fields {}'.format(', '.join(element) or 'none'))
+
+    encoded = element[value] or ''
+    if value_sink is not None and element[field].partition('/')[2].startswith(value_sink.prefix):
+        value_sink.add(element[field], base64.b64decode(encoded))
+    return element[field], value_size(len(encoded), encoded[-2:].count('='))
+
+
+def find_backup_values(backup_file_name, keys):
+    """Seek directly to elements with given keys (without consul prefix) in mapped backup,
+    without scanning the rest of it. Returns base64 decoded values, missing keys are absent in result."""
+    storage = storage_format(backup_file_name)
+    if storage is not None:
+        return find_storage_values(backup_file_name, storage, keys)
+
+    compression = backup_compression(backup_file_name)
+    if compression is not None:
+        return find_compressed_values(backup_file_name, compression, keys)
+
+    values = {}
+    with open(backup_file_name, 'rb') as backup_file:
+        if 0 == os.fstat(backup_file.fileno()).st_size:
+            return values
+        with mmap.mmap(backup_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            first = next(iter_raw_records(mapped), None)
+            if first is None:
+                return values
+            prefix = first[0].split('/')[0]
+
+            for key in keys:
+                needle = json.dumps('/'.join((prefix, key))).encode('utf-8')
+                position = find_mapped(mapped, needle)
+                while -1 != position:
+                    start = mapped.rfind(b'{', 0, position)
+                    element = RAW_ELEMENT.match(mapped, start)
+                    if element is not None:
+                        raw_key = RAW_KEY_FIELD.search(mapped, start, element.end())
+                        if raw_key is not None and raw_key.group(1) == needle[1:-1]:
+                            value = RAW_VALUE_FIELD.search(mapped, start, element.end())
+                            if value is not None and value.group(1) is not None:
+                                values[key] = base64.b64decode(value.group(1))
+                            break
+                    position = find_mapped(mapped, needle, position + 1)
+    return values
+
+
+def find_mapped(mapped, needle, start=0):
+    """mapped.find which releases pages it has searched through, so looking for missing key doesn't keep
+    the whole backup in RSS"""
+    if not hasattr(mapped, 'madvise'):
+        return mapped.find(needle, start)
+    while start < len(mapped):
+        end = min(start + MIN_WINDOW, len(mapped))
+        position = mapped.find(needle, start, min(end + len(needle), len(mapped)))
+        if -1 != position:
+            return position
+        released = start - start % mmap.PAGESIZE
+        mapped.madvise(mmap.MADV_DONTNEED, released, end - end % mmap.PAGESIZE - released)
+        start = end
+    return -1
+
+
+def parse_vault_time(value):
+    """Seconds since epoch of RFC 3339 time as vault stores it, None for missing or zero time"""
+    match = VAULT_TIME.match(value or '')
+    if match is None:
+        return None
+    year, month, day, hour, minute, second = (int(field) for field in match.groups()[:6])
+    if year <= 1:
+        return None
+    offset = 0
+    if 'Z' != match.group(7):
+        offset = (int(match.group(7)[1:3]) * 60 + int(match.group(7)[4:6])) * 60
+        if '-' == match.group(7)[0]:
+            offset = -offset
+    return calendar.timegm((year, month, day, hour, minute, second)) - offset
+
+
+def decode_storage_value(value):
+    """Decode JSON value stored by vault. Values written through vault barrier are encrypted,
+    so they can be decoded only from decrypted backup."""
+    if value[:1] == VAULT_GZIP_CANARY:
+        value = gzip.decompress(value[1:])
+    if value[:1] != b'{':
+        raise ValueError('Value is encrypted by vault barrier or has unknown format')
+    return json.loads(value.decode('utf-8'))
+
+
+def read_backup_mount_tables(backup_file_name):
+    """Read auth backends and secrets engines from mount tables stored in backup itself,
+    in the same format as convert_hvac_dict returns."""
+    tables = {'auth': {}, 'secrets': {}}
+    if is_consul_url(backup_file_name):
+        values = find_consul_values(backup_file_name, MOUNT_TABLE_KEYS.keys())
+    else:
+        values = find_backup_values(backup_file_name, MOUNT_TABLE_KEYS.keys())
+    if 'core/mounts' not in values or 'core/auth' not in values:
+        raise ValueError('No mount tables found in {}'.format(backup_file_name))
+
+    for key, value in values.items():
+        try:
+            table = decode_storage_value(value)
+        except ValueError as error:
+            raise ValueError('Unable to read mount table {}: {}'.format(key, error))
+        tables[MOUNT_TABLE_KEYS[key]].update(convert_mount_table(table))
+
+    return tables['auth'], tables['secrets']
+
+
+def is_consul_url(backup_file_name):
+    return backup_file_name.startswith(('http://', 'https://'))
+
+
+class CountingStream(io.RawIOBase):
+    """Binary stream counting bytes read from the stream it wraps"""
+    def __init__(self, stream):
+        super().__init__()
+        self.stream = stream
+        self.count = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = self.stream.readinto(buffer)
+        self.count += count
+        return count
+
+
+class ConsulKV:
+    """Persistent connection to consul KV API, backup_url is consul address with KV prefix as path,
+    e.g. http://localhost:8500/vault. Token is taken from CONSUL_HTTP_TOKEN like consul CLI does."""
+    def __init__(self, backup_url):
+        url = urllib.parse.urlsplit(backup_url)
+        self.prefix = url.path.strip('/')
+        if not self.prefix:
+            raise ValueError('No KV prefix in {}'.format(backup_url))
+        connection_class = http.client.HTTPSConnection if 'https' == url.scheme else http.client.HTTPConnection
+        self.connection = connection_class(url.netloc, timeout=CONSUL_TIMEOUT)
+        self.headers = {}
+        # Bytes of response bodies elements were decoded from
+        self.received = 0
+        if os.environ.get('CONSUL_HTTP_TOKEN'):
+            self.headers['X-Consul-Token'] = os.environ['CONSUL_HTTP_TOKEN']
+
+    def close(self):
+        self.connection.close()
+
+    def request(self, key, query=''):
+        path = '/v1/kv/' + urllib.parse.quote(key)
+        if query:
+            path = '?'.join((path, query))
+        self.connection.request('GET', path, headers=self.headers)
+        response = self.connection.getresponse()
+        if 404 == response.status:
+            response.read()
+            return None
+        if 200 != response.status:
+            response.read()
+            raise ValueError('Consul responded {} {} to {}'.format(response.status, response.reason, path))
+        return response
+
+    def iter_elements(self, key, query='', element_limit=None):
+        """Lazy function (generator) to decode elements of JSON array in response while it is being received"""
+        response = self.request(key, query)
+        if response is None:
+            return
+        body = CountingStream(response)
+        yield from iter_elements(io.TextIOWrapper(io.BufferedReader(body), encoding='utf-8'),
+                                 element_limit=element_limit, limit_advice=CONSUL_ELEMENT_LIMIT_ADVICE)
+        # Connection can be reused only after response is read to the end
+        self.received += body.count + len(response.read())
+
+    def get(self, key):
+        """Raw value of key, None if key is absent"""
+        response = self.request(key, 'raw')
+        return None if response is None else response.read()
+
+
+def iter_consul_records(backup_url, keys_only=False, value_sink=None, element_limit=None, stats=None):
+    """Lazy function (generator) to read (key, value size) pairs straight from consul KV API, so backup
+    never needs to be stored on disk. KV tree is requested per top level prefix over one connection,
+    elements are classified while response is being received. With keys_only values aren't requested
+    and sizes are 0. Element longer than element_limit raises MemoryError. Bytes of responses are added
+    to AnalyzerStats if stats is given."""
+    consul = ConsulKV(backup_url)
+    try:
+        for key in list(consul.iter_elements(consul.prefix + '/', 'keys&separator=/')):
+            if not key.endswith('/'):
+                if keys_only:
+                    yield key, 0
+                else:
+                    yield from (element_record(element, value_sink)
+                                for element in consul.iter_elements(key, element_limit=element_limit))
+            elif keys_only:
+                yield from ((sub_key, 0) for sub_key in consul.iter_elements(key, 'keys'))
+            else:
+                yield from (element_record(element, value_sink)
+                            for element in consul.iter_elements(key, 'recurse', element_limit))
+    finally:
+        if stats is not None:
+            stats.backup_bytes += consul.received
+        consul.close()
+
+
+def find_consul_values(backup_url, keys):
+    """Values of given keys (without consul prefix) read from consul KV API, missing keys are absent in result"""
+    values = {}
+    consul = ConsulKV(backup_url)
+    try:
+        for key in keys:
+            value = consul.get('/'.join((consul.prefix, key)))
+            if value is not None:
+                values[key] = value
+    finally:
+        consul.close()
+    return values
+
+
+def decode_varint(buffer, position):
+    result = 0
+    shift = 0
+    while True:
+        byte = buffer[position]
+        position += 1
+        result |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return result, position
+        shift += 7
+
+
+def read_varint(stream):
+    """Varint read byte by byte from stream, None at the end of stream"""
+    result = 0
+    shift = 0
+    while True:
+        byte = stream.read(1)
+        if not byte:
+            if shift:
+                raise ValueError('Truncated varint')
+            return None
+        result |= (byte[0] & 0x7f) << shift
+        if byte[0] < 0x80:
+            return result
+        shift += 7
+
+
+def decode_storage_entry(message):
+    """Key and value of StorageEntry protobuf message, other fields are skipped"""
+    key = ''
+    value = b''
+    position = 0
+    while position < len(message):
+        tag, position = decode_varint(message, position)
+        field, wire_type = tag >> 3, tag & 0x07
+        if 2 == wire_type:
+            length, position = decode_varint(message, position)
+            if 1 == field:
+                key = bytes(message[position:position + length]).decode('utf-8')
+            elif 2 == field:
+                value = bytes(message[position:position + length])
+            position += length
+        elif 0 == wire_type:
+            _, position = decode_varint(message, position)
+        elif 1 == wire_type:
+            position += 8
+        elif 5 == wire_type:
+            position += 4
+        else:
+            raise ValueError('Unsupported protobuf wire type {}'.format(wire_type))
+    return key, value
+
+
+def iter_raft_snapshot(backup_file_name, stats=None):
+    """Lazy function (generator) to read (key, value) pairs from raft snapshot made with
+    `vault operator raft snapshot save`. Archive is decompressed while being read, bytes of decompressed
+    storage entries are added to AnalyzerStats if stats is given."""
+    with tarfile.open(backup_file_name, 'r|gz') as archive:
+        for member in archive:
+            if RAFT_SNAPSHOT_STATE != member.name:
+                continue
+            state = archive.extractfile(member)
+            while True:
+                length = read_varint(state)
+                if length is None:
+                    if stats is not None:
+                        stats.backup_bytes += state.tell()
+                    return
+                message = state.read(length)
+                if len(message) != length:
+                    raise ValueError('Truncated storage entry in {}'.format(backup_file_name))
+                yield decode_storage_entry(memoryview(message))
+    raise ValueError('No {} found in {}'.format(RAFT_SNAPSHOT_STATE, backup_file_name))
+
+
+def bolt_checksum(data):
+    """FNV-1a 64-bit hash BoltDB uses for meta pages"""
+    checksum = 0xcbf29ce484222325
+    for byte in data:
+        checksum = ((checksum ^ byte) * 0x100000001b3) & 0xffffffffffffffff
+    return checksum
+
+
+def read_bolt_meta(mapped):
+    """Meta of the last committed transaction: both meta pages are read, valid one with greater txid wins"""
+    page_size = BOLT_META.unpack_from(mapped, BOLT_PAGE_HEADER.size)[2]
+    metas = []
+    for page in (0, 1):
+        offset = page * page_size + BOLT_PAGE_HEADER.size
+        if offset + BOLT_META.size > len(mapped):
+            continue
+        meta = BOLT_META.unpack_from(mapped, offset)
+        if BOLT_MAGIC == meta[0] and bolt_checksum(mapped[offset:offset + BOLT_META.size - 8]) == meta[9]:
+            metas.append(meta)
+    if not metas:
+        raise ValueError('No valid meta page found in BoltDB file')
+    return max(metas, key=lambda meta: meta[8])
+
+
+def iter_bolt_page(mapped, page_size, buffer, offset):
+    """Lazy function (generator) to read (flags, key, value offset, value size) of leaf elements under page
+    at offset in buffer (inline bucket page is stored in value of its parent), in key order."""
+    _, flags, count, _ = BOLT_PAGE_HEADER.unpack_from(buffer, offset)
+    elements = offset + BOLT_PAGE_HEADER.size
+    if flags & BOLT_BRANCH_PAGE:
+        for idx in range(count):
+            _, _, child = BOLT_BRANCH_ELEMENT.unpack_from(buffer, elements + idx * BOLT_BRANCH_ELEMENT.size)
+            yield from iter_bolt_page(mapped, page_size, mapped, child * page_size)
+    elif flags & BOLT_LEAF_PAGE:
+        for idx in range(count):
+            element = elements + idx * BOLT_LEAF_ELEMENT.size
+            element_flags, position, key_size, size = BOLT_LEAF_ELEMENT.unpack_from(buffer, element)
+            key_start = element + position
+            yield element_flags, buffer[key_start:key_start + key_size], key_start + key_size, size
+    else:
+        raise ValueError('Unexpected BoltDB page type {:#x} at offset {}'.format(flags, offset))
+
+
+def bolt_bucket_root(mapped, page_size, buffer, offset, size):
+    """Buffer and offset of root page of bucket stored as value at offset in buffer"""
+    root, _ = BOLT_BUCKET_HEADER.unpack_from(buffer, offset)
+    if 0 == root:
+        # Page of inline bucket follows its header in value of parent page
+        return bytes(buffer[offset + BOLT_BUCKET_HEADER.size:offset + size]), 0
+    return mapped, root * page_size
+
+
+def iter_boltdb(backup_file_name, stats=None):
+    """Lazy function (generator) to read (key, value) pairs from data bucket of integrated storage BoltDB file
+    (vault.db), file is mapped into memory and B+tree is walked in key order. Size of mapped file is added
+    to AnalyzerStats if stats is given."""
+    with open(backup_file_name, 'rb') as backup_file:
+        with mmap.mmap(backup_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            meta = read_bolt_meta(mapped)
+            page_size = meta[2]
+            root_page = meta[4] * page_size
+            for flags, key, bucket_offset, bucket_size in iter_bolt_page(mapped, page_size, mapped, root_page):
+                if not flags & BOLT_BUCKET_LEAF or BOLT_DATA_BUCKET != key:
+                    continue
+                buffer, offset = bolt_bucket_root(mapped, page_size, mapped, bucket_offset, bucket_size)
+                for entry_flags, entry_key, entry_offset, entry_size in iter_bolt_page(mapped, page_size, buffer,
+                                                                                       offset):
+                    # Nested buckets aren't storage entries
+                    if not entry_flags & BOLT_BUCKET_LEAF:
+                        yield entry_key.decode('utf-8'), buffer[entry_offset:entry_offset + entry_size]
+                if stats is not None:
+                    stats.backup_bytes += len(mapped)
+                return
+    raise ValueError('No {} bucket found in {}'.format(BOLT_DATA_BUCKET.decode(), backup_file_name))
+
+
+# Readers of integrated storage formats, generators of (key, value) pairs in storage order
+STORAGE_READERS = {
+    'raft': iter_raft_snapshot,
+    'boltdb': iter_boltdb,
+}
+
+
+def storage_format(backup_file_name):
+    """Integrated storage format of backup detected by magic bytes, None for consul export"""
+    with open(backup_file_name, 'rb') as backup_file:
+        head = backup_file.read(BOLT_PAGE_HEADER.size + 4)
+    if len(head) == BOLT_PAGE_HEADER.size + 4:
+        magic = struct.unpack_from('<I', head, BOLT_PAGE_HEADER.size)[0]
+        if BOLT_MAGIC == magic:
+            return 'boltdb'
+    if 'gzip' == backup_compression(backup_file_name):
+        with gzip.open(backup_file_name, 'rb') as stream:
+            block = stream.read(tarfile.BLOCKSIZE)
+        if b'ustar' == block[257:262]:
+            return 'raft'
+    return None
+
 
-    with open(backup_file_name, 'r') as backup_file:
-        for piece in read_in_chunks(backup_file):
-            prom_metrics, buffer = process_element(prom_metrics, buffer + piece, auth_backs, secrets_engs)
-    return prom_metrics
+def iter_storage_records(backup_file_name, storage, value_sink=None, stats=None):
+    for key, value in STORAGE_READERS[storage](backup_file_name, stats):
+        key_with_prefix = '/'.join((INTEGRATED_STORAGE_PREFIX, key))
+        if value_sink is not None and key.startswith(value_sink.prefix):
+            value_sink.add(key_with_prefix, bytes(value))
+        yield key_with_prefix, len(value)
+
+
+def find_storage_values(backup_file_name, storage, keys):
+    """Values of given keys in integrated storage backup, it is read only up to the last of them"""
+    keys = set(keys)
+    values = {}
+    for key, value in STORAGE_READERS[storage](backup_file_name):
+        if key in keys:
+            keys.discard(key)
+            values[key] = bytes(value)
+            if not keys:
+                break
+    return values
+
+
+def iter_backup_records(backup_file_name, use_mmap=True, start=0, end=None, counts_only=False, value_sink=None,
+                        budget=None, stats=None):
+    """Lazy function (generator) to read (key, value size) pairs from backup file or consul KV API.
+    With use_mmap file is mapped into memory and scanned as bytes between start and end offsets,
+    otherwise it is decoded in text mode. Compressed backup is decompressed while being read.
+    Raft snapshot and BoltDB file of integrated storage are read with STORAGE_READERS.
+    With counts_only sizes may be left 0. Values of keys under value_sink.prefix are passed to value_sink.add,
+    value_sink isn't supported with counts_only. Readers keep within MemoryBudget if budget is given.
+    Bytes the backup was read and parsed from are added to AnalyzerStats if stats is given: scanned range
+    of the file, decompressed data or consul responses."""
+    element_limit = None if budget is None else budget.element_limit
+    if is_consul_url(backup_file_name):
+        yield from iter_consul_records(backup_file_name, keys_only=counts_only, value_sink=value_sink,
+                                       element_limit=element_limit, stats=stats)
+        return
+
+    storage = storage_format(backup_file_name)
+    if storage is not None:
+        yield from iter_storage_records(backup_file_name, storage, value_sink, stats)
+        return
+
+    compression = backup_compression(backup_file_name)
+    if compression is not None:
+        yield from iter_compressed_records(backup_file_name, compression, counts_only, value_sink, element_limit,
+                                           stats)
+        return
+
+    if not use_mmap:
+        with open(backup_file_name, 'r') as backup_file:
+            for element in iter_elements(backup_file, element_limit=element_limit,
+                                         limit_advice=TEXT_ELEMENT_LIMIT_ADVICE):
+                yield element_record(element, value_sink)
+            if stats is not None:
+                stats.backup_bytes += backup_file.buffer.tell()
+        return
+
+    with open(backup_file_name, 'rb') as backup_file:
+        size = os.fstat(backup_file.fileno()).st_size
+        if 0 == size:
+            return
+        with mmap.mmap(backup_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if hasattr(mapped, 'madvise'):
+                mapped.madvise(mmap.MADV_SEQUENTIAL)
+            if budget is not None and hasattr(mapped, 'madvise'):
+                yield from iter_mapped_windows(mapped, start, end, counts_only, value_sink, budget.window)
+            elif counts_only:
+                yield from iter_raw_keys(mapped, start, end)
+            else:
+                yield from iter_raw_records(mapped, start, end, value_sink=value_sink)
+    if stats is not None:
+        stats.backup_bytes += (size if end is None else end) - start
+
+
+def iter_mapped_windows(mapped, start, end, counts_only, value_sink, window):
+    """iter_raw_keys/iter_raw_records over mapped backup window by window, pages of scanned windows are
+    released, so RSS doesn't grow with backup size. Window is widened to hold element which starts it,
+    keys are searched for in the tail of window without key."""
+    if end is None:
+        end = len(mapped)
+    position = start
+    released = start - start % mmap.PAGESIZE
+    scan_end = position + window
+    while scan_end < end:
+        if counts_only:
+            scanned = yield from iter_raw_keys(mapped, position, scan_end)
+            if scanned == position:
+                # Window is inside of value, only its tail may hold the start of the next key field
+                scanned = max(position, scan_end - KEY_FIELD_LIMIT)
+        else:
+            scanned = yield from iter_raw_records(mapped, position, scan_end, partial=True, value_sink=value_sink)
+        if scanned == position:
+            # Window is shorter than element (or than key field limit), it is widened until it holds one
+            scan_end += scan_end - position
+            continue
+        position = scanned
+        boundary = position - position % mmap.PAGESIZE
+        if boundary > released:
+            mapped.madvise(mmap.MADV_DONTNEED, released, boundary - released)
+            released = boundary
+        scan_end = position + window
+        if not counts_only:
+            scan_end = max(scan_end, mapped_element_end(mapped, position, end))
+    if counts_only:
+        yield from iter_raw_keys(mapped, position, end)
+    else:
+        yield from iter_raw_records(mapped, position, end, value_sink=value_sink)
+
+
+def mapped_element_end(mapped, position, end):
+    """Offset past the end of element at position in `consul kv export` layout, found without matching its
+    value by regex. -1 for other layouts."""
+    match = RAW_EXPORT_VALUE_START.match(mapped, position, end)
+    if match is None:
+        return -1
+    # Base64 has no quotes, so the next quote closes value
+    value_end = mapped.find(b'"', match.end(), end)
+    element_end = RAW_ELEMENT_END.match(mapped, value_end + 1, end) if -1 != value_end else None
+    return -1 if element_end is None else element_end.end()
+
+
+def find_shard_offsets(backup_file_name, shards):
+    """Split backup file into at most `shards` byte ranges, every range starts at element boundary."""
+    with open(backup_file_name, 'rb') as backup_file:
+        size = os.fstat(backup_file.fileno()).st_size
+        if 0 == size:
+            return []
+        with mmap.mmap(backup_file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            offsets = [0]
+            for shard in range(1, shards):
+                boundary = RAW_ELEMENT_BOUNDARY.search(mapped, max(offsets[-1], size * shard // shards))
+                if boundary is None:
+                    break
+                offsets.append(boundary.end())
+    offsets.append(size)
+    return list(zip(offsets[:-1], offsets[1:]))
+
+
+def process_shard(backup_file_name, start, end, classifier, counts_only=False, report=None, value_sink=None,
+                  stats=None, budget=None):
+    records = iter_backup_records(backup_file_name, True, start, end, counts_only, value_sink, budget, stats)
+    process_records(records, classifier, stats, report, budget=budget)
+    return classifier.slots, classifier.unresolved_mounts, report, value_sink, stats
+
+
+def secrets_engine_kind(secrets_eng):
+    if 'kv' != secrets_eng['type']:
+        return secrets_eng['type']
+    # KVv2 should have version field with value equal 2. If not set - KVv1
+    options = secrets_eng.get('options') or {}
+    if 'version' not in options:
+        return None
+    return 'kv-2' if '2' == options['version'] else 'kv-1'
+
+
+class MountTable:
+    """Mount table as returned by convert_hvac_dict with prebuilt indexes:
+    by UUID, by type (the first mount of the type) and by mount path."""
+    def __init__(self, mounts):
+        self.by_uuid = mounts
+        self.by_type = {}
+        self.by_path = {}
+        for mount in mounts.values():
+            self.by_type.setdefault(mount['type'], mount)
+            self.by_path[mount['name']] = mount
+
+
+class PathNode:
+    __slots__ = ('metrics', 'terminal', 'other', 'children', 'any', 'each', 'mounts')
+
+    def __init__(self, metrics, terminal, other):
+        self.metrics = metrics
+        self.terminal = terminal
+        # Slots of keys going on to segments without rules
+        self.other = other
+        self.children = {}
+        self.any = None
+        self.each = None
+        self.mounts = False
+
+
+class PathClassifier:
+    """Prefix trie compiled from STORAGE_RULES and mount tables once per run.
+    Every node keeps metric slots of the whole path to it, so classification of a key is a single walk
+    over its segments and returns slots of (metric family, labels) pairs resolved at compile time."""
+    def __init__(self, auth_backs, secrets_engs, slots, rules=STORAGE_RULES):
+        self.auth_backs = MountTable(auth_backs)
+        self.secrets_engs = MountTable(secrets_engs)
+        self.slots = slots
+        # UUIDs of mounts found in backup, but missing in mount tables
+        self.unresolved_mounts = set()
+        # Distinct classifications of classify_batch and their codes
+        self.classes = []
+        self.class_codes = {}
+        self.root = self.compile(self.branch_rules(rules), {}, ())
+
+    @staticmethod
+    def branch_rules(rules):
+        children = {segment: dict(rule, metrics=[(BRANCH_METRIC, (segment,))] + list(rule.get('metrics', ())))
+                    for segment, rule in rules.get('children', {}).items()}
+        other = [(BRANCH_METRIC, ('other',))]
+        return dict(rules, children=children, any={'metrics': other}, terminal=other)
+
+    def counted(self, metrics):
+        """Slots of keys classified with metrics, unknown key slot is added if only self-metrics count them"""
+        branch = ''
+        for slot in metrics:
+            m_name, m_labels = self.slots.keys[slot]
+            if BRANCH_METRIC != m_name:
+                return metrics
+            branch = m_labels[0]
+        return metrics + (self.slots.slot(UNKNOWN_METRIC, [branch]),)
+
+    def resolve(self, metrics, context):
+        return tuple(self.slots.slot(m_name, [label.format(**context) for label in m_labels])
+                     for m_name, m_labels in metrics)
+
+    def compile(self, rule, context, inherited):
+        if 'mount_type' in rule:
+            context = self.auth_backs.by_type.get(rule['mount_type'])
+            if context is None:
+                return None
+
+        metrics = inherited + self.resolve(rule.get('metrics', ()), context)
+        terminal = metrics + self.resolve(rule.get('terminal', ()), context)
+        node = PathNode(metrics, self.counted(terminal), self.counted(metrics))
+
+        if 'auth' == rule.get('mounts'):
+            node.mounts = True
+            for uuid, auth_back in self.auth_backs.by_uuid.items():
+                mount_rule = AUTH_BACKEND_RULES.get(auth_back['type'], AUTH_BACKEND_RULES['*'])
+                node.children[uuid] = self.compile(mount_rule, auth_back, metrics)
+        elif 'secrets' == rule.get('mounts'):
+            node.mounts = True
+            for uuid, secrets_eng in self.secrets_engs.by_uuid.items():
+                # Known mounts of types without rules are not counted, but are not unresolved either
+                mount_rule = SECRETS_ENGINE_RULES.get(secrets_engine_kind(secrets_eng), {})
+                node.children[uuid] = self.compile(mount_rule, secrets_eng, metrics)
+
+        if 'auth' == rule.get('lease_mounts'):
+            for mount_path, auth_back in self.auth_backs.by_path.items():
+                self.insert(node, mount_path.split('/'), self.compile(rule['rule'], auth_back, metrics))
+
+        for segment, child_rule in rule.get('children', {}).items():
+            child = self.compile(child_rule, context, metrics)
+            if child is not None:
+                node.children[segment] = child
+        if 'any' in rule:
+            node.any = self.compile(rule['any'], context, metrics)
+        if 'each' in rule:
+            node.each = (rule['each'], context)
+        return node
+
+    @staticmethod
+    def insert(node, segments, leaf):
+        """Insert leaf node under several segments, e.g. nested mount path. Nodes on the way are shared
+        with other mounts: a/b and a/c share node a, and mount a keeps children of mount a/b."""
+        for segment in segments[:-1]:
+            child = node.children.get(segment)
+            if child is None:
+                child = PathNode(node.metrics, node.other, node.other)
+                node.children[segment] = child
+            node = child
+        existing = node.children.get(segments[-1])
+        if existing is not None:
+            for segment, child in existing.children.items():
+                leaf.children.setdefault(segment, child)
+        node.children[segments[-1]] = leaf
+
+    def walk(self, node, segments, start):
+        """Node reached from node by segments[start:] and None, or None and slots of keys which go on
+        to segments without rules"""
+        for idx in range(start, len(segments)):
+            child = node.children.get(segments[idx])
+            if child is None:
+                child = node.any
+                if child is None:
+                    if node.each is None:
+                        if node.mounts:
+                            self.unresolved_mounts.add(segments[idx])
+                        return None, node.other
+                    child = self.expand(node, segments[idx])
+            node = child
+        return node, None
+
+    def classify(self, key):
+        # The first segment is consul prefix
+        node, slots = self.walk(self.root, key.split('/'), 1)
+        return node.terminal if slots is None else slots
+
+    def classify_batch(self, keys):
+        """Codes of classifications of keys, classifications are dictionary encoded in self.classes.
+        Keys under the same parent path share the walk to it, so the trie is walked once per parent in a batch."""
+        class_codes = self.class_codes
+        parents = {}
+        codes = []
+        for key in keys:
+            parent, _, segment = key.rpartition('/')
+            located = parents.get(parent)
+            if located is None:
+                # Key without parent is consul prefix itself
+                located = self.walk(self.root, parent.split('/'), 1) if parent else (self.root, None)
+                parents[parent] = located
+            node, slots = located
+            if slots is None:
+                if not parent:
+                    slots = node.terminal
+                else:
+                    child = node.children.get(segment)
+                    if child is None:
+                        child, slots = self.walk(node, (segment,), 0)
+                    if slots is None:
+                        slots = child.terminal
+            code = class_codes.get(slots)
+            if code is None:
+                code = class_codes[slots] = len(self.classes)
+                self.classes.append(slots)
+            codes.append(code)
+        return codes
+
+    def expand(self, node, segment):
+        rule, context = node.each
+        child = self.compile(rule, dict(context, segment=segment), node.metrics)
+        node.children[segment] = child
+        return child
+
+
+def analyze_backup(backup_file_name, auth_backs, secrets_engs, use_mmap=True, workers=1, counts_only=False,
+                   report=None, value_sink=None, stats=None, key_export=None, budget=None):
+    """Classify every key of backup, add it to StorageReport if report is given, pass values to value_sink
+    (e.g. LeaseTimeline), write it to KeyExport if key_export is given, add time of reading and classification
+    and bytes read to AnalyzerStats, keep within MemoryBudget if budget is given.
+    Returns metric slots and UUIDs of mounts missing in mount tables."""
+    classifier = PathClassifier(auth_backs, secrets_engs, MetricSlots())
+    if stats is None:
+        stats = AnalyzerStats()
+
+    if workers > 1:
+        if not use_mmap:
+            raise ValueError('Sharded analysis requires mmap mode')
+        if key_export is not None:
+            raise ValueError('Sharded analysis does not support key export')
+        if backup_compression(backup_file_name) is not None or storage_format(backup_file_name) is not None:
+            raise ValueError('Sharded analysis requires uncompressed consul export')
+        return analyze_backup_sharded(backup_file_name, classifier, workers, counts_only, report, value_sink,
+                                      stats, budget)
+
+    records = iter_backup_records(backup_file_name, use_mmap, counts_only=counts_only, value_sink=value_sink,
+                                  budget=budget, stats=stats)
+    process_records(records, classifier, stats, report, key_export, budget)
+    return classifier.slots, classifier.unresolved_mounts
+
+
+def analyze_backup_sharded(backup_file_name, classifier, workers, counts_only=False, report=None, value_sink=None,
+                           stats=None, budget=None):
+    # Few shards per worker, so workers which got lighter part of backup don't sit idle
+    shards = find_shard_offsets(backup_file_name, workers * 4)
+    # Workers run at the same time, parent process keeps one share to merge their results
+    shard_budget = None if budget is None else budget.share(workers + 1)
+    from concurrent.futures import ProcessPoolExecutor
+    slots = MetricSlots()
+    unresolved_mounts = set()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(process_shard, backup_file_name, start, end, classifier, counts_only,
+                                   None if report is None else StorageReport(report.top),
+                                   None if value_sink is None else LeaseTimeline(value_sink.now),
+                                   AnalyzerStats(), shard_budget)
+                   for start, end in shards]
+        for future in futures:
+            shard_slots, shard_unresolved_mounts, shard_report, shard_value_sink, shard_stats = future.result()
+            slots.merge(shard_slots)
+            if stats is not None:
+                stats.merge(shard_stats)
+            unresolved_mounts.update(shard_unresolved_mounts)
+            if report is not None:
+                report.merge(shard_report)
+            if value_sink is not None:
+                value_sink.merge(shard_value_sink)
+
+    return slots, unresolved_mounts
+
+
+def mount_tables_fingerprint(auth_backs, secrets_engs):
+    mounts = [[uuid, mount['type'], mount['name'], secrets_engine_kind(mount)]
+              for table in (auth_backs, secrets_engs) for uuid, mount in table.items()]
+    return hashlib.sha256(json.dumps(sorted(mounts)).encode('utf-8')).hexdigest()
+
+
+def analyze_backup_diff(backup_file_name, auth_backs, secrets_engs, index_file_name, use_mmap=True, budget=None,
+                        stats=None):
+    """Apply changes since previous run to its stored aggregates: only keys missing in index of previous run
+    are classified, changed and removed keys reuse their stored classification. Index is rewritten for the next run.
+    Returns metric slots, MetricDiff (None without usable previous index) and UUIDs of unresolved mounts."""
+    classifier = PathClassifier(auth_backs, secrets_engs, MetricSlots())
+    fingerprint = mount_tables_fingerprint(auth_backs, secrets_engs)
+    previous = KeyIndex.load(index_file_name, classifier.slots, fingerprint)
+    index = KeyIndex(fingerprint)
+    metric_diff = None
+
+    records = iter_backup_records(backup_file_name, use_mmap, budget=budget, stats=stats)
+    if budget is not None:
+        records = iter_checked(records, budget, 'Key index')
+    if previous is None:
+        for key, size in records:
+            index.append(KeyIndex.key_hash(key), index.class_id(classifier.classify(key)), size)
+    else:
+        metric_diff = MetricDiff(classifier.slots)
+        # Classifications of previous index are reused as is
+        for slots in previous.classes:
+            index.class_id(slots)
+        added = [0] * len(index.classes)
+        size_delta = [0] * len(index.classes)
+        seen = bytearray(len(previous.hashes))
+
+        for key, size in records:
+            key_hash = KeyIndex.key_hash(key)
+            position = previous.find(key_hash)
+            if -1 == position:
+                class_id = index.class_id(classifier.classify(key))
+                if class_id == len(added):
+                    added.append(0)
+                    size_delta.append(0)
+                added[class_id] += 1
+                size_delta[class_id] += size
+            else:
+                seen[position] = 1
+                class_id = previous.class_refs[position]
+                size_delta[class_id] += size - previous.sizes[position]
+            index.append(key_hash, class_id, size)
+
+        removed = [0] * len(index.classes)
+        position = seen.find(0)
+        while -1 != position:
+            class_id = previous.class_refs[position]
+            removed[class_id] += 1
+            size_delta[class_id] -= previous.sizes[position]
+            position = seen.find(0, position + 1)
+
+        for class_id, slots in enumerate(index.classes):
+            if added[class_id] or removed[class_id] or size_delta[class_id]:
+                metric_diff.add(slots, added[class_id], removed[class_id], size_delta[class_id])
+
+    index.save(index_file_name, classifier.slots)
+    return index.add_to(classifier.slots), metric_diff, classifier.unresolved_mounts
+
+
+def iter_checked(records, budget, what):
+    """Pass records through, MemoryBudget is checked once per RECORDS_BATCH of them"""
+    for count, record in enumerate(records, 1):
+        if 0 == count % RECORDS_BATCH:
+            budget.check(what)
+        yield record
 
 
 def update_metrics(metrics_pool, m_name, m_labels, value=1, size=0):
     name = '_'.join([m_name, 'count'])
     metrics_pool.inc(name, m_labels, value)
     name = '_'.join([m_name, 'size'])
-    metrics_pool.inc(name, m_labels, size)
+    # Size metrics aren't created when values aren't read
+    if name in metrics_pool.metrics:
+        metrics_pool.inc(name, m_labels, size)
 
     return metrics_pool
 
 
-def process_element(prom_metrics, buffer, authbackends, secretsengines):
-    def search_for_dict():
-        nonlocal buffer
-        dict_start = buffer.find('{')
-
-        if 0 != dict_start:
-            buffer = buffer[dict_start:]
-            dict_start = buffer.find('{')
-        dict_end = buffer.find('}')
-
-        if -1 != dict_end:
-            found = buffer[dict_start: dict_end + 1]
-            buffer = buffer[dict_end + 1:]
-            return json.loads(found)
-        else:
-            return None
-
-    element = search_for_dict()
-    while element is not None:
-        field = ''
-        value = ''
-        if 'Key' in element:
-            field = 'Key'
-            value = 'Value'
-        if 'key' in element:
-            field = 'key'
-            value = 'value'
-
-        if '' == field:
-            print('No key field found')
-            exit(1)
-
-        path = element[field].split('/')
-
-        if 'audit' == path[1]:
-            # audit_devices
-            prom_metrics = update_metrics(prom_metrics, m_name='vba_system_objects', m_labels=['audit_device'], value=1,
-                                          size=sys.getsizeof(element[value]))
-        elif 'core' == path[1]:
-            # core_objects
-            prom_metrics = update_metrics(prom_metrics, m_name='vba_system_objects', m_labels=['core'], value=1,
-                                          size=sys.getsizeof(element[value]))
-        elif 'auth' == path[1]:
-            # auth_backend_objects
-            prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_objects',
-                                          m_labels=[authbackends[path[2]]['type'],
-                                                    authbackends[path[2]]['name']], value=1,
-                                          size=sys.getsizeof(element[value]))
-
-            if 'userpass' == authbackends[path[2]]['type']:
-                if 'user' == path[3]:
-                    # auth_backend_users
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_users',
-                                                  m_labels=[authbackends[path[2]]['type'],
-                                                            authbackends[path[2]]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-            elif 'ldap' == authbackends[path[2]]['type']:
-                if 'user' == path[3]:
-                    # auth_backend_users
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_users',
-                                                  m_labels=[authbackends[path[2]]['type'],
-                                                            authbackends[path[2]]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-                elif 'group' == path[3]:
-                    # auth_backend_groups
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_groups',
-                                                  m_labels=[authbackends[path[2]]['type'],
-                                                            authbackends[path[2]]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-            elif 'approle' == authbackends[path[2]]['type']:
-                # auth_backend_secret_ids_accessors
-                if 'accessor' == path[3]:
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_secret_ids_accessors',
-                                                  m_labels=[authbackends[path[2]]['type'],
-                                                            authbackends[path[2]]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-                # auth_approle_role_ids
-                elif 'role_id' == path[3]:
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_role_ids',
-                                                  m_labels=[authbackends[path[2]]['type'],
-                                                            authbackends[path[2]]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-                # auth_approle_secret_ids
-                elif 'secret_id' == path[3]:
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_secret_ids',
-                                                  m_labels=[authbackends[path[2]]['type'],
-                                                            authbackends[path[2]]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-                # auth_approle_roles
-                elif 'role' == path[3]:
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_roles',
-                                                  m_labels=[authbackends[path[2]]['type'],
-                                                            authbackends[path[2]]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-        elif 'logical' == path[1]:
-            if 'cubbyhole' == secretsengines[path[2]]['type']:
-                # auth_secrets_engine_objects
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_objects',
-                                              m_labels=[secretsengines[path[2]]['type'],
-                                                        secretsengines[path[2]]['name'], ''], value=1,
-                                              size=sys.getsizeof(element[value]))
-                # auth_secrets_engine_objects
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_secrets',
-                                              m_labels=[secretsengines[path[2]]['type'],
-                                                        secretsengines[path[2]]['name'], ''], value=1,
-                                              size=sys.getsizeof(element[value]))
-
-            elif 'identity' == secretsengines[path[2]]['type']:
-                # auth_secrets_engine_objects
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_objects',
-                                              m_labels=[secretsengines[path[2]]['type'],
-                                                        secretsengines[path[2]]['name'], ''], value=1,
-                                              size=sys.getsizeof(element[value]))
-                # auth_secrets_engine_objects
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_secrets',
-                                              m_labels=[secretsengines[path[2]]['type'],
-                                                        secretsengines[path[2]]['name'], ''], value=1,
-                                              size=sys.getsizeof(element[value]))
-
-            elif 'kv' == secretsengines[path[2]]['type']:
-                if 'options' in secretsengines[path[2]]:
-                    # KVv2 should have version field with value equal 2. If not set - KVv1
-                    if 'version' in secretsengines[path[2]]['options']:
-                        if '2' == secretsengines[path[2]]['options']['version'] and len(path) > 4:
-                            # auth_secrets_engine_objects
-                            prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_objects',
-                                                          m_labels=[secretsengines[path[2]]['type'],
-                                                                    secretsengines[path[2]]['name'], 2], value=1,
-                                                          size=sys.getsizeof(element[value]))
-
-                            if 'metadata' == path[4]:
-                                # auth_secrets_engine_secrets
-                                prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_secrets',
-                                                              m_labels=[secretsengines[path[2]]['type'],
-                                                                        secretsengines[path[2]]['name'], 2], value=1,
-                                                              size=sys.getsizeof(element[value]))
-
-                            elif 'versions' == path[4]:
-                                # auth_secrets_engine_secrets_versions
-                                prom_metrics = update_metrics(prom_metrics,
-                                                              m_name='vba_secrets_engine_secrets_versions',
-                                                              m_labels=[secretsengines[path[2]]['type'],
-                                                                        secretsengines[path[2]]['name'], 2], value=1,
-                                                              size=sys.getsizeof(element[value]))
-
-                            elif 'archive' == path[4]:
-                                # auth_secrets_engine_secrets_archives
-                                prom_metrics = update_metrics(prom_metrics,
-                                                              m_name='vba_secrets_engine_secrets_archives',
-                                                              m_labels=[secretsengines[path[2]]['type'],
-                                                                        secretsengines[path[2]]['name'], 2], value=1,
-                                                              size=sys.getsizeof(element[value]))
-
-                            elif 'policy' == path[4]:
-                                # auth_secrets_engine_secrets_policies
-                                prom_metrics = update_metrics(prom_metrics,
-                                                              m_name='vba_secrets_engine_secrets_policies',
-                                                              m_labels=[secretsengines[path[2]]['type'],
-                                                                        secretsengines[path[2]]['name'], 2], value=1,
-                                                              size=sys.getsizeof(element[value]))
-
-                        else:
-                            # auth_secrets_engine_objects
-                            prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_objects',
-                                                          m_labels=[secretsengines[path[2]]['type'],
-                                                                    secretsengines[path[2]]['name'], 1], value=1,
-                                                          size=sys.getsizeof(element[value]))
-
-                            # auth_secrets_engine_secrets
-                            prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_secrets',
-                                                          m_labels=[secretsengines[path[2]]['type'],
-                                                                    secretsengines[path[2]]['name'], 1], value=1,
-                                                          size=sys.getsizeof(element[value]))
-
-            elif 'transit' == secretsengines[path[2]]['type']:
-                # secrets_engine_objects
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_objects',
-                                              m_labels=[secretsengines[path[2]]['type'],
-                                                        secretsengines[path[2]]['name'], ''], value=1,
-                                              size=sys.getsizeof(element[value]))
-
-                if 'archive' == path[3]:
-                    # secrets_engine_secrets_archives
-                    prom_metrics = update_metrics(prom_metrics,
-                                                  m_name='vba_secrets_engine_secrets_archives',
-                                                  m_labels=[secretsengines[path[2]]['type'],
-                                                            secretsengines[path[2]]['name'], 2], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-                elif 'policy' == path[3]:
-                    # secrets_engine_secrets_policies
-                    prom_metrics = update_metrics(prom_metrics,
-                                                  m_name='vba_secrets_engine_secrets_policies',
-                                                  m_labels=[secretsengines[path[2]]['type'],
-                                                            secretsengines[path[2]]['name'], 2], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-        elif 'sys' == path[1]:
-            if 'counters' == path[2]:
-                # audit_devices
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_system_objects', m_labels=['counters'],
-                                              value=1, size=sys.getsizeof(element[value]))
-
-            elif 'policy' == path[2]:
-                # sys_policy_objects
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_system_objects', m_labels=['policies'],
-                                              value=1, size=sys.getsizeof(element[value]))
-
-            elif 'config' == path[2]:
-                # sys_policy_objects
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_system_objects', m_labels=['config'],
-                                              value=1, size=sys.getsizeof(element[value]))
-
-            elif 'token' == path[2]:
-                uuid = find_uuid_auth_backend(authbackends, path[2])
-
-                prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_objects',
-                                              m_labels=[authbackends[uuid]['type'],
-                                                        authbackends[uuid]['name']], value=1,
-                                              size=sys.getsizeof(element[value]))
-
-                if 'accessor' == path[3]:
-                    # auth_backend_users
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_token_accessors',
-                                                  m_labels=[authbackends[uuid]['type'],
-                                                            authbackends[uuid]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-                elif 'id' == path[3]:
-                    # auth_backend_users
-                    prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_tokens',
-                                                  m_labels=[authbackends[uuid]['type'],
-                                                            authbackends[uuid]['name']], value=1,
-                                                  size=sys.getsizeof(element[value]))
-
-            elif 'expire' == path[2]:
-                if 'id' == path[3]:
-                    if 'auth' == path[4]:
-                        uuid = find_uuid_auth_backend(authbackends, path[5])
-
-                        if 'login' == path[6]:
-                            # auth_backend_tokens
-                            prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_tokens',
-                                                          m_labels=[authbackends[uuid]['type'],
-                                                                    authbackends[uuid]['name']], value=1,
-                                                          size=sys.getsizeof(element[value]))
-
-                        elif 'renew-self' == path[6]:
-                            prom_metrics = update_metrics(prom_metrics, m_name='vba_auth_backend_token_renew_self',
-                                                          m_labels=[authbackends[uuid]['type'],
-                                                                    authbackends[uuid]['name']], value=1,
-                                                          size=sys.getsizeof(element[value]))
-
-                    else:
-                        # auth_secrets_engine_objects
-                        prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_objects',
-                                                      m_labels=[path[4],
-                                                                'expire', ''], value=1,
-                                                      size=sys.getsizeof(element[value]))
-                        # auth_secrets_engine_objects
-                        prom_metrics = update_metrics(prom_metrics, m_name='vba_secrets_engine_secrets',
-                                                      m_labels=[path[4],
-                                                                'expire', ''], value=1,
-                                                      size=sys.getsizeof(element[value]))
-
-        element = search_for_dict()
-
-    return prom_metrics, buffer
+def process_element(metric_slots, key, size, classifier):
+    metric_slots.add(classifier.classify(key), size)
 
 
 def convert_hvac_dict(response_dict):
@@ -348,118 +2202,564 @@ def convert_hvac_dict(response_dict):
     return processed_dict
 
 
-if __name__ == "__main__":
-    # TODO: args should be parsed in separated function
-    BACKUP_FNAME = sys.argv[1]
+class MountTablesCache:
+    """Auth backends and secrets engines fetched from vault, cached on disk per vault address for ttl seconds"""
+    def __init__(self, cache_dir, ttl):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def path(self, vault_addr):
+        name = hashlib.sha256(vault_addr.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, 'mounts-{}.json'.format(name))
+
+    def load(self, vault_addr):
+        try:
+            with open(self.path(vault_addr), 'r') as cache_file:
+                cached = json.loads(cache_file.read())
+        except (OSError, ValueError):
+            return None
+
+        if cached.get('vault_addr') != vault_addr or time.time() - cached.get('fetched_at', 0) > self.ttl:
+            return None
+        return cached['auth_backends'], cached['secrets_engines']
+
+    def store(self, vault_addr, auth_backs, secrets_engs):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.path(vault_addr)
+        # Write to temporary file first, so concurrent runs never read partially written cache
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            cache_file.write(json.dumps({'vault_addr': vault_addr, 'fetched_at': time.time(),
+                                         'auth_backends': auth_backs, 'secrets_engines': secrets_engs}))
+        os.replace(tmp_path, path)
+
+    def invalidate(self, vault_addr):
+        try:
+            os.remove(self.path(vault_addr))
+        except FileNotFoundError:
+            pass
+
+
+@functools.lru_cache(maxsize=None)
+def vault_client(vault_addr, vault_creds_file):
+    """Vault client logged in with approle, cached per process, so its token and HTTP session are reused"""
+    with open(vault_creds_file, 'r') as creds_file:
+        creds = json.loads(creds_file.read())
+
+    import hvac
+    client = hvac.Client(url=vault_addr, verify=True)
+    client.auth_approle(creds['role_id'], creds['secret_id'])
+    return client
+
+
+def fetch_mount_tables(vault_addr, vault_creds_file):
+    import hvac
+    for attempt in range(2):
+        client = vault_client(vault_addr, vault_creds_file)
+        try:
+            auth_backs = convert_hvac_dict(client.sys.list_auth_methods())
+            secrets_engs = convert_hvac_dict(client.sys.list_mounted_secrets_engines())
+            return auth_backs, secrets_engs
+        except hvac.exceptions.Forbidden:
+            # Token of cached client has expired, log in again once
+            if attempt:
+                raise
+            vault_client.cache_clear()
+
+
+def convert_mount_table(table):
+    processed_dict = {}
+    for entry in table.get('entries') or []:
+        mount = dict(entry)
+        mount['name'] = mount.pop('path').strip('/')
+        processed_dict[mount.pop('uuid')] = mount
+
+    return processed_dict
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Analyze vault backup exported from consul and push metrics to '
+                                                 'pushgateway')
+    parser.add_argument('backup_file', nargs='?',
+                        help='Backup made with `consul kv export` or consul address with KV prefix '
+                             'to read it from directly, e.g. http://localhost:8500/vault')
     # TODO: variability:
     #    Should script push metrics to pushgateway or
-    #      * start it's own web server
     #      * just output metrics to log
-    PUSHGATEWAY_ADDR = sys.argv[2]
-    LABELS = sys.argv[3]
+    parser.add_argument('pushgateway_addr', nargs='?', help='Pushgateway address, host:port. Not used with --listen')
+    parser.add_argument('labels', nargs='?', help='Grouping key labels, comma separated name=value pairs')
     # TODO: variability:
     #  WIth query to vault and without
     #  Use vault agent for get and store token to file
     #  If we don't want convert UUIDs to human readable values
     #  Also It is possible that script will read data with unknown IDs
-    VAULT_ADDR = sys.argv[4]
-    VAULT_CREDS_FILE = sys.argv[5]
-
-    labels = LABELS.split(',')
+    parser.add_argument('vault_addr', nargs='?', help='Vault address to get auth backends and secrets engines from')
+    parser.add_argument('vault_creds_file', nargs='?', help='JSON file with approle role_id and secret_id')
+    parser.add_argument('--offline', action='store_true',
+                        help='Read auth backends and secrets engines from mount tables in backup instead of vault. '
+                             'Mount tables should be stored unencrypted, e.g. in decrypted backup')
+    parser.add_argument('--mounts-cache-dir',
+                        help='Directory to cache auth backends and secrets engines fetched from vault in')
+    parser.add_argument('--mounts-cache-ttl', type=int, default=3600,
+                        help='Seconds to use cached auth backends and secrets engines for, default: 3600')
+    parser.add_argument('--diff-index',
+                        help='Per-key index of previous run. Only keys added since it are classified, metrics of '
+                             'added and removed keys are pushed too. Index is rewritten for the next run')
+    parser.add_argument('--listen', metavar='[HOST:]PORT',
+                        help='Serve metrics over HTTP instead of pushing them. Backup is analyzed again '
+                             'every time it changes')
+    parser.add_argument('--interval', type=int, default=0,
+                        help='With --listen analyze backup again at least every INTERVAL seconds, even if it '
+                             'has not changed. Default: only on change')
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='Read backup while auth backends and secrets engines are being fetched from vault, '
+                             'retry pushing metrics with backoff')
+    parser.add_argument('--counts-only', action='store_true',
+                        help='Count keys without reading values, size metrics are not pushed')
+    parser.add_argument('--top', type=int, default=0, metavar='N',
+                        help='Push N storage paths with the most objects and the largest size, N largest objects '
+                             'and histograms of object sizes per mount')
+    parser.add_argument('--lease-timeline', action='store_true',
+                        help='Push counts of leases expiring and issued within 1h, 24h and 7d of backup time per '
+                             'mount. Leases can be decoded only from decrypted backup')
+    parser.add_argument('--export-keys', metavar='FILE',
+                        help='Write one row per key (mount, kind, depth, value size and its base64 encoded size) '
+                             'to Parquet FILE, or Arrow IPC FILE if it ends with .arrow or .feather. '
+                             'Requires pyarrow package')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='Write cProfile stats of the run to FILE (see `python -m pstats FILE`) and print time '
+                             'per phase to stderr')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of processes to analyze backup with, backup is split into shards between them')
+    parser.add_argument('--batch', metavar='CONFIG',
+                        help='Analyze backups of several clusters listed in JSON config file concurrently and push '
+                             'their metrics in one pass. Positional arguments are taken from the config')
+    parser.add_argument('--no-mmap', dest='use_mmap', action='store_false',
+                        help='Read backup in text mode instead of mapping it into memory')
+    parser.add_argument('--max-memory', type=parse_size, metavar='SIZE',
+                        help='Memory budget of analysis, e.g. 512M or 2G: values too large for it are measured '
+                             'without being buffered, analysis fails with MemoryError once RSS exceeds it. '
+                             'Shared between --workers')
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        return args
+    if args.backup_file is None or args.pushgateway_addr is None or args.labels is None:
+        parser.error('backup_file, pushgateway_addr and labels are required unless --batch is set')
+    if args.workers > 1 and not args.use_mmap:
+        parser.error('--workers requires mmap mode')
+    if args.workers > 1 and args.diff_index:
+        parser.error('--diff-index does not support --workers')
+    if args.use_async and (args.workers > 1 or args.diff_index or args.listen):
+        parser.error('--async does not support --workers, --diff-index and --listen')
+    if is_consul_url(args.backup_file) and (args.workers > 1 or args.listen):
+        parser.error('--workers and --listen require backup file')
+    if args.counts_only and args.diff_index:
+        parser.error('--diff-index does not support --counts-only')
+    if (args.top or args.lease_timeline) and (args.diff_index or args.use_async or args.counts_only):
+        parser.error('--top and --lease-timeline do not support --diff-index, --async and --counts-only')
+    if args.export_keys and (args.workers > 1 or args.use_async or args.diff_index):
+        parser.error('--export-keys does not support --workers, --async and --diff-index')
+    if args.profile and (args.workers > 1 or args.use_async or args.listen):
+        parser.error('--profile does not support --workers, --async and --listen')
+    if not args.offline and (args.vault_addr is None or args.vault_creds_file is None):
+        parser.error('vault_addr and vault_creds_file are required unless --offline is set')
+
+    return args
+
+
+def read_records_batch(records, stats, batch_size=RECORDS_BATCH):
+    """Up to batch_size records, time of reading and parsing them is added to stats"""
+    with stats.phase('read'):
+        return list(itertools.islice(records, batch_size))
+
+
+def process_records_batch(records, classifier, pending, stats, batch_size):
+    """Classify up to batch_size records with classifier compiled without mount tables,
+    records which depend on mount tables are put to pending. Returns False if records are exhausted."""
+    batch = read_records_batch(records, stats, batch_size)
+    with stats.phase('classify'):
+        for key, size in batch:
+            if key.partition('/')[2].startswith(MOUNT_DEPENDENT_PREFIXES):
+                pending.append((key, size))
+            else:
+                process_element(classifier.slots, key, size, classifier)
+    return len(batch) == batch_size
+
+
+def process_batch(classifier, records, numpy=None):
+    """process_element for a batch of records classified with classify_batch, counts are summed with NumPy
+    if it is given. Returns codes of classifications."""
+    codes = classifier.classify_batch([key for key, _ in records])
+    if numpy is None:
+        classes = classifier.classes
+        for (_, size), code in zip(records, codes):
+            classifier.slots.add(classes[code], size)
+    else:
+        classifier.slots.add_batch(classifier.classes, codes, [size for _, size in records])
+    return codes
+
+
+def process_records(records, classifier, stats, report=None, key_export=None, budget=None):
+    """Classify records batch by batch, so reading and classification are timed separately.
+    Batches are classified with NumPy if it is installed. Every batch is written to key_export if it is given,
+    with classifications it already has.
+    MemoryBudget is checked after every batch if budget is given."""
+    batch = read_records_batch(records, stats)
+    # Import of NumPy takes longer than classification of backup fitting into a single batch
+    numpy = optional_module('numpy') if len(batch) == RECORDS_BATCH else None
+    while batch:
+        if budget is not None:
+            budget.check('Analysis')
+        with stats.phase('classify'):
+            if numpy is None and key_export is None:
+                for key, size in batch:
+                    process_element(classifier.slots, key, size, classifier)
+            else:
+                codes = process_batch(classifier, batch, numpy)
+            if report is not None:
+                for key, size in batch:
+                    report.add(key, size)
+        if key_export is not None:
+            with stats.phase('export'):
+                key_export.write(batch, codes, classifier)
+        batch = read_records_batch(records, stats)
+
+
+async def analyze_backup_async(args, stats):
+    """Start reading backup while mount tables are being fetched. Keys which don't depend on mount tables are
+    classified right away, the rest are buffered until mount tables arrive or --max-memory is reached.
+    Returns metric slots, UUIDs of unresolved mounts and the result of get_mount_tables."""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    mount_tables = loop.run_in_executor(None, stats.timed, 'mount_tables', get_mount_tables, args)
+
+    metric_slots = MetricSlots()
+    budget = memory_budget(args)
+    records = iter_backup_records(args.backup_file, args.use_mmap, counts_only=args.counts_only, budget=budget,
+                                  stats=stats)
+    pending = []
+    more = True
+    system_classifier = PathClassifier({}, {}, metric_slots)
+    while more and not mount_tables.done() and (budget is None or not budget.exceeded()):
+        more = await loop.run_in_executor(None, process_records_batch, records, system_classifier, pending,
+                                          stats, RECORDS_BATCH)
+
+    auth_backs, secrets_engs, mounts_cache = await mount_tables
+    classifier = PathClassifier(auth_backs, secrets_engs, metric_slots)
+    with stats.phase('classify'):
+        for key, size in pending:
+            process_element(metric_slots, key, size, classifier)
+    del pending[:]
+    if more:
+        await loop.run_in_executor(None, process_records, records, classifier, stats, None, None, budget)
+
+    return metric_slots, classifier.unresolved_mounts, (auth_backs, secrets_engs, mounts_cache)
+
+
+async def push_metrics_async(metrics):
+    """Push metrics from executor, so event loop isn't blocked, retry with exponential backoff"""
+    import asyncio
+    loop = asyncio.get_running_loop()
+    for attempt in range(PUSH_ATTEMPTS):
+        try:
+            await loop.run_in_executor(None, metrics.push_metrics)
+            return
+        except OSError as error:
+            if attempt == PUSH_ATTEMPTS - 1:
+                raise
+            print('Failed to push metrics: {}, retrying'.format(error), file=sys.stderr)
+            await asyncio.sleep(PUSH_BACKOFF * 2 ** attempt)
+
+
+async def collect_and_push_async(args):
+    """Analyze backup with analyze_backup_async, metrics are built from the result as in sync mode and pushed"""
+    from prometheus_client import CollectorRegistry
+    stats = AnalyzerStats()
+    metric_slots, unresolved_mounts, mount_tables = await analyze_backup_async(args, stats)
+    mounts_cache = mount_tables[2]
+    if unresolved_mounts and mounts_cache is not None:
+        # Backup contains mounts created after cache was filled, they are fetched again while backup is read
+        mounts_cache.invalidate(args.vault_addr)
+        metric_slots, unresolved_mounts, mount_tables = await analyze_backup_async(args, stats)
+    auth_backs, secrets_engs, _ = mount_tables
+
+    analysis = (auth_backs, secrets_engs, metric_slots, None, unresolved_mounts, [])
+    metrics = build_metrics(args, CollectorRegistry(), analysis, stats)
+    await push_metrics_async(metrics)
+    return metrics
+
+
+def parse_labels(labels):
     label_names = []
     label_values = []
 
-    for label in labels:
+    for label in labels.split(','):
         label_name, label_value = label.split('=')
         label_names.append(label_name)
         label_values.append(label_value)
 
-    with open(VAULT_CREDS_FILE, 'r') as creds_file:
-        creds = json.loads(creds_file.read())
-
-    VAULT_ROLE_ID = creds['role_id']
-    VAULT_SECRET_ID = creds['secret_id']
-
-    vault_client = hvac.Client(url=VAULT_ADDR, verify=True)
-    vault_token = vault_client.auth_approle(VAULT_ROLE_ID, VAULT_SECRET_ID)
-
-    auth_backends = convert_hvac_dict(vault_client.sys.list_auth_methods())
-    secrets_engines = convert_hvac_dict(vault_client.sys.list_mounted_secrets_engines())
-
-    prom_registry = CollectorRegistry()
-    # Init metrics
-    metrics = Metrics(registry=prom_registry, pushgateway_addr=PUSHGATEWAY_ADDR, labelnames=label_names,
+    return label_names, label_values
+
+
+def get_mount_tables(args):
+    """Returns auth backends, secrets engines and cache they were loaded from (None if they are fresh)"""
+    if args.offline:
+        auth_backs, secrets_engs = read_backup_mount_tables(args.backup_file)
+        return auth_backs, secrets_engs, None
+
+    mounts_cache = None
+    if args.mounts_cache_dir:
+        mounts_cache = MountTablesCache(args.mounts_cache_dir, args.mounts_cache_ttl)
+        mounts_cached = mounts_cache.load(args.vault_addr)
+        if mounts_cached is not None:
+            auth_backs, secrets_engs = mounts_cached
+            return auth_backs, secrets_engs, mounts_cache
+
+    auth_backs, secrets_engs = fetch_mount_tables(args.vault_addr, args.vault_creds_file)
+    if mounts_cache is not None:
+        mounts_cache.store(args.vault_addr, auth_backs, secrets_engs)
+    return auth_backs, secrets_engs, None
+
+
+def backup_time(backup_file_name):
+    """Time backup was made at: modification time of file, now for consul KV API"""
+    if is_consul_url(backup_file_name):
+        return time.time()
+    return os.stat(backup_file_name).st_mtime
+
+
+def memory_budget(args):
+    return MemoryBudget(args.max_memory) if args.max_memory else None
+
+
+def run_analysis(args, auth_backs, secrets_engs, stats):
+    """Returns metric slots, MetricDiff (--diff-index), UUIDs of unresolved mounts and reports
+    (StorageReport with --top, LeaseTimeline with --lease-timeline)"""
+    budget = memory_budget(args)
+    if args.diff_index:
+        with stats.phase('diff'):
+            return analyze_backup_diff(args.backup_file, auth_backs, secrets_engs, args.diff_index,
+                                       use_mmap=args.use_mmap, budget=budget, stats=stats) + ([],)
+    report = StorageReport(args.top) if args.top else None
+    lease_timeline = LeaseTimeline(backup_time(args.backup_file)) if args.lease_timeline else None
+    key_export = KeyExport(args.export_keys) if args.export_keys else None
+    try:
+        metric_slots, unresolved_mounts = analyze_backup(args.backup_file, auth_backs, secrets_engs,
+                                                         use_mmap=args.use_mmap, workers=args.workers,
+                                                         counts_only=args.counts_only, report=report,
+                                                         value_sink=lease_timeline, stats=stats,
+                                                         key_export=key_export, budget=budget)
+    finally:
+        if key_export is not None:
+            key_export.close()
+    return metric_slots, None, unresolved_mounts, [item for item in (report, lease_timeline) if item is not None]
+
+
+def analyze_cluster(args, stats):
+    """Get mount tables and analyze backup with them, cached mount tables are fetched again if backup has
+    mounts unknown to them. Returns auth backends, secrets engines and the result of run_analysis."""
+    with stats.phase('mount_tables'):
+        auth_backs, secrets_engs, mounts_cache = get_mount_tables(args)
+    metric_slots, metric_diff, unresolved_mounts, reports = run_analysis(args, auth_backs, secrets_engs, stats)
+    if unresolved_mounts and mounts_cache is not None:
+        # Backup contains mounts created after cache was filled
+        with stats.phase('mount_tables'):
+            mounts_cache.invalidate(args.vault_addr)
+            auth_backs, secrets_engs = fetch_mount_tables(args.vault_addr, args.vault_creds_file)
+            mounts_cache.store(args.vault_addr, auth_backs, secrets_engs)
+        metric_slots, metric_diff, unresolved_mounts, reports = run_analysis(args, auth_backs, secrets_engs, stats)
+    return auth_backs, secrets_engs, metric_slots, metric_diff, unresolved_mounts, reports
+
+
+def build_metrics(args, registry, analysis, stats):
+    """Metrics registered in registry from the result of analyze_cluster, self-metrics are taken from stats"""
+    label_names, label_values = parse_labels(args.labels)
+    metrics = Metrics(registry=registry, pushgateway_addr=args.pushgateway_addr, labelnames=label_names,
                       labelvalues=label_values)
+    metrics = create_metrics(metrics, count_metrics_list() if args.counts_only else None)
+
+    auth_backs, secrets_engs, metric_slots, metric_diff, _, reports = analysis
+    with stats.phase('flush'):
+        metrics = metric_slots.flush(metrics)
+        if metric_diff is not None:
+            metrics = create_metrics(metrics, diff_metrics_list())
+            metrics = metric_diff.flush(metrics)
+        for report in reports:
+            metrics = create_metrics(metrics, report.metrics_list)
+            metrics = report.flush(metrics, auth_backs, secrets_engs)
+    metrics = create_metrics(metrics, stats.metrics_list)
+    return stats.flush(metrics, auth_backs, secrets_engs)
+
+
+def collect_metrics(args, registry, stats=None):
+    """Analyze backup into new metrics registered in registry"""
+    if stats is None:
+        stats = AnalyzerStats()
+    return build_metrics(args, registry, analyze_cluster(args, stats), stats)
+
+
+def backup_file_state(backup_file_name):
+    try:
+        stat = os.stat(backup_file_name)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+def serve_metrics(args):
+    """Exporter mode: serve metrics over HTTP, analyze backup again when it changes or interval passes.
+    Backup is analyzed only after it stays unchanged for WATCH_PERIOD, so it isn't read while being written."""
+    from prometheus_client import CollectorRegistry, start_http_server
+    host, _, port = args.listen.rpartition(':')
+    label_names, label_values = parse_labels(args.labels)
+    collector = SnapshotCollector(dict(zip(label_names, label_values)))
+    serving_registry = CollectorRegistry()
+    serving_registry.register(collector)
+    start_http_server(int(port), host, registry=serving_registry)
+
+    analyzed_state = None
+    analyzed_at = 0
+    previous_state = None
+    while True:
+        state = backup_file_state(args.backup_file)
+        expired = args.interval and time.time() - analyzed_at >= args.interval
+        if state is not None and state == previous_state and (state != analyzed_state or expired):
+            analyzed_state = state
+            analyzed_at = time.time()
+            try:
+                registry = CollectorRegistry()
+                collect_metrics(args, registry)
+                collector.swap(registry)
+            except Exception as error:
+                # Keep serving the previous snapshot
+                print('Failed to analyze {}: {}'.format(args.backup_file, error), file=sys.stderr)
+        previous_state = state
+        time.sleep(WATCH_PERIOD)
+
+
+def cluster_argv(options):
+    """Command line of batch config entry: positional arguments are given by their names, options by long names
+    without dashes, flags are set with true"""
+    argv = []
+    for name, value in options.items():
+        if name in BATCH_ARGUMENTS or value is None or value is False:
+            continue
+        argv.append('--' + name.replace('_', '-'))
+        if value is not True:
+            argv.append(str(value))
+    return argv + [str(options[name]) for name in BATCH_ARGUMENTS if options.get(name) is not None]
+
+
+def load_batch_config(config_file_name):
+    """Arguments of every cluster in batch config and the number of processes to analyze them with.
+    Options of 'defaults' apply to all clusters, 'pushgateway_addr' is the default pushgateway."""
+    with open(config_file_name, 'r') as config_file:
+        config = json.loads(config_file.read())
+
+    defaults = dict(config.get('defaults') or {})
+    if config.get('pushgateway_addr'):
+        defaults.setdefault('pushgateway_addr', config['pushgateway_addr'])
+    clusters = []
+    grouping_keys = set()
+    for options in config.get('clusters') or []:
+        options = dict(defaults, **options)
+        unsupported = [name for name in options if name.replace('_', '-') in BATCH_UNSUPPORTED_OPTIONS]
+        if unsupported:
+            raise ValueError('Batch mode does not support {} (cluster {})'.format(
+                ', '.join(unsupported), options.get('labels')))
+        try:
+            cluster_args = parse_args(cluster_argv(options))
+        except SystemExit:
+            print('Invalid options of cluster {}'.format(options.get('labels')), file=sys.stderr)
+            raise
+        grouping_key = (cluster_args.pushgateway_addr, tuple(sorted(cluster_args.labels.split(','))))
+        if grouping_key in grouping_keys:
+            raise ValueError('Clusters with labels {} would overwrite metrics of each other'.format(
+                cluster_args.labels))
+        grouping_keys.add(grouping_key)
+        clusters.append(cluster_args)
+
+    if not clusters:
+        raise ValueError('No clusters in {}'.format(config_file_name))
+    return clusters, config.get('processes') or os.cpu_count()
+
+
+def analyze_batch_cluster(args):
+    """Analysis of one cluster in batch pool process, returns the result of analyze_cluster and AnalyzerStats"""
+    stats = AnalyzerStats()
+    return analyze_cluster(args, stats), stats
+
+
+def run_batch(args):
+    """Analyze clusters of batch config in bounded process pool, then push metrics of all of them in one pass,
+    over one connection per pushgateway. Failure of a cluster is reported and doesn't stop the others.
+    Returns the number of failed clusters."""
+    from concurrent.futures import ProcessPoolExecutor
+    from prometheus_client import CollectorRegistry
+    clusters, processes = load_batch_config(args.batch)
+    failed = 0
+    results = []
+    with ProcessPoolExecutor(max_workers=min(processes, len(clusters))) as executor:
+        futures = [executor.submit(analyze_batch_cluster, cluster_args) for cluster_args in clusters]
+        for cluster_args, future in zip(clusters, futures):
+            try:
+                results.append((cluster_args,) + future.result())
+            except Exception as error:
+                failed += 1
+                print('Failed to analyze {} ({}): {}'.format(cluster_args.backup_file, cluster_args.labels, error),
+                      file=sys.stderr)
+
+    session = PushgatewaySession()
+    try:
+        for cluster_args, analysis, stats in results:
+            try:
+                metrics = build_metrics(cluster_args, CollectorRegistry(), analysis, stats)
+                metrics.push_metrics(session.handler)
+            except Exception as error:
+                failed += 1
+                print('Failed to push metrics of {}: {}'.format(cluster_args.labels, error), file=sys.stderr)
+    finally:
+        session.close()
+    return failed
+
+
+@contextlib.contextmanager
+def profiled(profile_file_name, stats):
+    """Profile the block with cProfile into profile_file_name and print time per phase to stderr"""
+    if not profile_file_name:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        profiler.dump_stats(profile_file_name)
+        print(stats.summary(), file=sys.stderr)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.batch:
+        if run_batch(args):
+            sys.exit(1)
+    elif args.listen:
+        serve_metrics(args)
+    elif args.use_async:
+        import asyncio
+        asyncio.run(collect_and_push_async(args))
+    else:
+        from prometheus_client import CollectorRegistry
+        stats = AnalyzerStats()
+        with profiled(args.profile, stats):
+            metrics = collect_metrics(args, CollectorRegistry(), stats)
+            # Push time is known only after push, it is printed with --profile
+            with stats.phase('push'):
+                metrics.push_metrics()
 
-    metrics_list = {
-        'vba_auth_backend_objects_count': {'label_names': ['type', 'mount_point'],
-                                           'description': 'Count auth backend objects'},
-        'vba_auth_backend_objects_size': {'label_names': ['type', 'mount_point'],
-                                          'description': 'Size of auth backend objects'},
-        'vba_auth_backend_roles_count': {'label_names': ['type', 'mount_point'],
-                                         'description': 'Count auth backend roles'},
-        'vba_auth_backend_roles_size': {'label_names': ['type', 'mount_point'],
-                                        'description': 'Size of auth backend role_ids'},
-        'vba_auth_backend_role_ids_count': {'label_names': ['type', 'mount_point'],
-                                            'description': 'Count auth backend role_ids'},
-        'vba_auth_backend_role_ids_size': {'label_names': ['type', 'mount_point'],
-                                           'description': 'Size of auth backend roles'},
-        'vba_auth_backend_secret_ids_count': {'label_names': ['type', 'mount_point'],
-                                              'description': 'Count auth backend secret_ids'},
-        'vba_auth_backend_secret_ids_size': {'label_names': ['type', 'mount_point'],
-                                             'description': 'Size of auth backend secret_ids'},
-        'vba_auth_backend_secret_ids_accessors_count': {'label_names': ['type', 'mount_point'],
-                                                        'description': 'Count auth backend secret_ids_accessors'},
-        'vba_auth_backend_secret_ids_accessors_size': {'label_names': ['type', 'mount_point'],
-                                                       'description': 'Size of auth backend secret_ids_accessors'},
-        'vba_auth_backend_tokens_count': {'label_names': ['type', 'mount_point'],
-                                          'description': 'Count auth backend tokens'},
-        'vba_auth_backend_tokens_size': {'label_names': ['type', 'mount_point'],
-                                         'description': 'Size of auth backend tokens'},
-        'vba_auth_backend_token_renew_self_count': {'label_names': ['type', 'mount_point'],
-                                                     'description': 'Count auth backend tokens renew self'},
-        'vba_auth_backend_token_renew_self_size': {'label_names': ['type', 'mount_point'],
-                                                    'description': 'Size of auth backend tokens renew self'},
-        'vba_auth_backend_token_accessors_count': {'label_names': ['type', 'mount_point'],
-                                                   'description': 'Count auth backend token accessors'},
-        'vba_auth_backend_token_accessors_size': {'label_names': ['type', 'mount_point'],
-                                                  'description': 'Size of auth backend token accessors'},
-        'vba_auth_backend_users_count': {'label_names': ['type', 'mount_point'],
-                                         'description': 'Count auth backend users'},
-        'vba_auth_backend_users_size': {'label_names': ['type', 'mount_point'],
-                                        'description': 'Size of auth backend users'},
-        'vba_auth_backend_groups_count': {'label_names': ['type', 'mount_point'],
-                                          'description': 'Count auth backend groups'},
-        'vba_auth_backend_groups_size': {'label_names': ['type', 'mount_point'],
-                                         'description': 'Size of auth backend groups'},
-        'vba_secrets_engine_objects_count': {'label_names': ['type', 'mount_point', 'version'],
-                                             'description': 'Count secrets engine objects'},
-        'vba_secrets_engine_objects_size': {'label_names': ['type', 'mount_point', 'version'],
-                                            'description': 'Size of secrets engine objects'},
-        'vba_secrets_engine_secrets_count': {'label_names': ['type', 'mount_point', 'version'],
-                                             'description': 'Count secrets engine secrets'},
-        'vba_secrets_engine_secrets_size': {'label_names': ['type', 'mount_point', 'version'],
-                                            'description': 'Size of secrets engine secrets'},
-        'vba_secrets_engine_secrets_archives_count': {'label_names': ['type', 'mount_point', 'version'],
-                                                      'description': 'Count secrets engine secrets archives'},
-        'vba_secrets_engine_secrets_archives_size': {'label_names': ['type', 'mount_point', 'version'],
-                                                     'description': 'Count secrets engine secrets archives'},
-        'vba_secrets_engine_secrets_policies_count': {'label_names': ['type', 'mount_point', 'version'],
-                                                      'description': 'Count secrets engine secrets policies'},
-        'vba_secrets_engine_secrets_policies_size': {'label_names': ['type', 'mount_point', 'version'],
-                                                     'description': 'Count secrets engine secrets policies'},
-        'vba_secrets_engine_secrets_versions_count': {'label_names': ['type', 'mount_point', 'version'],
-                                                      'description': 'Count secrets engine secrets versions'},
-        'vba_secrets_engine_secrets_versions_size': {'label_names': ['type', 'mount_point', 'version'],
-                                                     'description': 'Count secrets engine secrets versions'},
-        'vba_system_objects_count': {'label_names': ['type'], 'description': 'Count system objects'},
-        'vba_system_objects_size': {'label_names': ['type'], 'description': 'Size of system objects'},
-    }
-
-    for metric in metrics_list.keys():
-        metrics.create_metric(metric_name=metric, description=metrics_list[metric]['description'],
-                              labelnames=metrics_list[metric]['label_names'])
-
-    metrics = process_backup(BACKUP_FNAME, metrics, auth_backends, secrets_engines)
 
-    metrics.push_metrics()
+if __name__ == "__main__":
+    main()